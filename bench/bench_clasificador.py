@@ -0,0 +1,61 @@
+# Micro-benchmark del clasificador de solicitudes: compara el coste por mensaje de la búsqueda
+# anterior (24 búsquedas de subcadena + 4 sobre el texto en minúsculas) con clasificar_mensaje
+# en mensajes cortos y en pies de foto largos.
+#
+# Uso:
+#   python bench/bench_clasificador.py [--repeticiones 20000]
+import argparse
+import os
+import sys
+import timeit
+
+DIRECTORIO = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(DIRECTORIO))
+
+# main.py exige estas variables al importarse; el clasificador no usa ni la red ni la base de datos
+os.environ.setdefault("TOKEN", "123456789:AAHdqTcvCH1vGWJxfSeofSAs0K5PALDsaw")
+os.environ.setdefault("GROUP_DESTINO", "-1001000000001")
+os.environ.setdefault("DATABASE_URL", "postgresql://localhost/entreshijos_bench")
+
+import logging
+logging.disable(logging.CRITICAL)
+import main
+
+COMANDOS_ANTERIORES = [
+    '/solicito', '/solícito', '/SOLÍCITO', '/SOLICITO', '/Solicito', '/Solícito',
+    '#solicito', '#solícito', '#SOLÍCITO', '#SOLICITO', '#Solicito', '#Solícito',
+    '/petición', '/peticion', '/PETICIÓN', '/PETICION', '/Petición', '/Peticion',
+    '#petición', '#peticion', '#PETICIÓN', '#PETICION', '#Petición', '#Peticion',
+]
+
+def clasificar_anterior(texto):
+    if any(cmd in texto for cmd in COMANDOS_ANTERIORES):
+        return "valida"
+    if any(word in texto.lower() for word in ['solicito', 'solícito', 'peticion', 'petición']):
+        return "casi"
+    return None
+
+RELLENO = "Compartimos la colección completa en 4K con subtítulos en castellano, audio dual y extras. "
+CASOS = {
+    "charla corta": "buenas tardes, ¿alguien sabe si ya salió la segunda temporada?",
+    "solicitud corta": "/solicito Dune: Parte Dos (2024)",
+    "casi-acierto corto": "solicito la última de Nolan por favor",
+    "variante no enumerada": "/SOLICITÓ Oppenheimer",
+    "pie largo sin comando": (RELLENO * 12)[:1024],
+    "pie largo con comando al final": (RELLENO * 12)[:1000] + " #PETICIÓN",
+    "mensaje 4096 sin comando": (RELLENO * 48)[:4096],
+}
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description="Micro-benchmark del clasificador de solicitudes")
+    parser.add_argument("--repeticiones", type=int, default=20000)
+    args = parser.parse_args()
+    print(f"{'caso':<32}{'anterior µs':>13}{'actual µs':>12}{'mejora':>9}   resultado")
+    for nombre, texto in CASOS.items():
+        anterior = min(timeit.repeat(lambda: clasificar_anterior(texto), number=args.repeticiones, repeat=3)) / args.repeticiones
+        actual = min(timeit.repeat(lambda: main.clasificar_mensaje(texto), number=args.repeticiones, repeat=3)) / args.repeticiones
+        print(f"{nombre:<32}{anterior * 1e6:>13.2f}{actual * 1e6:>12.2f}{anterior / actual:>8.1f}x   "
+              f"{clasificar_anterior(texto)} -> {main.clasificar_mensaje(texto)}")
+
+if __name__ == "__main__":
+    main_benchmark()
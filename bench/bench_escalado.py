@@ -0,0 +1,266 @@
+# Benchmark de extremo a extremo: arranca gunicorn con 1..N workers contra el stub local de la
+# Bot API y una base de datos desechable, lanza /webhook a una tasa objetivo (carga en lazo abierto)
+# y mide throughput, latencia de la respuesta HTTP, llamadas a la API y conexiones a PostgreSQL.
+#
+# Uso:
+#   python bench/bench_escalado.py --pg-url postgresql://postgres@localhost/postgres \
+#       --workers 1,2,4 --tasa 200 --duracion 20 --latencia-ms 80 --tasa-429 0.01 --grafica escalado.png
+#
+# Las variables de entorno del bot (WEBHOOK_WORKERS, OUTBOX_WORKERS, DB_POOL_MAX...) se heredan,
+# así que se pueden comparar configuraciones exportándolas antes de lanzar el script.
+import argparse
+import http.client
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import psycopg2
+
+DIRECTORIO = os.path.dirname(os.path.abspath(__file__))
+RAIZ = os.path.dirname(DIRECTORIO)
+sys.path.insert(0, DIRECTORIO)
+
+from bench_handlers import TOKEN_FALSO, GRUPO_DESTINO, crear_base, eliminar_base, percentil, revision_git, url_con_base
+from botapi_stub import iniciar_stub
+from fake_telegram import GeneradorUpdates
+
+GRUPO_PETICIONES = -1002350263641
+HILO_PETICIONES = 19
+# Mezcla de tráfico: la mayoría es charla del grupo, el resto solicitudes y casi-solicitudes
+MEZCLA = [("charla", 0.7), ("solicitud", 0.2), ("casi_solicitud", 0.1)]
+
+def puerto_libre():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+class GeneradorCarga:
+    def __init__(self, puerto, concurrencia):
+        self.puerto = puerto
+        self.updates = GeneradorUpdates()
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.resultados = []
+        self.usuarios = 0
+        self.ejecutor = ThreadPoolExecutor(max_workers=concurrencia)
+
+    def _conexion(self):
+        if getattr(self.local, "conexion", None) is None:
+            self.local.conexion = http.client.HTTPConnection("127.0.0.1", self.puerto, timeout=30)
+        return self.local.conexion
+
+    def siguiente_update(self):
+        with self.lock:
+            self.usuarios += 1
+            user_id = 700000 + self.usuarios
+        tipo = random.choices([t for t, _ in MEZCLA], [p for _, p in MEZCLA])[0]
+        texto = {"charla": "buenas, ¿alguien ha visto la última de Nolan?",
+                 "solicitud": f"/solicito Película {user_id}",
+                 "casi_solicitud": "solicito la serie completa"}[tipo]
+        return json.dumps(self.updates.mensaje(GRUPO_PETICIONES, user_id, texto, HILO_PETICIONES, f"carga{user_id}"))
+
+    def _enviar(self, cuerpo):
+        inicio = time.perf_counter()
+        try:
+            conexion = self._conexion()
+            conexion.request("POST", "/webhook", body=cuerpo, headers={"Content-Type": "application/json"})
+            respuesta = conexion.getresponse()
+            respuesta.read()
+            estado = respuesta.status
+        except Exception:
+            self.local.conexion = None
+            estado = 0
+        with self.lock:
+            self.resultados.append((time.perf_counter() - inicio, estado))
+
+    def ejecutar(self, tasa, duracion):
+        total = int(tasa * duracion)
+        inicio = time.perf_counter()
+        for i in range(total):
+            espera = inicio + i / tasa - time.perf_counter()
+            if espera > 0:
+                time.sleep(espera)
+            self.ejecutor.submit(self._enviar, self.siguiente_update())
+        self.ejecutor.shutdown(wait=True)
+        return time.perf_counter() - inicio
+
+class MuestreoConexiones(threading.Thread):
+    def __init__(self, pg_url, base, intervalo=0.5):
+        super().__init__(daemon=True)
+        self.pg_url = pg_url
+        self.base = base
+        self.intervalo = intervalo
+        self.muestras = []
+        self.parar = threading.Event()
+
+    def run(self):
+        conn = psycopg2.connect(self.pg_url)
+        conn.autocommit = True
+        c = conn.cursor()
+        while not self.parar.wait(self.intervalo):
+            c.execute("SELECT COUNT(*) FROM pg_stat_activity WHERE datname = %s", (self.base,))
+            self.muestras.append(c.fetchone()[0])
+        conn.close()
+
+def esperar_servidor(puerto, proceso, limite=60):
+    fin = time.time() + limite
+    while time.time() < fin:
+        if proceso.poll() is not None:
+            raise RuntimeError("gunicorn terminó durante el arranque")
+        try:
+            conexion = http.client.HTTPConnection("127.0.0.1", puerto, timeout=2)
+            conexion.request("GET", "/")
+            if conexion.getresponse().status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("gunicorn no respondió a tiempo")
+
+def esperar_drenaje(stub, limite=60, quietud=2.0):
+    # La API se sigue llamando después de responder al webhook: se espera a que deje de recibir llamadas
+    fin = time.time() + limite
+    ultimo, desde = -1, time.time()
+    while time.time() < fin:
+        total = stub.estado.resumen()["total"]
+        if total != ultimo:
+            ultimo, desde = total, time.time()
+        elif time.time() - desde >= quietud:
+            return desde
+        time.sleep(0.2)
+    return time.time()
+
+def ejecutar_nivel(args, stub, workers):
+    base = f"entreshijos_escalado_{os.getpid()}_{workers}"
+    crear_base(args.pg_url, base)
+    puerto = puerto_libre()
+    entorno = dict(os.environ, TOKEN=TOKEN_FALSO, GROUP_DESTINO=str(GRUPO_DESTINO),
+                   DATABASE_URL=url_con_base(args.pg_url, base),
+                   TELEGRAM_API_URL=f"http://127.0.0.1:{stub.server_port}/bot")
+    # Toda la carga va a un único grupo: con el límite real de 20 mensajes/min por grupo la prueba
+    # mediría la cola de salida y no el escalado, salvo que se exporte TG_GROUP_RATE explícitamente
+    entorno.setdefault("TG_GROUP_RATE", "60000")
+    registro = tempfile.NamedTemporaryFile(prefix=f"gunicorn-{workers}-", suffix=".log", delete=False)
+    proceso = subprocess.Popen([sys.executable, "-m", "gunicorn", "-w", str(workers), "--bind", f"127.0.0.1:{puerto}",
+                                "--timeout", "120", "main:app"], cwd=RAIZ, env=entorno, stdout=registro, stderr=registro)
+    muestreo = MuestreoConexiones(args.pg_url, base)
+    try:
+        esperar_servidor(puerto, proceso)
+        # Calentamiento: que cada worker de gunicorn inicialice sus servicios antes de medir
+        calentamiento = GeneradorCarga(puerto, workers * 2)
+        calentamiento.ejecutar(min(args.tasa, 50), 1)
+        esperar_drenaje(stub, limite=20, quietud=1.0)
+        stub.estado.reiniciar()
+        muestreo.start()
+        carga = GeneradorCarga(puerto, args.concurrencia)
+        inicio = time.time()
+        duracion = carga.ejecutar(args.tasa, args.duracion)
+        fin_api = esperar_drenaje(stub, limite=args.duracion * 3, quietud=args.quietud)
+    finally:
+        muestreo.parar.set()
+        proceso.send_signal(signal.SIGTERM)
+        try:
+            proceso.wait(timeout=60)
+        except subprocess.TimeoutExpired:
+            proceso.kill()
+        registro.close()
+        eliminar_base(args.pg_url, base)
+
+    latencias = [l for l, estado in carga.resultados if estado == 200]
+    api = stub.estado.resumen()
+    segundos_api = max(fin_api - inicio, 1e-9)
+    return {
+        "workers": workers,
+        "enviadas": len(carga.resultados),
+        "aceptadas": len(latencias),
+        "rechazadas_503": sum(1 for _, estado in carga.resultados if estado == 503),
+        "errores": sum(1 for _, estado in carga.resultados if estado not in (200, 503)),
+        "aceptadas_por_segundo": round(len(latencias) / duracion, 1),
+        "p50_ms": round(percentil(latencias, 50) * 1000, 2),
+        "p95_ms": round(percentil(latencias, 95) * 1000, 2),
+        "p99_ms": round(percentil(latencias, 99) * 1000, 2),
+        "llamadas_api": api["total"],
+        "llamadas_api_por_segundo": round(api["total"] / segundos_api, 1),
+        "api_429": api["limitadas_429"],
+        "drenaje_segundos": round(max(0.0, fin_api - inicio - duracion), 2),
+        "conexiones_db_max": max(muestreo.muestras, default=0),
+        "conexiones_db_media": round(sum(muestreo.muestras) / len(muestreo.muestras), 1) if muestreo.muestras else 0,
+        "registro_gunicorn": registro.name,
+    }
+
+def graficar(niveles, ruta):
+    try:
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print("matplotlib no está instalado: se omite la gráfica")
+        return
+    workers = [n["workers"] for n in niveles]
+    figura, (ax1, ax2, ax3) = plt.subplots(1, 3, figsize=(15, 4.5))
+    ax1.plot(workers, [n["aceptadas_por_segundo"] for n in niveles], marker="o", label="webhook aceptadas/s")
+    ax1.plot(workers, [n["llamadas_api_por_segundo"] for n in niveles], marker="o", label="llamadas API/s")
+    ax1.set_title("Throughput")
+    for clave in ("p50_ms", "p95_ms", "p99_ms"):
+        ax2.plot(workers, [n[clave] for n in niveles], marker="o", label=clave.replace("_ms", ""))
+    ax2.set_title("Latencia de /webhook (ms)")
+    ax3.plot(workers, [n["conexiones_db_max"] for n in niveles], marker="o", label="máximo")
+    ax3.plot(workers, [n["conexiones_db_media"] for n in niveles], marker="o", label="media")
+    ax3.set_title("Conexiones a PostgreSQL")
+    for ax in (ax1, ax2, ax3):
+        ax.set_xlabel("workers de gunicorn")
+        ax.set_xticks(workers)
+        ax.legend()
+        ax.grid(alpha=0.3)
+    figura.tight_layout()
+    figura.savefig(ruta, dpi=120)
+    print(f"Gráfica guardada en {ruta}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de escalado con gunicorn y stub de la Bot API")
+    parser.add_argument("--pg-url", default=os.getenv("BENCH_PG_URL"), help="URL de un servidor PostgreSQL donde crear las bases desechables")
+    parser.add_argument("--workers", default="1,2,4", help="Lista de números de workers de gunicorn")
+    parser.add_argument("--tasa", type=float, default=100, help="Actualizaciones por segundo a enviar")
+    parser.add_argument("--duracion", type=float, default=15, help="Segundos de carga por nivel")
+    parser.add_argument("--concurrencia", type=int, default=64, help="Peticiones HTTP simultáneas como máximo")
+    parser.add_argument("--latencia-ms", type=float, default=50, help="Latencia simulada de la Bot API")
+    parser.add_argument("--jitter-ms", type=float, default=20)
+    parser.add_argument("--tasa-429", type=float, default=0.0, help="Fracción de llamadas a la API que responden 429")
+    parser.add_argument("--quietud", type=float, default=3, help="Segundos sin llamadas a la API para dar la cola por vaciada")
+    parser.add_argument("--salida", help="Fichero JSON de resultados (por defecto bench/resultados/escalado-<fecha>.json)")
+    parser.add_argument("--grafica", help="Ruta del PNG con las gráficas (requiere matplotlib)")
+    args = parser.parse_args()
+    if not args.pg_url:
+        parser.error("indica --pg-url o BENCH_PG_URL")
+
+    stub = iniciar_stub(0, args.latencia_ms / 1000, args.jitter_ms / 1000, args.tasa_429)
+    resultados = {"fecha": datetime.now().isoformat(timespec="seconds"), "revision": revision_git(),
+                  "tasa": args.tasa, "duracion": args.duracion, "latencia_ms": args.latencia_ms,
+                  "tasa_429": args.tasa_429, "niveles": []}
+    print(f"{'workers':>8}{'acept/s':>10}{'503':>7}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'API/s':>9}{'drenaje s':>11}{'conn max':>10}")
+    for workers in [int(w) for w in args.workers.split(",")]:
+        nivel = ejecutar_nivel(args, stub, workers)
+        resultados["niveles"].append(nivel)
+        print(f"{workers:>8}{nivel['aceptadas_por_segundo']:>10}{nivel['rechazadas_503']:>7}{nivel['p50_ms']:>9}{nivel['p95_ms']:>9}"
+              f"{nivel['p99_ms']:>9}{nivel['llamadas_api_por_segundo']:>9}{nivel['drenaje_segundos']:>11}{nivel['conexiones_db_max']:>10}")
+    stub.shutdown()
+
+    salida = args.salida or os.path.join(DIRECTORIO, "resultados", f"escalado-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(salida), exist_ok=True)
+    with open(salida, "w", encoding="utf-8") as f:
+        json.dump(resultados, f, indent=2, ensure_ascii=False)
+    print(f"\nResultados guardados en {salida}")
+    if args.grafica:
+        graficar(resultados["niveles"], args.grafica)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+# Benchmark offline de los handlers: importa main.py con un Bot falso y una base de datos
+# PostgreSQL desechable, reproduce actualizaciones sintéticas a través de /webhook y mide
+# actualizaciones/s y latencias p50/p95/p99 por escenario.
+#
+# Uso:
+#   python bench/bench_handlers.py --pg-url postgresql://postgres@localhost/postgres
+#   python bench/bench_handlers.py --iteraciones 500 --comparar bench/resultados/anterior.json
+#
+# --pg-url apunta a un servidor donde se pueda crear bases de datos (por defecto BENCH_PG_URL);
+# se crea entreshijos_bench_<pid> y se elimina al terminar.
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime
+from urllib.parse import urlsplit, urlunsplit
+
+import psycopg2
+
+DIRECTORIO = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, DIRECTORIO)
+sys.path.insert(0, os.path.dirname(DIRECTORIO))
+
+from fake_telegram import FakeBot, GeneradorUpdates
+
+TOKEN_FALSO = "123456789:AAHdqTcvCH1vGWJxfSeofSAs0K5PALDsaw"
+GRUPO_DESTINO = -1001000000001
+ESCENARIOS = ["charla", "solicitud_valida", "limite_excedido", "casi_solicitud", "aprobacion_con_url"]
+
+def url_con_base(url, base):
+    partes = urlsplit(url)
+    return urlunsplit((partes.scheme, partes.netloc, f"/{base}", partes.query, partes.fragment))
+
+def crear_base(pg_url, nombre):
+    conn = psycopg2.connect(pg_url)
+    conn.autocommit = True
+    conn.cursor().execute(f"DROP DATABASE IF EXISTS {nombre}")
+    conn.cursor().execute(f"CREATE DATABASE {nombre}")
+    conn.close()
+
+def eliminar_base(pg_url, nombre):
+    conn = psycopg2.connect(pg_url)
+    conn.autocommit = True
+    try:
+        conn.cursor().execute(f"DROP DATABASE IF EXISTS {nombre} WITH (FORCE)")
+    except psycopg2.Error:  # PostgreSQL < 13 no admite FORCE
+        conn.cursor().execute("SELECT pg_terminate_backend(pid) FROM pg_stat_activity WHERE datname = %s AND pid <> pg_backend_pid()", (nombre,))
+        conn.cursor().execute(f"DROP DATABASE IF EXISTS {nombre}")
+    conn.close()
+
+def percentil(valores, p):
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    k = (len(ordenados) - 1) * p / 100
+    inferior = int(k)
+    superior = min(inferior + 1, len(ordenados) - 1)
+    return ordenados[inferior] + (ordenados[superior] - ordenados[inferior]) * (k - inferior)
+
+class Banco:
+    def __init__(self, main, bot):
+        self.main = main
+        self.bot = bot
+        self.cliente = main.app.test_client()
+        self.updates = GeneradorUpdates()
+        self.grupo = next(iter(main.CANALES_PETICIONES))
+        self.hilo = main.CANALES_PETICIONES[self.grupo]["thread_id"]
+        self.destino = int(main.GROUP_DESTINO)
+        self._usuarios = 0
+
+    def nuevo_usuario(self):
+        self._usuarios += 1
+        return 500000 + self._usuarios, f"bench{self._usuarios}"
+
+    def enviar(self, update, latencias):
+        inicio = time.perf_counter()
+        respuesta = self.cliente.post("/webhook", json=update)
+        latencias.append(time.perf_counter() - inicio)
+        if respuesta.status_code != 200:
+            raise RuntimeError(f"/webhook devolvió {respuesta.status_code}: {respuesta.data[:200]!r}")
+
+    def ticket_de(self, username):
+        with self.main.get_db_connection() as conn:
+            c = conn.cursor()
+            c.execute("SELECT MAX(ticket_number) FROM peticiones_registradas WHERE username = %s", (f"@{username}",))
+            return c.fetchone()[0]
+
+    # Cada escenario recibe la lista de latencias y envía una o varias actualizaciones
+    def charla(self, latencias):
+        user_id, username = self.nuevo_usuario()
+        self.enviar(self.updates.mensaje(self.grupo, user_id, "buenas tardes a todos, ¿qué tal?", self.hilo, username), latencias)
+
+    def solicitud_valida(self, latencias):
+        user_id, username = self.nuevo_usuario()
+        self.enviar(self.updates.mensaje(self.grupo, user_id, "/solicito Matrix (1999)", self.hilo, username), latencias)
+
+    def preparar_limite_excedido(self):
+        user_id, username = self.nuevo_usuario()
+        for _ in range(2):
+            self.enviar(self.updates.mensaje(self.grupo, user_id, "/solicito Relleno", self.hilo, username), [])
+        self._usuario_limite = (user_id, username)
+
+    def limite_excedido(self, latencias):
+        user_id, username = self._usuario_limite
+        self.enviar(self.updates.mensaje(self.grupo, user_id, "/solicito Otra más", self.hilo, username), latencias)
+
+    def casi_solicitud(self, latencias):
+        user_id, username = self.nuevo_usuario()
+        self.enviar(self.updates.mensaje(self.grupo, user_id, "solicito el último de Dune", self.hilo, username), latencias)
+
+    def aprobacion_con_url(self, latencias):
+        user_id, username = self.nuevo_usuario()
+        self.enviar(self.updates.mensaje(self.grupo, user_id, "/solicito Dune parte dos", self.hilo, username), latencias)
+        ticket = self.ticket_de(username)
+        admin = 900001
+        for data in [f"pend_{ticket}", f"pend_{ticket}_subido", f"pend_{ticket}_subido_confirm", f"pend_{ticket}_subido_url_yes"]:
+            self.enviar(self.updates.callback(self.destino, admin, data), latencias)
+        self.enviar(self.updates.mensaje(self.destino, admin, f"https://ejemplo.org/ticket/{ticket}", None, "admin", "Administración"), latencias)
+        self.enviar(self.updates.callback(self.destino, admin, f"pend_{ticket}_subido_url_confirm"), latencias)
+
+    def ejecutar(self, escenario, iteraciones, calentamiento):
+        preparar = getattr(self, f"preparar_{escenario}", None)
+        if preparar:
+            preparar()
+        paso = getattr(self, escenario)
+        for _ in range(calentamiento):
+            paso([])
+        self.bot.limpiar()
+        latencias = []
+        inicio = time.perf_counter()
+        for _ in range(iteraciones):
+            paso(latencias)
+        duracion = time.perf_counter() - inicio
+        llamadas = len(self.bot.limpiar())
+        return {
+            "updates": len(latencias),
+            "segundos": round(duracion, 4),
+            "updates_por_segundo": round(len(latencias) / duracion, 1) if duracion else 0.0,
+            "p50_ms": round(percentil(latencias, 50) * 1000, 3),
+            "p95_ms": round(percentil(latencias, 95) * 1000, 3),
+            "p99_ms": round(percentil(latencias, 99) * 1000, 3),
+            "llamadas_api_por_update": round(llamadas / len(latencias), 2) if latencias else 0.0,
+        }
+
+def revision_git():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=DIRECTORIO, text=True).strip()
+    except Exception:
+        return None
+
+def comparar(actual, anterior):
+    print(f"\nComparación con {anterior['revision']} ({anterior['fecha']}):")
+    print(f"{'escenario':<22}{'upd/s':>12}{'Δ':>9}{'p95 ms':>12}{'Δ':>9}")
+    for escenario, datos in actual["escenarios"].items():
+        previo = anterior["escenarios"].get(escenario)
+        if not previo:
+            continue
+        delta_ups = (datos["updates_por_segundo"] / previo["updates_por_segundo"] - 1) * 100 if previo["updates_por_segundo"] else 0
+        delta_p95 = (datos["p95_ms"] / previo["p95_ms"] - 1) * 100 if previo["p95_ms"] else 0
+        print(f"{escenario:<22}{datos['updates_por_segundo']:>12}{delta_ups:>+8.1f}%{datos['p95_ms']:>12}{delta_p95:>+8.1f}%")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark offline de los handlers del bot")
+    parser.add_argument("--pg-url", default=os.getenv("BENCH_PG_URL"), help="URL de un servidor PostgreSQL donde crear la base desechable")
+    parser.add_argument("--iteraciones", type=int, default=200)
+    parser.add_argument("--calentamiento", type=int, default=20)
+    parser.add_argument("--escenarios", default=",".join(ESCENARIOS))
+    parser.add_argument("--salida", help="Fichero JSON de resultados (por defecto bench/resultados/<fecha>.json)")
+    parser.add_argument("--comparar", help="Fichero JSON de una ejecución anterior")
+    args = parser.parse_args()
+    if not args.pg_url:
+        parser.error("indica --pg-url o BENCH_PG_URL")
+
+    nombre_base = f"entreshijos_bench_{os.getpid()}"
+    crear_base(args.pg_url, nombre_base)
+    # main.py lee la configuración al importarse: procesar dentro de la petición y sin cola de salida
+    os.environ.update({
+        "TOKEN": TOKEN_FALSO,
+        "GROUP_DESTINO": str(GRUPO_DESTINO),
+        "DATABASE_URL": url_con_base(args.pg_url, nombre_base),
+        "WEBHOOK_WORKERS": "0",
+        "OUTBOX_WORKERS": "0",
+    })
+    try:
+        import main as bot_main
+        logging.getLogger().setLevel(logging.WARNING)
+        bot = FakeBot(TOKEN_FALSO)
+        bot_main.bot = bot
+        bot_main.dispatcher.bot = bot
+        banco = Banco(bot_main, bot)
+
+        resultados = {
+            "fecha": datetime.now().isoformat(timespec="seconds"),
+            "revision": revision_git(),
+            "python": platform.python_version(),
+            "iteraciones": args.iteraciones,
+            "escenarios": {},
+        }
+        print(f"{'escenario':<22}{'updates':>9}{'upd/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'api/upd':>9}")
+        for escenario in args.escenarios.split(","):
+            datos = banco.ejecutar(escenario, args.iteraciones, args.calentamiento)
+            resultados["escenarios"][escenario] = datos
+            print(f"{escenario:<22}{datos['updates']:>9}{datos['updates_por_segundo']:>10}{datos['p50_ms']:>10}"
+                  f"{datos['p95_ms']:>10}{datos['p99_ms']:>10}{datos['llamadas_api_por_update']:>9}")
+    finally:
+        logging.disable(logging.CRITICAL)  # El hilo LISTEN de main.py pierde su conexión al borrar la base
+        eliminar_base(args.pg_url, nombre_base)
+
+    salida = args.salida or os.path.join(DIRECTORIO, "resultados", f"{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(salida), exist_ok=True)
+    with open(salida, "w", encoding="utf-8") as f:
+        json.dump(resultados, f, indent=2, ensure_ascii=False)
+    print(f"\nResultados guardados en {salida}")
+
+    if args.comparar:
+        with open(args.comparar, encoding="utf-8") as f:
+            comparar(resultados, json.load(f))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+# Micro-benchmark del índice de solicitudes duplicadas: carga IndiceSimilares con títulos sintéticos
+# (abiertas y aprobadas) y mide el coste por consulta de buscar() con aciertos, variantes de redacción y
+# títulos nuevos, junto con el parecido que obtiene cada pareja de ejemplo.
+#
+# Uso:
+#   python bench/bench_similares.py [--solicitudes 20000] [--repeticiones 2000]
+import argparse
+import os
+import random
+import sys
+import timeit
+
+DIRECTORIO = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(DIRECTORIO))
+
+# main.py exige estas variables al importarse; el índice vive en memoria y no usa ni la red ni la base de datos
+os.environ.setdefault("TOKEN", "123456789:AAHdqTcvCH1vGWJxfSeofSAs0K5PALDsaw")
+os.environ.setdefault("GROUP_DESTINO", "-1001000000001")
+os.environ.setdefault("DATABASE_URL", "postgresql://localhost/entreshijos_bench")
+
+import logging
+logging.disable(logging.CRITICAL)
+import main
+
+SILABAS = ["ma", "tri", "du", "ne", "ca", "sa", "pa", "pel", "ro", "sel", "to", "nes", "li", "bro", "ven", "tor",
+           "es", "pe", "jo", "som", "bra", "gue", "rra", "fue", "go", "hie", "lo", "vi", "a", "je", "mon", "ta"]
+ADORNOS = ["", " en castellano", " 4K", " latino", " con subtítulos", " porfa", " temporada {n}", " ({anio})"]
+PAREJAS = {
+    "misma petición": ("/solicito La casa de papel temporada 5", "/solicito la casa de papel temporada 5"),
+    "cortesía y tildes": ("/solicito Interstellar", "Hola! #petición interstellar por favor, gracias"),
+    "errata": ("/solicito Peaky Blinders temporada 6", "/solicito Peaky Blinder temporada 6"),
+    "otro orden": ("/solicito Juego de tronos temporada 8", "/solicito temporada 8 de juego de tronos"),
+    "otra temporada": ("/solicito Friends temporada 3", "/solicito Friends temporada 4"),
+    "otro título": ("/solicito Dune", "/solicito Matrix"),
+}
+
+def titulo_aleatorio(azar, palabras):
+    # Títulos de 1 a 4 palabras de un vocabulario de unas 3000: casi todos distintos, con algún duplicado
+    # casual y muchos trigramas compartidos entre títulos, como en los grupos reales
+    adorno = azar.choice(ADORNOS).format(n=azar.randint(1, 9), anio=azar.randint(1980, 2025))
+    return "/solicito " + " ".join(azar.sample(palabras, azar.randint(1, 4))) + adorno
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description="Micro-benchmark del índice de solicitudes duplicadas")
+    parser.add_argument("--solicitudes", type=int, default=20000)
+    parser.add_argument("--repeticiones", type=int, default=2000)
+    args = parser.parse_args()
+    azar = random.Random(7)
+    palabras = sorted({"".join(azar.choices(SILABAS, k=azar.randint(2, 4))) for _ in range(3000)})
+    ahora = main.datetime.now(main.SPAIN_TZ)
+    filas = [("pendiente" if i % 4 == 0 else "aprobada", i, titulo_aleatorio(azar, palabras), None if i % 4 == 0 else ahora)
+             for i in range(1, args.solicitudes + 1)]
+    indice = main.IndiceSimilares()
+    segundos = timeit.timeit(lambda: indice.cargar(filas), number=1)
+    print(f"Carga de {len(filas)} solicitudes: {segundos * 1000:.0f} ms")
+    consultas = {
+        "acierto exacto": filas[len(filas) // 2][2],
+        "variante de redacción": "Hola, #petición " + filas[len(filas) // 3][2].replace("/solicito", "").upper() + " por favor",
+        "título nuevo": "/solicito Una película que nadie ha pedido nunca",
+    }
+    print(f"{'consulta':<26}{'µs':>9}   resultado")
+    for nombre, texto in consultas.items():
+        coste = min(timeit.repeat(lambda: indice.buscar(texto), number=args.repeticiones, repeat=3)) / args.repeticiones
+        print(f"{nombre:<26}{coste * 1e6:>9.1f}   {indice.buscar(texto)}")
+    print(f"\n{'pareja':<20}{'parecido':>9}   ¿duplicado? (umbral {main.DUPLICADOS_UMBRAL})")
+    for nombre, (original, nueva) in PAREJAS.items():
+        pareja = main.IndiceSimilares()
+        pareja.cargar([("pendiente", 1, original, None)])
+        a, b = main.normalizar_titulo(original)[0], main.normalizar_titulo(nueva)[0]
+        print(f"{nombre:<20}{len(a & b) / len(a | b):>9.2f}   {'sí' if pareja.buscar(nueva) else 'no'}")
+
+if __name__ == "__main__":
+    main_benchmark()
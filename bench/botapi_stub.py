@@ -0,0 +1,136 @@
+# Stub local de la Bot API de Telegram para pruebas de carga de extremo a extremo.
+# Implementa los métodos que usa el bot con latencia y tasa de 429 configurables:
+#   python bench/botapi_stub.py --puerto 8081 --latencia-ms 80 --jitter-ms 40 --tasa-429 0.02
+# y se apunta el bot con TELEGRAM_API_URL=http://127.0.0.1:8081/bot
+# GET /stats devuelve las llamadas recibidas por método; POST /reset las pone a cero.
+import argparse
+import itertools
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+METODOS_CON_MENSAJE = {"sendMessage", "editMessageText", "sendPhoto", "sendDocument", "sendVideo"}
+METODOS_BOOLEANOS = {"deleteMessage", "answerCallbackQuery", "setWebhook", "deleteWebhook"}
+
+class EstadoStub:
+    def __init__(self, latencia, jitter, tasa_429, retry_after):
+        self.latencia = latencia
+        self.jitter = jitter
+        self.tasa_429 = tasa_429
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.reiniciar()
+
+    def reiniciar(self):
+        with self.lock:
+            self.inicio = time.time()
+            self.llamadas = {}
+            self.limitadas = 0
+
+    def registrar(self, metodo, limitada):
+        with self.lock:
+            self.llamadas[metodo] = self.llamadas.get(metodo, 0) + 1
+            if limitada:
+                self.limitadas += 1
+            return next(self.ids)
+
+    def resumen(self):
+        with self.lock:
+            return {"segundos": round(time.time() - self.inicio, 3), "llamadas": dict(self.llamadas),
+                    "total": sum(self.llamadas.values()), "limitadas_429": self.limitadas}
+
+def crear_handler(estado):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _responder(self, codigo, cuerpo):
+            datos = json.dumps(cuerpo).encode()
+            self.send_response(codigo)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(datos)))
+            self.end_headers()
+            self.wfile.write(datos)
+
+        def _leer_parametros(self):
+            longitud = int(self.headers.get("Content-Length") or 0)
+            crudo = self.rfile.read(longitud) if longitud else b""
+            tipo = self.headers.get("Content-Type", "")
+            if "json" in tipo:
+                return json.loads(crudo or b"{}")
+            if "multipart" in tipo:
+                return {}  # Envíos de ficheros: basta con contestar, no se interpreta el contenido
+            return {k: v[0] for k, v in parse_qs(crudo.decode()).items()}
+
+        def do_GET(self):
+            if self.path == "/stats":
+                self._responder(200, estado.resumen())
+            else:
+                self._responder(404, {"ok": False, "error_code": 404, "description": "Not Found"})
+
+        def do_POST(self):
+            if self.path == "/reset":
+                self._leer_parametros()
+                estado.reiniciar()
+                self._responder(200, {"ok": True})
+                return
+            metodo = self.path.rsplit("/", 1)[-1]
+            parametros = self._leer_parametros()
+            espera = estado.latencia + random.uniform(0, estado.jitter)
+            if espera:
+                time.sleep(espera)
+            limitada = random.random() < estado.tasa_429
+            message_id = estado.registrar(metodo, limitada)
+            if limitada:
+                self._responder(429, {"ok": False, "error_code": 429,
+                                      "description": f"Too Many Requests: retry after {estado.retry_after}",
+                                      "parameters": {"retry_after": estado.retry_after}})
+                return
+            if metodo in METODOS_CON_MENSAJE:
+                chat_id = int(parametros.get("chat_id") or 0)
+                resultado = {"message_id": message_id, "date": int(time.time()),
+                             "chat": {"id": chat_id, "type": "supergroup"},
+                             "text": parametros.get("text", parametros.get("caption", ""))}
+            elif metodo in METODOS_BOOLEANOS:
+                resultado = True
+            elif metodo == "getMe":
+                resultado = {"id": 1, "is_bot": True, "first_name": "Stub", "username": "stub_bot"}
+            else:
+                self._responder(404, {"ok": False, "error_code": 404, "description": f"Not Found: método {metodo} no implementado"})
+                return
+            self._responder(200, {"ok": True, "result": resultado})
+
+    return Handler
+
+def iniciar_stub(puerto=0, latencia=0.0, jitter=0.0, tasa_429=0.0, retry_after=1):
+    estado = EstadoStub(latencia, jitter, tasa_429, retry_after)
+    servidor = ThreadingHTTPServer(("127.0.0.1", puerto), crear_handler(estado))
+    servidor.daemon_threads = True
+    servidor.estado = estado
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub local de la Bot API de Telegram")
+    parser.add_argument("--puerto", type=int, default=8081)
+    parser.add_argument("--latencia-ms", type=float, default=50)
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--tasa-429", type=float, default=0.0, help="Fracción de llamadas que responden 429 (0-1)")
+    parser.add_argument("--retry-after", type=int, default=1)
+    args = parser.parse_args()
+    servidor = iniciar_stub(args.puerto, args.latencia_ms / 1000, args.jitter_ms / 1000, args.tasa_429, args.retry_after)
+    print(f"Stub de la Bot API en http://127.0.0.1:{servidor.server_port}/bot (Ctrl+C para salir)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        servidor.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+# Bot de Telegram falso y generador de actualizaciones sintéticas para los benchmarks.
+# FakeBot hereda de telegram.Bot y solo sustituye _post, así que toda la serialización de
+# python-telegram-bot se ejecuta igual que en producción pero sin salir a la red.
+import itertools
+import threading
+import time
+
+import telegram
+
+METODOS_CON_MENSAJE = {"sendMessage", "sendPhoto", "sendDocument", "sendVideo", "editMessageText"}
+
+class FakeBot(telegram.Bot):
+    def __init__(self, token, latencia=0.0):
+        super().__init__(token)
+        self.latencia = latencia
+        self.llamadas = []
+        self._ids = itertools.count(1000)
+        self._lock = threading.Lock()
+
+    def _post(self, endpoint, data=None, timeout=None, api_kwargs=None):
+        datos = dict(data or {})
+        datos.update(api_kwargs or {})
+        with self._lock:
+            self.llamadas.append((endpoint, datos))
+            message_id = next(self._ids)
+        if self.latencia:
+            time.sleep(self.latencia)
+        if endpoint in METODOS_CON_MENSAJE:
+            return {"message_id": message_id, "date": int(time.time()),
+                    "chat": {"id": int(datos.get("chat_id", 0)), "type": "supergroup"},
+                    "text": datos.get("text", datos.get("caption", ""))}
+        if endpoint == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        return True
+
+    def limpiar(self):
+        with self._lock:
+            llamadas, self.llamadas = self.llamadas, []
+        return llamadas
+
+class GeneradorUpdates:
+    def __init__(self):
+        self._ids = itertools.count(1)
+
+    def mensaje(self, chat_id, user_id, texto, thread_id=None, username="usuario", titulo="Grupo"):
+        mensaje = {"message_id": next(self._ids), "date": int(time.time()),
+                   "chat": {"id": chat_id, "type": "supergroup", "title": titulo},
+                   "from": {"id": user_id, "is_bot": False, "first_name": "Usuario", "username": username},
+                   "text": texto}
+        if thread_id is not None:
+            mensaje["message_thread_id"] = thread_id
+            mensaje["is_topic_message"] = True
+        return {"update_id": next(self._ids), "message": mensaje}
+
+    def callback(self, chat_id, user_id, data, message_id=1, username="admin"):
+        return {"update_id": next(self._ids),
+                "callback_query": {"id": str(next(self._ids)), "chat_instance": "bench", "data": data,
+                                   "from": {"id": user_id, "is_bot": False, "first_name": "Admin", "username": username},
+                                   "message": {"message_id": message_id, "date": int(time.time()),
+                                               "chat": {"id": chat_id, "type": "supergroup", "title": "Administración"},
+                                               "text": "menú"}}}
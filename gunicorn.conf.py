@@ -0,0 +1,14 @@
+# Configuración de gunicorn: se carga sola desde el directorio de trabajo (Procfile: gunicorn main:app)
+import subprocess
+import sys
+
+def on_starting(server):
+    # Migraciones una sola vez, en el maestro y antes de aceptar tráfico. Van en un proceso aparte para que
+    # el maestro no importe main: los workers no heredan sus conexiones ni sus hilos
+    subprocess.run([sys.executable, "-c", "import main; main.init_db()"], check=True)
+
+def post_fork(server, worker):
+    # Cada worker arranca sus hilos (avisos, menús, tareas programadas, ingesta del webhook) al nacer,
+    # sin esperar a la primera actualización de Telegram
+    import main
+    main.iniciar_servicios()
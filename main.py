@@ -1,21 +1,53 @@
-from flask import Flask, request
+from flask import Flask, request, jsonify
 import telegram
 from telegram.ext import Dispatcher, MessageHandler, CommandHandler, Filters, CallbackQueryHandler
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.utils.request import Request
 from datetime import datetime, timedelta
 import pytz
 import os
 import random
+import secrets
+import shlex
+import re
+import string
+import unicodedata
 import logging
+import select
 import psycopg2
-from psycopg2.extras import DictCursor
+import psycopg2.errors
+import psycopg2.pool
+from psycopg2.extras import DictCursor, Json
+from contextlib import contextmanager
 import threading
 import time
+import queue
+import atexit
+import signal
+import socket
+import sys
+from collections import deque, OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+import heapq
+import gzip
+import hashlib
+import io
+import json
+import itertools
+from functools import lru_cache
+
+# matplotlib es opcional: sin él, el menú de gráficas envía solo el resumen en texto
+try:
+    from matplotlib.figure import Figure
+    from matplotlib.ticker import MaxNLocator
+except ImportError:
+    Figure = None
 
 # Configura las variables de entorno (sin valores hardcoded)
 TOKEN = os.getenv('TOKEN')
 GROUP_DESTINO = os.getenv('GROUP_DESTINO')
 DATABASE_URL = os.getenv('DATABASE_URL')
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')  # Base alternativa de la Bot API, p. ej. http://127.0.0.1:8081/bot (servidor propio o stub)
 
 # Validación estricta de variables de entorno
 if not TOKEN:
@@ -25,12 +57,95 @@ if not GROUP_DESTINO:
 if not DATABASE_URL:
     raise ValueError("DATABASE_URL no está configurada en las variables de entorno.")
 
+# Parámetros del pool de conexiones a PostgreSQL
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', 10))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 5))  # Segundos de espera máxima por una conexión libre
+DB_CONNECT_TIMEOUT = int(os.getenv('DB_CONNECT_TIMEOUT', 10))
+DB_MAX_LIFETIME = float(os.getenv('DB_MAX_LIFETIME', 1800))  # Segundos antes de reciclar una conexión
+DB_MAX_IDLE = float(os.getenv('DB_MAX_IDLE', 300))  # Segundos inactiva antes de cerrar conexiones por encima del mínimo
+DB_HEALTHCHECK_IDLE = float(os.getenv('DB_HEALTHCHECK_IDLE', 30))  # Verificar con SELECT 1 si lleva más de N segundos inactiva
+
+# Tickets reservados por proceso en cada viaje a la base de datos (1 = sin reserva por bloques)
+TICKET_BLOCK_SIZE = max(1, int(os.getenv('TICKET_BLOCK_SIZE', 1)))
+
+# Cuota diaria de solicitudes: QUOTA_RESET=medianoche (se reinicia a las 00:00 de Madrid) o ventana
+# (24 h desde la primera solicitud). LIMITES_POR_GRUPO admite "chat_id:límite,chat_id:límite"
+QUOTA_RESET = os.getenv('QUOTA_RESET', 'medianoche')
+LIMITE_DIARIO = int(os.getenv('LIMITE_DIARIO', 2))
+LIMITES_POR_GRUPO = {int(chat): int(limite) for chat, limite in
+                     (par.split(':') for par in os.getenv('LIMITES_POR_GRUPO', '').split(',') if par.strip())}
+if QUOTA_RESET not in ('medianoche', 'ventana'):
+    raise ValueError("QUOTA_RESET debe ser 'medianoche' o 'ventana'.")
+
+# Caducidad de los menús de administración (se borran pasado MENU_TIMEOUT) y espera máxima del
+# planificador entre barridos, que acota el retraso con menús registrados por otros procesos
+MENU_TIMEOUT = int(os.getenv('MENU_TIMEOUT', 3600))
+MENU_SWEEP_MAX = float(os.getenv('MENU_SWEEP_MAX', 300))
+
+# Segundos que un worker sirve desde caché una clave del estado compartido (las escrituras la invalidan por NOTIFY)
+ESTADO_CACHE_TTL = float(os.getenv('ESTADO_CACHE_TTL', 30))
+
+# Segundos entre intentos de un proceso no líder de hacerse con la ejecución de las tareas programadas
+JOBS_LEADER_RETRY = float(os.getenv('JOBS_LEADER_RETRY', 30))
+
+# Retención de datos (limpieza por lotes): días que se conservan las peticiones incorrectas y el historial
+# por estado con "estado:días,estado:días" (un estado sin entrada, o con 0 días, se conserva para siempre)
+RETENCION_INCORRECTAS_DIAS = int(os.getenv('RETENCION_INCORRECTAS_DIAS', 30))
+RETENCION_HISTORIAL = {estado.strip(): int(dias) for estado, dias in
+                       (par.rsplit(':', 1) for par in os.getenv('RETENCION_HISTORIAL', 'eliminado:180,limite_excedido:90').split(',') if par.strip())
+                       if int(dias) > 0}
+RETENCION_LOTE = max(1, int(os.getenv('RETENCION_LOTE', 1000)))  # Filas por transacción
+RETENCION_PAUSA = float(os.getenv('RETENCION_PAUSA', 0.2))  # Segundos de pausa entre lotes
+RETENCION_LOCK_TIMEOUT = os.getenv('RETENCION_LOCK_TIMEOUT', '2s')  # Espera máxima por un bloqueo antes de ceder el lote
+RETENCION_MAX_SEGUNDOS = float(os.getenv('RETENCION_MAX_SEGUNDOS', 600))  # Tope por ejecución; lo pendiente queda para la siguiente
+
+# Historial particionado por mes (fecha_gestion): los meses con más de HISTORIAL_ARCHIVO_MESES de antigüedad
+# se vuelcan a ficheros JSONL comprimidos en HISTORIAL_ARCHIVO_DIR y se eliminan de PostgreSQL (0 = no archivar).
+# Todos los workers deben ver el mismo directorio para poder paginar lo archivado
+HISTORIAL_ARCHIVO_DIR = os.getenv('HISTORIAL_ARCHIVO_DIR', 'archivo_historial')
+HISTORIAL_ARCHIVO_MESES = int(os.getenv('HISTORIAL_ARCHIVO_MESES', 6))
+HISTORIAL_PARTICIONES_ADELANTE = int(os.getenv('HISTORIAL_PARTICIONES_ADELANTE', 2))  # Meses futuros con partición creada
+HISTORIAL_ARCHIVO_CACHE = int(os.getenv('HISTORIAL_ARCHIVO_CACHE', 4))  # Ficheros archivados que cada proceso guarda en memoria
+
+# Gráficas del menú: días representados, días recientes que recalcula cada pasada del resumen diario y
+# segundos que se conserva el file_id de la última imagen subida
+GRAFICAS_DIAS = int(os.getenv('GRAFICAS_DIAS', 30))
+GRAFICAS_RECALCULO_DIAS = int(os.getenv('GRAFICAS_RECALCULO_DIAS', 2))
+GRAFICAS_CACHE_TTL = int(os.getenv('GRAFICAS_CACHE_TTL', 7 * 86400))
+
+# Búsqueda de tickets: resultados máximos por consulta y umbral de parecido por trigramas (tolerancia a erratas)
+BUSQUEDA_MAX_RESULTADOS = int(os.getenv('BUSQUEDA_MAX_RESULTADOS', 100))
+BUSQUEDA_SIMILITUD = float(os.getenv('BUSQUEDA_SIMILITUD', 0.4))
+BUSQUEDA_CANDIDATOS = int(os.getenv('BUSQUEDA_CANDIDATOS', 2000))  # Coincidencias más recientes que se puntúan por tabla
+
+# Posibles duplicados al registrar: parecido mínimo (Jaccard de trigramas) y días que una aprobada sigue contando
+DUPLICADOS_UMBRAL = float(os.getenv('DUPLICADOS_UMBRAL', 0.6))
+DUPLICADOS_APROBADAS_DIAS = int(os.getenv('DUPLICADOS_APROBADAS_DIAS', 30))
+
+# Segundos máximos que un worker puede servir el estado de los grupos desde caché sin releerlo
+GRUPOS_CACHE_TTL = float(os.getenv('GRUPOS_CACHE_TTL', 60))
+
+# Ingesta del webhook: con WEBHOOK_WORKERS > 0 las actualizaciones se encolan y se responde 200 de inmediato
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', 4))  # 0 = procesar dentro de la petición HTTP
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', 1000))
+WEBHOOK_RETRY_AFTER = int(os.getenv('WEBHOOK_RETRY_AFTER', 5))  # Segundos sugeridos a Telegram cuando la cola está llena
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv('WEBHOOK_DRAIN_TIMEOUT', 25))  # Segundos para vaciar la cola al apagar
+
+# Cola de salida hacia la API de Telegram (límites: 30 msg/s global, 20 msg/min por grupo, ~1 msg/s por chat privado)
+OUTBOX_WORKERS = int(os.getenv('OUTBOX_WORKERS', 4))  # 0 = llamadas síncronas sin cola ni reintentos
+TG_GLOBAL_RATE = float(os.getenv('TG_GLOBAL_RATE', 30))  # Mensajes por segundo en total
+TG_GROUP_RATE = float(os.getenv('TG_GROUP_RATE', 20))  # Mensajes por minuto a un mismo grupo
+TG_PRIVATE_RATE = float(os.getenv('TG_PRIVATE_RATE', 1))  # Mensajes por segundo a un mismo chat privado
+TG_MAX_RETRIES = int(os.getenv('TG_MAX_RETRIES', 5))
+TG_RESULT_TIMEOUT = float(os.getenv('TG_RESULT_TIMEOUT', 60))  # Espera máxima de safe_bot_method por su resultado
+
 # Configura el logging
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 # Inicializa el bot y Flask
-bot = telegram.Bot(token=TOKEN)
+bot = telegram.Bot(token=TOKEN, base_url=TELEGRAM_API_URL, request=Request(con_pool_size=WEBHOOK_WORKERS + OUTBOX_WORKERS + 4))
 app = Flask(__name__)
 
 # Configura el Dispatcher
@@ -38,108 +153,955 @@ dispatcher = Dispatcher(bot, None, workers=0)
 SPAIN_TZ = pytz.timezone('Europe/Madrid')
 
 # Variables globales
-grupos_seleccionados = {}
-menu_activos = {}
-pending_urls = {}  # Almacena URLs temporales para solicitudes
 
-# Función para manejar métodos del bot de forma segura
-def safe_bot_method(method, *args, **kwargs):
+# Métricas en formato de exposición de Prometheus (por proceso; bajo gunicorn cada worker expone las suyas)
+BUCKETS_LATENCIA = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BUCKETS_CONTEO = (0, 1, 2, 3, 4, 6, 8, 12, 16, 24)
+
+class Metricas:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._definiciones = {}  # nombre -> (tipo, ayuda, buckets)
+        self._valores = {}  # (nombre, etiquetas) -> valor o [cuentas por bucket, suma, total]
+
+    def definir(self, nombre, tipo, ayuda, buckets=None):
+        self._definiciones[nombre] = (tipo, ayuda, buckets)
+
+    def incrementar(self, nombre, valor=1, **etiquetas):
+        clave = (nombre, tuple(sorted(etiquetas.items())))
+        with self._lock:
+            self._valores[clave] = self._valores.get(clave, 0) + valor
+
+    def observar(self, nombre, valor, **etiquetas):
+        buckets = self._definiciones[nombre][2]
+        clave = (nombre, tuple(sorted(etiquetas.items())))
+        with self._lock:
+            serie = self._valores.get(clave)
+            if serie is None:
+                serie = self._valores[clave] = [[0] * len(buckets), 0.0, 0]
+            for i, limite in enumerate(buckets):
+                if valor <= limite:
+                    serie[0][i] += 1
+            serie[1] += valor
+            serie[2] += 1
+
+    @staticmethod
+    def _etiquetas(pares):
+        if not pares:
+            return ""
+        return "{" + ",".join(f'{k}="{str(v)}"' for k, v in pares) + "}"
+
+    def exponer(self, indicadores=None):
+        lineas = []
+        with self._lock:
+            valores = sorted(self._valores.items(), key=lambda x: x[0])
+        for nombre, (tipo, ayuda, buckets) in sorted(self._definiciones.items()):
+            lineas.append(f"# HELP {nombre} {ayuda}")
+            lineas.append(f"# TYPE {nombre} {tipo}")
+            for (serie_nombre, pares), valor in valores:
+                if serie_nombre != nombre:
+                    continue
+                if tipo == "histogram":
+                    for limite, cuenta in zip(buckets, valor[0]):
+                        lineas.append(f"{nombre}_bucket{self._etiquetas(pares + (('le', limite),))} {cuenta}")
+                    lineas.append(f"{nombre}_bucket{self._etiquetas(pares + (('le', '+Inf'),))} {valor[2]}")
+                    lineas.append(f"{nombre}_sum{self._etiquetas(pares)} {valor[1]}")
+                    lineas.append(f"{nombre}_count{self._etiquetas(pares)} {valor[2]}")
+                else:
+                    lineas.append(f"{nombre}{self._etiquetas(pares)} {valor}")
+        for nombre, ayuda, valor in indicadores or []:
+            lineas.append(f"# HELP {nombre} {ayuda}")
+            lineas.append(f"# TYPE {nombre} gauge")
+            lineas.append(f"{nombre} {valor}")
+        return "\n".join(lineas) + "\n"
+
+metricas = Metricas()
+metricas.definir("bot_handler_seconds", "histogram", "Duración de cada handler o familia de callbacks", BUCKETS_LATENCIA)
+metricas.definir("bot_db_query_seconds", "histogram", "Duración de cada consulta SQL por función que la ejecuta", BUCKETS_LATENCIA)
+metricas.definir("bot_db_errors_total", "counter", "Consultas SQL fallidas por función")
+metricas.definir("bot_telegram_api_seconds", "histogram", "Duración de cada llamada a la API de Telegram por método", BUCKETS_LATENCIA)
+metricas.definir("bot_telegram_api_errors_total", "counter", "Llamadas a la API de Telegram fallidas por método y error")
+metricas.definir("bot_update_db_queries", "histogram", "Consultas SQL ejecutadas al procesar una actualización", BUCKETS_CONTEO)
+metricas.definir("bot_update_api_calls", "histogram", "Llamadas a la API de Telegram generadas por una actualización", BUCKETS_CONTEO)
+metricas.definir("bot_graficas_total", "counter", "Gráficas enviadas, reutilizando el file_id (cache) o dibujadas y subidas")
+metricas.definir("bot_duplicados_total", "counter", "Solicitudes marcadas como posible duplicado por origen del ticket parecido")
+
+# Contadores de la actualización en curso en este hilo (consultas y llamadas a la API)
+_contexto_update = threading.local()
+
+def _contar_en_update(clave):
+    if getattr(_contexto_update, "activo", False):
+        setattr(_contexto_update, clave, getattr(_contexto_update, clave, 0) + 1)
+
+# Cursor que mide cada consulta; la etiqueta es la función que llama a execute (get_peticion_registrada...)
+class CursorMedido(DictCursor):
+    def execute(self, query, vars=None):
+        consulta = sys._getframe(1).f_code.co_name
+        _contar_en_update("db")
+        inicio = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        except Exception:
+            metricas.incrementar("bot_db_errors_total", consulta=consulta)
+            raise
+        finally:
+            metricas.observar("bot_db_query_seconds", time.perf_counter() - inicio, consulta=consulta)
+
+def llamar_api(method, *args, **kwargs):
+    nombre = getattr(method, "__name__", "desconocido")
+    inicio = time.perf_counter()
     try:
         return method(*args, **kwargs)
-    except telegram.error.Unauthorized:
-        logger.warning(f"Bot no autorizado para realizar la acción en {kwargs.get('chat_id', 'desconocido')}")
-        return None
-    except telegram.error.TelegramError as e:
-        logger.error(f"Error de Telegram: {str(e)}")
-        return None
-
-# Inicialización de la base de datos PostgreSQL
-def init_db():
-    conn = None
-    try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute('''CREATE TABLE IF NOT EXISTS peticiones_por_usuario 
-                     (user_id BIGINT PRIMARY KEY, count INTEGER, chat_id BIGINT, username TEXT, last_reset TIMESTAMP WITH TIME ZONE)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS peticiones_registradas 
-                     (ticket_number BIGINT PRIMARY KEY, chat_id BIGINT, username TEXT, message_text TEXT, 
-                      message_id BIGINT, timestamp TIMESTAMP WITH TIME ZONE, chat_title TEXT, thread_id BIGINT, has_attachment BOOLEAN DEFAULT FALSE)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS historial_solicitudes 
-                     (ticket_number BIGINT PRIMARY KEY, chat_id BIGINT, username TEXT, message_text TEXT, 
-                      chat_title TEXT, estado TEXT, fecha_gestion TIMESTAMP WITH TIME ZONE, admin_username TEXT, url TEXT)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS grupos_estados 
-                     (chat_id BIGINT PRIMARY KEY, title TEXT, activo BOOLEAN DEFAULT TRUE)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS peticiones_incorrectas 
-                     (id SERIAL PRIMARY KEY, user_id BIGINT, timestamp TIMESTAMP WITH TIME ZONE, chat_id BIGINT)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS usuarios 
-                     (user_id BIGINT PRIMARY KEY, username TEXT)''')
-        conn.commit()
-        logger.info("Base de datos inicializada correctamente.")
     except Exception as e:
-        logger.error(f"Error al inicializar la base de datos: {str(e)}")
+        metricas.incrementar("bot_telegram_api_errors_total", metodo=nombre, error=type(e).__name__)
         raise
     finally:
-        if conn:
+        metricas.observar("bot_telegram_api_seconds", time.perf_counter() - inicio, metodo=nombre)
+
+# Cubo de fichas para limitar la tasa de envíos (no es seguro entre hilos: se usa bajo el lock de la bandeja)
+class TokenBucket:
+    def __init__(self, tasa, capacidad):
+        self.tasa = tasa
+        self.capacidad = capacidad
+        self.fichas = capacidad
+        self.ultimo = time.monotonic()
+
+    def _rellenar(self, ahora):
+        self.fichas = min(self.capacidad, self.fichas + (ahora - self.ultimo) * self.tasa)
+        self.ultimo = ahora
+
+    def espera(self, ahora):
+        self._rellenar(ahora)
+        return 0.0 if self.fichas >= 1 else (1 - self.fichas) / self.tasa
+
+    def consumir(self, ahora):
+        self._rellenar(ahora)
+        self.fichas -= 1
+
+    def lleno(self, ahora):
+        return self.fichas + (ahora - self.ultimo) * self.tasa >= self.capacidad
+
+def _chat_de_llamada(method, kwargs):
+    if 'chat_id' in kwargs:
+        return int(kwargs['chat_id'])
+    destino = getattr(method, '__self__', None)  # query.message.delete, query.edit_message_text...
+    if isinstance(destino, telegram.Message):
+        return destino.chat_id
+    if isinstance(destino, telegram.CallbackQuery) and destino.message:
+        return destino.message.chat_id
+    return None
+
+def _es_transitorio(error):
+    return isinstance(error, telegram.error.TimedOut) or \
+        (isinstance(error, telegram.error.NetworkError) and not isinstance(error, telegram.error.BadRequest))
+
+# Bandeja de salida: una cola FIFO por chat (como mucho una llamada en vuelo por chat, así se conserva
+# el orden), cubos de fichas global y por chat, respeto de RetryAfter y reintentos con jitter ante
+# errores de red. Los chats listos esperan en un montículo ordenado por el instante en que pueden enviar.
+class BandejaSalida:
+    def __init__(self, workers):
+        self.pid = os.getpid()
+        self._cond = threading.Condition()
+        self._colas = {}
+        self._programados = set()
+        self._monticulo = []
+        self._seq = itertools.count()
+        self._global = TokenBucket(TG_GLOBAL_RATE, TG_GLOBAL_RATE)
+        self._buckets = OrderedDict()  # chat -> cubo, del usado hace más tiempo al más reciente
+        self._pausa_global = 0.0
+        self._en_vuelo = 0
+        self.stats = {"enviadas": 0, "reintentos": 0, "retry_after": 0, "fallidas": 0, "canceladas": 0}
+        for i in range(workers):
+            threading.Thread(target=self._worker, name=f"outbox-{i}", daemon=True).start()
+
+    def _bucket(self, chat, ahora):
+        if chat in self._buckets:
+            self._buckets.move_to_end(chat)
+            return self._buckets[chat]
+        # Un cubo lleno equivale a uno nuevo: se descartan los de chats inactivos para que el diccionario
+        # no crezca con cada chat privado que haya escrito alguna vez
+        while self._buckets and next(iter(self._buckets.values())).lleno(ahora):
+            self._buckets.popitem(last=False)
+        if chat is not None and chat < 0:
+            self._buckets[chat] = TokenBucket(TG_GROUP_RATE / 60.0, TG_GROUP_RATE)
+        else:
+            self._buckets[chat] = TokenBucket(TG_PRIVATE_RATE, 3)
+        return self._buckets[chat]
+
+    def _programar(self, chat, instante):
+        heapq.heappush(self._monticulo, (instante, next(self._seq), chat))
+        self._programados.add(chat)
+        self._cond.notify()
+
+    def enviar(self, method, *args, **kwargs):
+        futuro = Future()
+        chat = _chat_de_llamada(method, kwargs)
+        with self._cond:
+            self._colas.setdefault(chat, deque()).append([futuro, method, args, kwargs, 0])
+            if chat not in self._programados:
+                self._programar(chat, time.monotonic())
+        return futuro
+
+    def _siguiente(self):
+        with self._cond:
+            while True:
+                if not self._monticulo:
+                    self._cond.wait()
+                    continue
+                instante, _, chat = self._monticulo[0]
+                ahora = time.monotonic()
+                if instante > ahora:
+                    self._cond.wait(instante - ahora)
+                    continue
+                if not self._colas[chat]:  # Su única llamada se canceló mientras esperaba turno
+                    heapq.heappop(self._monticulo)
+                    del self._colas[chat]
+                    self._programados.discard(chat)
+                    self._cond.notify_all()
+                    continue
+                item = self._colas[chat][0]
+                limitado = item[1].__name__.startswith("send")
+                espera = max(self._global.espera(ahora), self._pausa_global - ahora,
+                             self._bucket(chat, ahora).espera(ahora) if limitado else 0.0)
+                if espera > 0:
+                    heapq.heapreplace(self._monticulo, (ahora + espera, next(self._seq), chat))
+                    continue
+                heapq.heappop(self._monticulo)
+                self._global.consumir(ahora)
+                if limitado:
+                    self._bucket(chat, ahora).consumir(ahora)
+                self._colas[chat].popleft()
+                self._en_vuelo += 1
+                return chat, item
+
+    def _worker(self):
+        while True:
+            chat, item = self._siguiente()
+            futuro, method, args, kwargs, intentos = item
+            reintentar_en = None
+            try:
+                resultado = llamar_api(method, *args, **kwargs)
+                if not futuro.cancelled():  # cancelar() solo retira llamadas en cola, pero set_result fallaría
+                    futuro.set_result(resultado)
+                self._contar("enviadas")
+            except telegram.error.RetryAfter as e:
+                self._contar("retry_after")
+                logger.warning(f"Control de flujo de Telegram en {chat}: reintento en {e.retry_after}s")
+                reintentar_en = float(e.retry_after)
+                if chat is None:
+                    with self._cond:
+                        self._pausa_global = time.monotonic() + reintentar_en
+            except Exception as e:
+                if _es_transitorio(e) and intentos < TG_MAX_RETRIES:
+                    self._contar("reintentos")
+                    reintentar_en = min(30.0, 0.5 * 2 ** intentos) * random.uniform(0.5, 1.5)
+                    logger.warning(f"Error transitorio de Telegram en {chat} ({str(e)}), reintento en {reintentar_en:.1f}s")
+                else:
+                    self._contar("fallidas")
+                    if not futuro.cancelled():
+                        futuro.set_exception(e)
+            with self._cond:
+                self._en_vuelo -= 1
+                ahora = time.monotonic()
+                if reintentar_en is not None:
+                    item[4] = intentos + 1
+                    self._colas[chat].appendleft(item)
+                    self._programar(chat, ahora + reintentar_en)
+                elif self._colas[chat]:
+                    self._programar(chat, ahora)
+                else:
+                    del self._colas[chat]
+                    self._programados.discard(chat)
+                self._cond.notify_all()
+
+    def cancelar(self, futuro):
+        # Retira una llamada que sigue en cola (también si espera un reintento); False si ya está en vuelo
+        with self._cond:
+            for cola in self._colas.values():
+                for item in cola:
+                    if item[0] is futuro:
+                        cola.remove(item)
+                        futuro.cancel()
+                        self.stats["canceladas"] += 1
+                        return True
+        return False
+
+    def _contar(self, clave):
+        with self._cond:
+            self.stats[clave] += 1
+
+    def pendientes(self):
+        with self._cond:
+            return sum(len(cola) for cola in self._colas.values()) + self._en_vuelo
+
+    def drenar(self, timeout):
+        limite = time.monotonic() + timeout
+        with self._cond:
+            while (self._colas or self._en_vuelo) and time.monotonic() < limite:
+                self._cond.wait(max(0.05, limite - time.monotonic()))
+
+    def estadisticas(self):
+        with self._cond:
+            stats = dict(self.stats)
+            stats["en_cola"] = sum(len(cola) for cola in self._colas.values())
+            stats["en_vuelo"] = self._en_vuelo
+            stats["chats"] = len(self._colas)
+            stats["cubos"] = len(self._buckets)
+        return stats
+
+_bandeja = None
+_bandeja_lock = threading.Lock()
+
+def obtener_bandeja():
+    global _bandeja
+    if _bandeja is not None and _bandeja.pid == os.getpid():
+        return _bandeja
+    with _bandeja_lock:
+        if _bandeja is None or _bandeja.pid != os.getpid():
+            _bandeja = BandejaSalida(OUTBOX_WORKERS)
+            atexit.register(drenar_bandeja)
+        return _bandeja
+
+def drenar_bandeja():
+    if _bandeja is not None and _bandeja.pid == os.getpid():
+        _bandeja.drenar(WEBHOOK_DRAIN_TIMEOUT)
+
+def _registrar_error_telegram(futuro, chat_id):
+    if futuro.cancelled():
+        return
+    error = futuro.exception()
+    if isinstance(error, telegram.error.Unauthorized):
+        logger.warning(f"Bot no autorizado para realizar la acción en {chat_id}")
+    elif isinstance(error, telegram.error.TelegramError):
+        logger.error(f"Error de Telegram: {str(error)}")
+    elif error is not None:
+        logger.error(f"Error al llamar a la API de Telegram: {str(error)}")
+
+# Envío sin esperar: devuelve un Future con el resultado; los errores se registran en el log
+def safe_bot_method_async(method, *args, **kwargs):
+    _contar_en_update("api")
+    if OUTBOX_WORKERS <= 0:
+        futuro = Future()
+        try:
+            futuro.set_result(llamar_api(method, *args, **kwargs))
+        except Exception as e:
+            futuro.set_exception(e)
+    else:
+        futuro = obtener_bandeja().enviar(method, *args, **kwargs)
+    futuro.add_done_callback(lambda f: _registrar_error_telegram(f, kwargs.get('chat_id', 'desconocido')))
+    return futuro
+
+# Función para manejar métodos del bot de forma segura (espera el resultado; None si falla).
+# None garantiza que el mensaje no se ha enviado ni se enviará: si vence la espera con la llamada aún en
+# la cola se cancela; si ya está en vuelo se espera a que termine, porque el llamante actúa sobre el None
+def safe_bot_method(method, *args, **kwargs):
+    futuro = safe_bot_method_async(method, *args, **kwargs)
+    while True:
+        try:
+            return futuro.result(timeout=TG_RESULT_TIMEOUT)
+        except FutureTimeoutError:
+            if obtener_bandeja().cancelar(futuro):
+                logger.error(f"Sin respuesta de Telegram tras {TG_RESULT_TIMEOUT}s en {kwargs.get('chat_id', 'desconocido')}: envío cancelado")
+                return None
+        except Exception:
+            return None  # Ya registrado por _registrar_error_telegram
+
+# Pool de conexiones PostgreSQL (seguro entre hilos y consciente de fork para gunicorn)
+class PoolConexiones:
+    def __init__(self, dsn, minconn, maxconn, timeout, connect_timeout, max_lifetime, max_idle, healthcheck_idle):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = max(maxconn, minconn, 1)
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.max_lifetime = max_lifetime
+        self.max_idle = max_idle
+        self.healthcheck_idle = healthcheck_idle
+        self.pid = os.getpid()
+        self._cond = threading.Condition()
+        self._libres = []  # Pila de (conexión, último uso): la más reciente se reutiliza primero
+        self._creadas = {}  # conexión -> instante de creación
+        self._total = 0
+        self._en_uso = 0
+        self._esperando = 0
+        self._stats = {"checkouts": 0, "timeouts": 0, "recicladas": 0, "fallos_salud": 0,
+                       "espera_total": 0.0, "espera_max": 0.0}
+
+    def _conectar(self):
+        conn = psycopg2.connect(self.dsn, cursor_factory=CursorMedido, connect_timeout=self.connect_timeout)
+        with self._cond:
+            self._creadas[conn] = time.monotonic()
+        return conn
+
+    def _cerrar(self, conn):
+        try:
             conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._creadas.pop(conn, None)
+            self._total -= 1
+            self._cond.notify()
+
+    def _caducada(self, conn):
+        creada = self._creadas.get(conn)
+        return creada is None or time.monotonic() - creada >= self.max_lifetime
+
+    def _sana(self, conn, ultimo_uso):
+        if conn.closed:
+            return False
+        if self._caducada(conn):
+            with self._cond:
+                self._stats["recicladas"] += 1
+            return False
+        if time.monotonic() - ultimo_uso >= self.healthcheck_idle:
+            try:
+                with conn.cursor() as c:
+                    c.execute("SELECT 1")
+                conn.rollback()
+            except psycopg2.Error:
+                with self._cond:
+                    self._stats["fallos_salud"] += 1
+                return False
+        return True
+
+    def precargar(self):
+        while True:
+            with self._cond:
+                if self._total >= self.minconn:
+                    return
+                self._total += 1
+            try:
+                conn = self._conectar()
+            except Exception:
+                with self._cond:
+                    self._total -= 1
+                raise
+            with self._cond:
+                self._libres.append((conn, time.monotonic()))
+                self._cond.notify()
+
+    def getconn(self):
+        inicio = time.monotonic()
+        while True:
+            conn = None
+            with self._cond:
+                while not self._libres and self._total >= self.maxconn:
+                    restante = inicio + self.timeout - time.monotonic()
+                    if restante <= 0:
+                        self._stats["timeouts"] += 1
+                        raise psycopg2.pool.PoolError(f"No hay conexiones libres tras esperar {self.timeout}s")
+                    self._esperando += 1
+                    try:
+                        self._cond.wait(restante)
+                    finally:
+                        self._esperando -= 1
+                if self._libres:
+                    conn, ultimo_uso = self._libres.pop()
+                else:
+                    self._total += 1
+            if conn is None:
+                try:
+                    conn = self._conectar()
+                except Exception:
+                    with self._cond:
+                        self._total -= 1
+                        self._cond.notify()
+                    raise
+            elif not self._sana(conn, ultimo_uso):
+                self._cerrar(conn)
+                continue
+            espera = time.monotonic() - inicio
+            with self._cond:
+                self._en_uso += 1
+                self._stats["checkouts"] += 1
+                self._stats["espera_total"] += espera
+                self._stats["espera_max"] = max(self._stats["espera_max"], espera)
+            return conn
+
+    def putconn(self, conn, cerrar=False):
+        with self._cond:
+            self._en_uso -= 1
+        if cerrar or conn.closed or self._caducada(conn):
+            self._cerrar(conn)
+            return
+        if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                self._cerrar(conn)
+                return
+        ahora = time.monotonic()
+        sobrantes = []
+        with self._cond:
+            self._libres.append((conn, ahora))
+            # Cierra las conexiones inactivas más antiguas que sobran por encima del mínimo
+            while self._total - len(sobrantes) > self.minconn and len(self._libres) > 1 and ahora - self._libres[0][1] >= self.max_idle:
+                sobrantes.append(self._libres.pop(0)[0])
+            self._cond.notify()
+        for vieja in sobrantes:
+            self._cerrar(vieja)
+
+    def estadisticas(self):
+        with self._cond:
+            checkouts = self._stats["checkouts"]
+            return {
+                "minimo": self.minconn,
+                "maximo": self.maxconn,
+                "abiertas": self._total,
+                "en_uso": self._en_uso,
+                "libres": len(self._libres),
+                "esperando": self._esperando,
+                "checkouts": checkouts,
+                "timeouts": self._stats["timeouts"],
+                "recicladas": self._stats["recicladas"],
+                "fallos_salud": self._stats["fallos_salud"],
+                "espera_media_ms": round(self._stats["espera_total"] * 1000 / checkouts, 3) if checkouts else 0.0,
+                "espera_max_ms": round(self._stats["espera_max"] * 1000, 3),
+            }
+
+_pool = None
+_pool_lock = threading.Lock()
+_pools_heredados = []  # Pools del proceso padre: se conservan para que el GC no cierre sockets compartidos tras un fork
+
+def obtener_pool():
+    global _pool
+    pool = _pool
+    if pool is not None and pool.pid == os.getpid():
+        return pool
+    with _pool_lock:
+        if _pool is None or _pool.pid != os.getpid():
+            if _pool is not None:
+                _pools_heredados.append(_pool)
+            _pool = PoolConexiones(DATABASE_URL, DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_CONNECT_TIMEOUT,
+                                   DB_MAX_LIFETIME, DB_MAX_IDLE, DB_HEALTHCHECK_IDLE)
+            try:
+                _pool.precargar()
+            except psycopg2.OperationalError as e:
+                logger.error(f"Error al precargar el pool de conexiones: {str(e)}")
+            logger.info(f"Pool de conexiones creado (pid {_pool.pid}, min {_pool.minconn}, max {_pool.maxconn})")
+        return _pool
 
+@contextmanager
 def get_db_connection():
+    pool = obtener_pool()
     try:
-        return psycopg2.connect(DATABASE_URL, cursor_factory=DictCursor, connect_timeout=10)
+        conn = pool.getconn()
     except psycopg2.OperationalError as e:
         logger.error(f"Error al conectar a la base de datos: {str(e)}")
         raise
-
-# Funciones de utilidad para la base de datos
-def get_ticket_counter():
+    except psycopg2.pool.PoolError as e:
+        logger.error(f"Pool de conexiones agotado: {str(e)}")
+        raise
+    roto = False
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            roto = True
+        raise
+    finally:
+        pool.putconn(conn, cerrar=roto)
+
+def get_pool_stats():
+    return obtener_pool().estadisticas()
+
+# Migraciones del esquema, aplicadas en orden al arrancar: (versión, descripción, sentencias, concurrente).
+# Las concurrentes se ejecutan fuera de transacción para no bloquear la tabla durante un despliegue en caliente.
+MIGRACIONES = [
+    (1, "Tablas base", [
+        '''CREATE TABLE IF NOT EXISTS peticiones_por_usuario 
+           (user_id BIGINT PRIMARY KEY, count INTEGER, chat_id BIGINT, username TEXT, last_reset TIMESTAMP WITH TIME ZONE)''',
+        '''CREATE TABLE IF NOT EXISTS peticiones_registradas 
+           (ticket_number BIGINT PRIMARY KEY, chat_id BIGINT, username TEXT, message_text TEXT, 
+            message_id BIGINT, timestamp TIMESTAMP WITH TIME ZONE, chat_title TEXT, thread_id BIGINT, has_attachment BOOLEAN DEFAULT FALSE)''',
+        '''CREATE TABLE IF NOT EXISTS historial_solicitudes 
+           (ticket_number BIGINT PRIMARY KEY, chat_id BIGINT, username TEXT, message_text TEXT, 
+            chat_title TEXT, estado TEXT, fecha_gestion TIMESTAMP WITH TIME ZONE, admin_username TEXT, url TEXT)''',
+        '''CREATE TABLE IF NOT EXISTS grupos_estados 
+           (chat_id BIGINT PRIMARY KEY, title TEXT, activo BOOLEAN DEFAULT TRUE)''',
+        '''CREATE TABLE IF NOT EXISTS peticiones_incorrectas 
+           (id SERIAL PRIMARY KEY, user_id BIGINT, timestamp TIMESTAMP WITH TIME ZONE, chat_id BIGINT)''',
+        '''CREATE TABLE IF NOT EXISTS usuarios 
+           (user_id BIGINT PRIMARY KEY, username TEXT)''',
+    ], False),
+    (2, "Secuencia de tickets", [
+        "CREATE SEQUENCE IF NOT EXISTS ticket_seq",
+        # Sitúa la secuencia por encima del mayor ticket existente (solo avanza, nunca retrocede)
+        '''SELECT setval('ticket_seq', m.maximo)
+           FROM (SELECT GREATEST((SELECT COALESCE(MAX(ticket_number), 0) FROM peticiones_registradas),
+                                 (SELECT COALESCE(MAX(ticket_number), 0) FROM historial_solicitudes)) AS maximo) m,
+                ticket_seq s
+           WHERE m.maximo > CASE WHEN s.is_called THEN s.last_value ELSE s.last_value - 1 END''',
+    ], False),
+    (3, "Índice de usuarios por username (get_user_id_by_username)", [
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_usuarios_username ON usuarios (username)",
+    ], True),
+    (4, "Índice de peticiones incorrectas por usuario y fecha (get_peticiones_incorrectas)", [
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_incorrectas_user_ts ON peticiones_incorrectas (user_id, timestamp)",
+    ], True),
+    (5, "Índice de peticiones incorrectas por fecha (clean_database)", [
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_incorrectas_ts ON peticiones_incorrectas (timestamp)",
+    ], True),
+    (6, "Índice del historial por estado (clean_database y recuento por estado)", [
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_historial_estado ON historial_solicitudes (estado)",
+    ], True),
+    (7, "Menús de administración activos con su caducidad, compartidos entre procesos", [
+        '''CREATE TABLE IF NOT EXISTS menus_activos 
+           (chat_id BIGINT, message_id BIGINT, expira_en TIMESTAMP WITH TIME ZONE NOT NULL, PRIMARY KEY (chat_id, message_id))''',
+        "CREATE INDEX IF NOT EXISTS idx_menus_expira ON menus_activos (expira_en)",
+    ], False),
+    (8, "Estado de conversación compartido entre workers (UNLOGGED: se puede perder en una caída)", [
+        '''CREATE UNLOGGED TABLE IF NOT EXISTS estado_compartido 
+           (clave TEXT PRIMARY KEY, valor JSONB NOT NULL, version BIGINT NOT NULL DEFAULT 1, expira_en TIMESTAMP WITH TIME ZONE)''',
+        "CREATE INDEX IF NOT EXISTS idx_estado_expira ON estado_compartido (expira_en)",
+    ], False),
+    (9, "Registro de ejecuciones de las tareas programadas", [
+        '''CREATE TABLE IF NOT EXISTS jobs_ejecuciones 
+           (nombre TEXT PRIMARY KEY, ultima_ejecucion TIMESTAMP WITH TIME ZONE, duracion DOUBLE PRECISION, resultado TEXT, 
+            detalle TEXT, ejecutado_por TEXT, ejecuciones BIGINT DEFAULT 0, errores BIGINT DEFAULT 0)''',
+    ], False),
+    (10, "Índice del historial por estado y fecha de gestión (retención por lotes)", [
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_historial_estado_fecha ON historial_solicitudes (estado, fecha_gestion)",
+    ], True),
+    # Una tabla particionada no admite una clave única que no incluya fecha_gestion: la unicidad del ticket
+    # la garantiza set_historial_solicitud. Los registros sin fecha_gestion reciben la de la migración.
+    # Se ejecuta en una sola transacción: el historial queda bloqueado (ni lectura ni escritura) mientras se
+    # copian todas las filas, y las peticiones que lo usen esperan a que termine; con historiales grandes
+    # conviene desplegar en una ventana de mantenimiento. idx_historial_estado (migración 6) desaparece con
+    # la tabla antigua y no se recrea: idx_historial_estado_fecha cubre las mismas consultas por estado
+    (11, "Historial particionado por mes de gestión y registro de meses archivados", [
+        "ALTER TABLE historial_solicitudes RENAME TO historial_solicitudes_previo",
+        '''CREATE TABLE historial_solicitudes 
+           (ticket_number BIGINT NOT NULL, chat_id BIGINT, username TEXT, message_text TEXT, chat_title TEXT, estado TEXT, 
+            fecha_gestion TIMESTAMP WITH TIME ZONE NOT NULL, admin_username TEXT, url TEXT) PARTITION BY RANGE (fecha_gestion)''',
+        "CREATE TABLE historial_solicitudes_default PARTITION OF historial_solicitudes DEFAULT",
+        '''DO $$
+           DECLARE mes DATE;
+           BEGIN
+               FOR mes IN SELECT date_trunc('month', fecha_gestion AT TIME ZONE 'Europe/Madrid')::date FROM historial_solicitudes_previo
+                          WHERE fecha_gestion IS NOT NULL
+                          UNION SELECT date_trunc('month', now() AT TIME ZONE 'Europe/Madrid')::date LOOP
+                   EXECUTE format('CREATE TABLE %I PARTITION OF historial_solicitudes FOR VALUES FROM (%L) TO (%L)',
+                                  'historial_solicitudes_' || to_char(mes, 'YYYY_MM'),
+                                  mes::timestamp AT TIME ZONE 'Europe/Madrid',
+                                  (mes + interval '1 month')::timestamp AT TIME ZONE 'Europe/Madrid');
+               END LOOP;
+           END $$''',
+        '''INSERT INTO historial_solicitudes 
+           SELECT ticket_number, chat_id, username, message_text, chat_title, estado, COALESCE(fecha_gestion, now()), admin_username, url 
+           FROM historial_solicitudes_previo''',
+        "DROP TABLE historial_solicitudes_previo",
+        "CREATE INDEX IF NOT EXISTS idx_historial_ticket ON historial_solicitudes (ticket_number)",
+        "CREATE INDEX IF NOT EXISTS idx_historial_estado_fecha ON historial_solicitudes (estado, fecha_gestion)",
+        '''CREATE TABLE IF NOT EXISTS historial_archivo 
+           (mes DATE PRIMARY KEY, fichero TEXT NOT NULL, filas BIGINT NOT NULL, ticket_min BIGINT, ticket_max BIGINT, 
+            por_estado JSONB NOT NULL DEFAULT '{}', archivado_en TIMESTAMP WITH TIME ZONE DEFAULT now())''',
+        "CREATE INDEX IF NOT EXISTS idx_archivo_tickets ON historial_archivo (ticket_max, ticket_min)",
+    ], False),
+    # Contadores por (estado, grupo, día) que mantienen los triggers en la misma transacción que cada cambio.
+    # El estado es el del historial, "pendiente" (peticiones_registradas) o "usuario" (usuarios registrados).
+    # Los traslados internos de filas (particiones, archivo) activan entreshijos.omitir_estadisticas
+    (12, "Estadísticas mantenidas por triggers", [
+        "LOCK TABLE historial_solicitudes, peticiones_registradas, usuarios IN SHARE ROW EXCLUSIVE MODE",
+        '''CREATE TABLE IF NOT EXISTS estadisticas 
+           (estado TEXT NOT NULL, chat_id BIGINT NOT NULL DEFAULT 0, dia DATE NOT NULL, cantidad BIGINT NOT NULL DEFAULT 0, 
+            PRIMARY KEY (estado, chat_id, dia))''',
+        '''CREATE OR REPLACE FUNCTION sumar_estadistica(p_estado TEXT, p_chat BIGINT, p_fecha TIMESTAMPTZ, p_delta BIGINT) 
+           RETURNS void LANGUAGE sql AS $$
+               INSERT INTO estadisticas (estado, chat_id, dia, cantidad) 
+               VALUES (COALESCE(p_estado, 'desconocido'), COALESCE(p_chat, 0), 
+                       (COALESCE(p_fecha, now()) AT TIME ZONE 'Europe/Madrid')::date, p_delta)
+               ON CONFLICT (estado, chat_id, dia) DO UPDATE SET cantidad = estadisticas.cantidad + EXCLUDED.cantidad
+           $$''',
+        '''CREATE OR REPLACE FUNCTION estadisticas_historial() RETURNS trigger LANGUAGE plpgsql AS $$
+           BEGIN
+               IF current_setting('entreshijos.omitir_estadisticas', true) = 'on' THEN
+                   RETURN NULL;
+               END IF;
+               IF TG_OP = 'UPDATE' AND OLD.estado IS NOT DISTINCT FROM NEW.estado AND OLD.chat_id IS NOT DISTINCT FROM NEW.chat_id
+                  AND OLD.fecha_gestion = NEW.fecha_gestion THEN
+                   RETURN NULL;
+               END IF;
+               IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                   PERFORM sumar_estadistica(OLD.estado, OLD.chat_id, OLD.fecha_gestion, -1);
+               END IF;
+               IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                   PERFORM sumar_estadistica(NEW.estado, NEW.chat_id, NEW.fecha_gestion, 1);
+               END IF;
+               RETURN NULL;
+           END $$''',
+        '''CREATE OR REPLACE FUNCTION estadisticas_pendientes() RETURNS trigger LANGUAGE plpgsql AS $$
+           BEGIN
+               IF TG_OP = 'UPDATE' AND OLD.chat_id IS NOT DISTINCT FROM NEW.chat_id AND OLD.timestamp IS NOT DISTINCT FROM NEW.timestamp THEN
+                   RETURN NULL;
+               END IF;
+               IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                   PERFORM sumar_estadistica('pendiente', OLD.chat_id, OLD.timestamp, -1);
+               END IF;
+               IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                   PERFORM sumar_estadistica('pendiente', NEW.chat_id, NEW.timestamp, 1);
+               END IF;
+               RETURN NULL;
+           END $$''',
+        '''CREATE OR REPLACE FUNCTION estadisticas_usuarios() RETURNS trigger LANGUAGE plpgsql AS $$
+           BEGIN
+               PERFORM sumar_estadistica('usuario', 0, now(), CASE WHEN TG_OP = 'INSERT' THEN 1 ELSE -1 END);
+               RETURN NULL;
+           END $$''',
+        '''INSERT INTO estadisticas (estado, chat_id, dia, cantidad) 
+           SELECT COALESCE(estado, 'desconocido'), COALESCE(chat_id, 0), (fecha_gestion AT TIME ZONE 'Europe/Madrid')::date, COUNT(*) 
+           FROM historial_solicitudes GROUP BY 1, 2, 3''',
+        # Lo ya archivado solo tiene desglose por estado: se imputa al grupo 0 y al primer día de su mes
+        '''INSERT INTO estadisticas (estado, chat_id, dia, cantidad) 
+           SELECT e.key, 0, a.mes, e.value::BIGINT FROM historial_archivo a, jsonb_each_text(a.por_estado) e 
+           ON CONFLICT (estado, chat_id, dia) DO UPDATE SET cantidad = estadisticas.cantidad + EXCLUDED.cantidad''',
+        '''INSERT INTO estadisticas (estado, chat_id, dia, cantidad) 
+           SELECT 'pendiente', COALESCE(chat_id, 0), (COALESCE(timestamp, now()) AT TIME ZONE 'Europe/Madrid')::date, COUNT(*) 
+           FROM peticiones_registradas GROUP BY 2, 3''',
+        '''INSERT INTO estadisticas (estado, chat_id, dia, cantidad) 
+           SELECT 'usuario', 0, (now() AT TIME ZONE 'Europe/Madrid')::date, COUNT(*) FROM usuarios HAVING COUNT(*) > 0''',
+        '''CREATE TRIGGER trg_estadisticas_historial AFTER INSERT OR UPDATE OR DELETE ON historial_solicitudes 
+           FOR EACH ROW EXECUTE FUNCTION estadisticas_historial()''',
+        '''CREATE TRIGGER trg_estadisticas_pendientes AFTER INSERT OR UPDATE OR DELETE ON peticiones_registradas 
+           FOR EACH ROW EXECUTE FUNCTION estadisticas_pendientes()''',
+        '''CREATE TRIGGER trg_estadisticas_usuarios AFTER INSERT OR DELETE ON usuarios 
+           FOR EACH ROW EXECUTE FUNCTION estadisticas_usuarios()''',
+    ], False),
+    # "recibida" cuenta las solicitudes por día de entrada y no se descuenta al gestionarlas; resumen_diario
+    # guarda los agregados de las gráficas que no caben en estadisticas (por admin y por tiempo de resolución)
+    (13, "Fecha de solicitud en el historial y agregados diarios para las gráficas", [
+        "ALTER TABLE historial_solicitudes ADD COLUMN IF NOT EXISTS fecha_solicitud TIMESTAMP WITH TIME ZONE",
+        '''UPDATE historial_solicitudes h SET fecha_solicitud = p.timestamp FROM peticiones_registradas p 
+           WHERE p.ticket_number = h.ticket_number AND h.fecha_solicitud IS NULL''',
+        '''CREATE OR REPLACE FUNCTION estadisticas_pendientes() RETURNS trigger LANGUAGE plpgsql AS $$
+           BEGIN
+               IF TG_OP = 'INSERT' THEN
+                   PERFORM sumar_estadistica('recibida', NEW.chat_id, NEW.timestamp, 1);
+               END IF;
+               IF TG_OP = 'UPDATE' AND OLD.chat_id IS NOT DISTINCT FROM NEW.chat_id AND OLD.timestamp IS NOT DISTINCT FROM NEW.timestamp THEN
+                   RETURN NULL;
+               END IF;
+               IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                   PERFORM sumar_estadistica('pendiente', OLD.chat_id, OLD.timestamp, -1);
+               END IF;
+               IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                   PERFORM sumar_estadistica('pendiente', NEW.chat_id, NEW.timestamp, 1);
+               END IF;
+               RETURN NULL;
+           END $$''',
+        '''INSERT INTO estadisticas (estado, chat_id, dia, cantidad) 
+           SELECT 'recibida', COALESCE(chat_id, 0), (COALESCE(timestamp, now()) AT TIME ZONE 'Europe/Madrid')::date, COUNT(*) 
+           FROM peticiones_registradas GROUP BY 2, 3 
+           ON CONFLICT (estado, chat_id, dia) DO UPDATE SET cantidad = estadisticas.cantidad + EXCLUDED.cantidad''',
+        '''CREATE TABLE IF NOT EXISTS resumen_diario 
+           (dimension TEXT NOT NULL, dia DATE NOT NULL, clave TEXT NOT NULL, cantidad BIGINT NOT NULL, PRIMARY KEY (dimension, dia, clave))''',
+    ], False),
+    # Índices de búsqueda: texto completo en español sobre message_text y, si el servidor ofrece pg_trgm,
+    # trigramas sobre el texto y el usuario (erratas e ILIKE '%...%'). Sin permiso o sin la extensión, la
+    # búsqueda funciona igual pero sin tolerancia a erratas. Sobre la tabla particionada no cabe CONCURRENTLY
+    (14, "Índices de búsqueda por texto completo y trigramas", [
+        '''CREATE INDEX IF NOT EXISTS idx_historial_texto_fts ON historial_solicitudes 
+           USING gin (to_tsvector('spanish', COALESCE(message_text, '')))''',
+        '''CREATE INDEX IF NOT EXISTS idx_peticiones_texto_fts ON peticiones_registradas 
+           USING gin (to_tsvector('spanish', COALESCE(message_text, '')))''',
+        '''DO $$
+           BEGIN
+               IF EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm') THEN
+                   BEGIN
+                       CREATE EXTENSION IF NOT EXISTS pg_trgm;
+                   EXCEPTION WHEN insufficient_privilege THEN
+                       RAISE NOTICE 'Sin permiso para crear pg_trgm: búsqueda sin tolerancia a erratas';
+                   END;
+               END IF;
+               IF EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm') THEN
+                   CREATE INDEX IF NOT EXISTS idx_historial_texto_trgm ON historial_solicitudes USING gin (message_text gin_trgm_ops);
+                   CREATE INDEX IF NOT EXISTS idx_historial_usuario_trgm ON historial_solicitudes USING gin (username gin_trgm_ops);
+                   CREATE INDEX IF NOT EXISTS idx_peticiones_texto_trgm ON peticiones_registradas USING gin (message_text gin_trgm_ops);
+                   CREATE INDEX IF NOT EXISTS idx_peticiones_usuario_trgm ON peticiones_registradas USING gin (username gin_trgm_ops);
+               END IF;
+           END $$''',
+    ], False),
+    # Cada alta, baja o aprobación se publica en el canal "similares" para que todos los procesos mantengan
+    # su índice de duplicados sin releer las tablas. El texto va recortado: NOTIFY no admite más de 8000 bytes
+    (15, "Avisos para el índice en memoria de solicitudes duplicadas", [
+        '''CREATE OR REPLACE FUNCTION notificar_similares() RETURNS trigger LANGUAGE plpgsql AS $$
+           BEGIN
+               IF current_setting('entreshijos.omitir_estadisticas', true) = 'on' THEN
+                   RETURN NULL;
+               END IF;
+               IF TG_OP = 'DELETE' THEN
+                   PERFORM pg_notify('similares', json_build_object('op', 'quitar', 'origen', TG_ARGV[0], 'ticket', OLD.ticket_number)::TEXT);
+               ELSIF TG_ARGV[0] = 'pendiente' THEN
+                   PERFORM pg_notify('similares', json_build_object('op', 'agregar', 'origen', TG_ARGV[0], 'ticket', NEW.ticket_number, 
+                                                                    'texto', left(NEW.message_text, 300))::TEXT);
+               ELSIF NEW.estado = 'subido' THEN
+                   PERFORM pg_notify('similares', json_build_object('op', 'agregar', 'origen', TG_ARGV[0], 'ticket', NEW.ticket_number, 
+                                                                    'texto', left(NEW.message_text, 300), 'fecha', NEW.fecha_gestion)::TEXT);
+               ELSIF TG_OP = 'UPDATE' AND OLD.estado = 'subido' THEN
+                   PERFORM pg_notify('similares', json_build_object('op', 'quitar', 'origen', TG_ARGV[0], 'ticket', NEW.ticket_number)::TEXT);
+               END IF;
+               RETURN NULL;
+           END $$''',
+        '''CREATE TRIGGER trg_similares_pendientes AFTER INSERT OR UPDATE OF message_text OR DELETE ON peticiones_registradas 
+           FOR EACH ROW EXECUTE FUNCTION notificar_similares('pendiente')''',
+        '''CREATE TRIGGER trg_similares_historial AFTER INSERT OR UPDATE OR DELETE ON historial_solicitudes 
+           FOR EACH ROW EXECUTE FUNCTION notificar_similares('aprobada')''',
+    ], False),
+    (16, "Ejecuciones manuales pedidas al proceso líder de las tareas programadas", [
+        "ALTER TABLE jobs_ejecuciones ADD COLUMN IF NOT EXISTS solicitada_en TIMESTAMP WITH TIME ZONE",
+    ], False),
+]
+MIGRACIONES_LOCK_ID = 72430001  # Clave del advisory lock que serializa las migraciones entre procesos
+HISTORIAL_LOCK_ID = 72430003  # Primera clave del advisory lock (clave, ticket) de las escrituras en el historial
+JOBS_LOCK_ID = 72430002  # Clave del advisory lock que elige al proceso que ejecuta las tareas programadas
+
+def version_esquema(c):
+    c.execute("SELECT to_regclass('schema_version') IS NOT NULL")
+    if not c.fetchone()[0]:
+        return 0
+    c.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    return c.fetchone()[0]
+
+def aplicar_migraciones():
     with get_db_connection() as conn:
+        conn.autocommit = True
         c = conn.cursor()
-        c.execute("SELECT COALESCE(MAX(ticket_number), 0) FROM peticiones_registradas")
-        max_registradas = c.fetchone()[0]
-        c.execute("SELECT COALESCE(MAX(ticket_number), 0) FROM historial_solicitudes")
-        max_historial = c.fetchone()[0]
-        return max(max_registradas, max_historial)
-
-def increment_ticket_counter():
-    return get_ticket_counter() + 1
+        # Espera activa con pg_try_advisory_lock: un proceso bloqueado en pg_advisory_lock mantiene abierta
+        # su transacción y CREATE INDEX CONCURRENTLY del proceso que migra esperaría por ella (interbloqueo)
+        while True:
+            c.execute("SELECT pg_try_advisory_lock(%s)", (MIGRACIONES_LOCK_ID,))
+            if c.fetchone()[0]:
+                break
+            time.sleep(0.5)
+        try:
+            c.execute('''CREATE TABLE IF NOT EXISTS schema_version 
+                         (version INTEGER PRIMARY KEY, descripcion TEXT, aplicada TIMESTAMP WITH TIME ZONE DEFAULT now())''')
+            c.execute("SELECT version FROM schema_version")
+            aplicadas = {row[0] for row in c.fetchall()}
+            for version, descripcion, sentencias, concurrente in MIGRACIONES:
+                if version in aplicadas:
+                    continue
+                logger.info(f"Aplicando migración {version}: {descripcion}")
+                if concurrente:
+                    for sentencia in sentencias:
+                        # Un CREATE INDEX CONCURRENTLY interrumpido deja un índice inválido que IF NOT EXISTS daría por bueno
+                        nombre = sentencia.split("IF NOT EXISTS")[1].split()[0]
+                        c.execute("""SELECT 1 FROM pg_index i JOIN pg_class r ON r.oid = i.indexrelid 
+                                     WHERE r.relname = %s AND NOT i.indisvalid""", (nombre,))
+                        if c.fetchone():
+                            c.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {nombre}")
+                        c.execute(sentencia)
+                    c.execute("INSERT INTO schema_version (version, descripcion) VALUES (%s, %s)", (version, descripcion))
+                else:
+                    conn.autocommit = False
+                    for sentencia in sentencias:
+                        c.execute(sentencia)
+                    c.execute("INSERT INTO schema_version (version, descripcion) VALUES (%s, %s)", (version, descripcion))
+                    conn.commit()
+                    conn.autocommit = True
+        finally:
+            if not conn.closed:
+                conn.rollback()
+                conn.autocommit = True
+                c.execute("SELECT pg_advisory_unlock(%s)", (MIGRACIONES_LOCK_ID,))
+                conn.autocommit = False
 
-def get_peticiones_por_usuario(user_id):
+# Inicialización de la base de datos PostgreSQL
+def init_db():
     try:
         with get_db_connection() as conn:
-            c = conn.cursor()
-            c.execute("SELECT count, chat_id, username, last_reset FROM peticiones_por_usuario WHERE user_id = %s", (user_id,))
-            result = c.fetchone()
-            if result:
-                result_dict = dict(result)
-                now = datetime.now(SPAIN_TZ)
-                last_reset = result_dict['last_reset'].astimezone(SPAIN_TZ) if result_dict['last_reset'] else None
-                if not last_reset or (now - last_reset).total_seconds() >= 86400:
-                    result_dict['count'] = 0
-                    result_dict['last_reset'] = now
-                    set_peticiones_por_usuario(user_id, 0, result_dict['chat_id'], result_dict['username'], now)
-                return result_dict
-            return None
+            version = version_esquema(conn.cursor())
+        if version >= MIGRACIONES[-1][0]:
+            logger.info(f"Esquema de la base de datos al día (versión {version}).")
+            return
+        aplicar_migraciones()
+        logger.info("Base de datos inicializada correctamente.")
     except Exception as e:
-        logger.error(f"Error en get_peticiones_por_usuario: {str(e)}")
-        return None
+        logger.error(f"Error al inicializar la base de datos: {str(e)}")
+        raise
 
-def set_peticiones_por_usuario(user_id, count, chat_id, username, last_reset=None):
-    if last_reset is None:
-        last_reset = datetime.now(SPAIN_TZ)
+# Funciones de utilidad para la base de datos
+_tickets_reservados = deque()
+_tickets_pid = None
+_tickets_lock = threading.Lock()
+
+def reservar_tickets(c, cantidad=1):
+    c.execute("SELECT nextval('ticket_seq') FROM generate_series(1, %s)", (cantidad,))
+    return [row[0] for row in c.fetchall()]
+
+def increment_ticket_counter(c=None):
+    global _tickets_pid
+    if TICKET_BLOCK_SIZE == 1:
+        if c is not None:
+            return reservar_tickets(c)[0]
+        with get_db_connection() as conn:
+            return reservar_tickets(conn.cursor())[0]
+    with _tickets_lock:
+        if _tickets_pid != os.getpid():  # Un proceso hijo no debe reutilizar el bloque heredado del padre
+            _tickets_reservados.clear()
+            _tickets_pid = os.getpid()
+        if not _tickets_reservados:
+            if c is not None:
+                _tickets_reservados.extend(reservar_tickets(c, TICKET_BLOCK_SIZE))
+            else:
+                with get_db_connection() as conn:
+                    _tickets_reservados.extend(reservar_tickets(conn.cursor(), TICKET_BLOCK_SIZE))
+        return _tickets_reservados.popleft()
+
+def devolver_ticket(ticket):
+    with _tickets_lock:
+        if _tickets_pid == os.getpid():
+            _tickets_reservados.appendleft(ticket)
+
+# Motor de cuotas: la comprobación de caducidad, el límite y el incremento van en una sola sentencia
+# sobre la fila del usuario, así dos solicitudes simultáneas no pueden superar el límite
+if QUOTA_RESET == 'medianoche':
+    CUOTA_CADUCADA = "(p.last_reset IS NULL OR p.last_reset < date_trunc('day', now() AT TIME ZONE 'Europe/Madrid') AT TIME ZONE 'Europe/Madrid')"
+else:
+    CUOTA_CADUCADA = "(p.last_reset IS NULL OR p.last_reset <= now() - interval '24 hours')"
+
+SQL_CONSUMIR_CUOTA = f"""INSERT INTO peticiones_por_usuario AS p (user_id, count, chat_id, username, last_reset)
+                         VALUES (%(user_id)s, 1, %(chat_id)s, %(username)s, now())
+                         ON CONFLICT (user_id) DO UPDATE SET
+                         count = CASE WHEN {CUOTA_CADUCADA} THEN 1 ELSE p.count + 1 END,
+                         last_reset = CASE WHEN {CUOTA_CADUCADA} THEN now() ELSE p.last_reset END,
+                         chat_id = EXCLUDED.chat_id, username = EXCLUDED.username
+                         WHERE {CUOTA_CADUCADA} OR p.count < %(limite)s
+                         RETURNING count"""
+
+def limite_de(chat_id):
+    return LIMITES_POR_GRUPO.get(chat_id, LIMITE_DIARIO)
+
+def ajustar_cuota(user_id, delta, username=None, chat_id=None):
+    # /sumar y /restar: suma (o resta) sobre la cuota vigente sin bajar de 0; restar a quien no tiene fila no la crea
     try:
         with get_db_connection() as conn:
             c = conn.cursor()
-            c.execute("""INSERT INTO peticiones_por_usuario (user_id, count, chat_id, username, last_reset) 
-                         VALUES (%s, %s, %s, %s, %s)
-                         ON CONFLICT (user_id) DO UPDATE SET 
-                         count = EXCLUDED.count, chat_id = EXCLUDED.chat_id, username = EXCLUDED.username, last_reset = EXCLUDED.last_reset""",
-                      (user_id, count, chat_id, username, last_reset))
-            c.execute("""INSERT INTO usuarios (user_id, username) 
-                         VALUES (%s, %s) 
-                         ON CONFLICT (user_id) DO UPDATE SET username = EXCLUDED.username""",
-                      (user_id, username))
-            conn.commit()
+            if delta >= 0:
+                c.execute(f"""INSERT INTO peticiones_por_usuario AS p (user_id, count, chat_id, username, last_reset)
+                              VALUES (%(user_id)s, %(delta)s, %(chat_id)s, %(username)s, now())
+                              ON CONFLICT (user_id) DO UPDATE SET
+                              count = CASE WHEN {CUOTA_CADUCADA} THEN 0 ELSE p.count END + %(delta)s,
+                              last_reset = CASE WHEN {CUOTA_CADUCADA} THEN now() ELSE p.last_reset END,
+                              username = COALESCE(EXCLUDED.username, p.username)
+                              RETURNING count, chat_id""",
+                          {"user_id": user_id, "delta": delta, "chat_id": chat_id, "username": username})
+            else:
+                c.execute(f"""UPDATE peticiones_por_usuario AS p SET
+                              count = GREATEST(CASE WHEN {CUOTA_CADUCADA} THEN 0 ELSE p.count END + %(delta)s, 0),
+                              last_reset = CASE WHEN {CUOTA_CADUCADA} THEN now() ELSE p.last_reset END
+                              WHERE user_id = %(user_id)s
+                              RETURNING count, chat_id""",
+                          {"user_id": user_id, "delta": delta})
+            result = c.fetchone()
+            return dict(result) if result else None
     except Exception as e:
-        logger.error(f"Error en set_peticiones_por_usuario: {str(e)}")
+        logger.error(f"Error en ajustar_cuota: {str(e)}")
+        return None
 
 def get_user_id_by_username(username):
     try:
@@ -164,40 +1126,69 @@ def get_peticion_registrada(ticket_number):
         logger.error(f"Error en get_peticion_registrada: {str(e)}")
         return None
 
-def set_peticion_registrada(ticket_number, data):
+def del_peticion_registrada(ticket_number):
     try:
         with get_db_connection() as conn:
             c = conn.cursor()
-            c.execute("""INSERT INTO peticiones_registradas 
-                         (ticket_number, chat_id, username, message_text, message_id, timestamp, chat_title, thread_id, has_attachment) 
-                         VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                         ON CONFLICT (ticket_number) DO UPDATE SET 
-                         chat_id = EXCLUDED.chat_id, username = EXCLUDED.username, message_text = EXCLUDED.message_text, 
-                         message_id = EXCLUDED.message_id, timestamp = EXCLUDED.timestamp, chat_title = EXCLUDED.chat_title, 
-                         thread_id = EXCLUDED.thread_id, has_attachment = EXCLUDED.has_attachment""",
-                      (ticket_number, data["chat_id"], data["username"], data["message_text"],
-                       data["message_id"], data["timestamp"], data["chat_title"], data["thread_id"], data.get("has_attachment", False)))
+            c.execute("DELETE FROM peticiones_registradas WHERE ticket_number = %s", (ticket_number,))
             conn.commit()
     except Exception as e:
-        logger.error(f"Error en set_peticion_registrada: {str(e)}")
+        logger.error(f"Error en del_peticion_registrada: {str(e)}")
 
-def del_peticion_registrada(ticket_number):
+# Alta de una solicitud en una única transacción (el estado del grupo sale de la caché): cuota diaria con bloqueo de fila,
+# asignación de ticket y registro. Devuelve {"estado": "ok" | "desactivado" | "limite", ...}
+def registrar_peticion(user_id, data):
+    chat_id = data["chat_id"]
+    username = data["username"]
+    if not get_grupos_estados().get(chat_id, {}).get("activo", True):
+        return {"estado": "desactivado"}
+    limite = limite_de(chat_id)
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        # Cuota, ticket y usuario en un solo viaje: si la cuota no admite la solicitud el upsert no devuelve
+        # fila y las inserciones que dependen de él no se ejecutan (tampoco se consume número de ticket)
+        ticket_reservado = increment_ticket_counter(c) if TICKET_BLOCK_SIZE > 1 else None
+        c.execute(f"""WITH cuota AS ({SQL_CONSUMIR_CUOTA}),
+                      registro AS (
+                          INSERT INTO peticiones_registradas 
+                          (ticket_number, chat_id, username, message_text, message_id, timestamp, chat_title, thread_id, has_attachment) 
+                          SELECT COALESCE(%(ticket)s, nextval('ticket_seq')), %(chat_id)s, %(username)s, %(message_text)s, NULL,
+                                 %(timestamp)s, %(chat_title)s, %(thread_id)s, %(has_attachment)s
+                          FROM cuota
+                          RETURNING ticket_number),
+                      usuario AS (
+                          INSERT INTO usuarios (user_id, username) SELECT %(user_id)s, %(username)s FROM cuota
+                          ON CONFLICT (user_id) DO UPDATE SET username = EXCLUDED.username)
+                      SELECT cuota.count, registro.ticket_number FROM cuota, registro""",
+                  {"user_id": user_id, "chat_id": chat_id, "username": username, "limite": limite,
+                   "ticket": ticket_reservado, "message_text": data["message_text"], "timestamp": data["timestamp"],
+                   "chat_title": data["chat_title"], "thread_id": data["thread_id"],
+                   "has_attachment": data.get("has_attachment", False)})
+        result = c.fetchone()
+    if not result:
+        if ticket_reservado is not None:
+            devolver_ticket(ticket_reservado)
+        return {"estado": "limite", "count": limite, "limite": limite}
+    return {"estado": "ok", "ticket_number": result["ticket_number"], "count": result["count"], "limite": limite}
+
+def set_message_id_peticion(ticket_number, message_id):
     try:
         with get_db_connection() as conn:
             c = conn.cursor()
-            c.execute("DELETE FROM peticiones_registradas WHERE ticket_number = %s", (ticket_number,))
-            conn.commit()
+            c.execute("UPDATE peticiones_registradas SET message_id = %s WHERE ticket_number = %s", (message_id, ticket_number))
     except Exception as e:
-        logger.error(f"Error en del_peticion_registrada: {str(e)}")
+        logger.error(f"Error en set_message_id_peticion: {str(e)}")
 
 def get_historial_solicitud(ticket_number):
     try:
         with get_db_connection() as conn:
             c = conn.cursor()
-            c.execute("SELECT chat_id, username, message_text, chat_title, estado, fecha_gestion, admin_username, url "
+            c.execute("SELECT chat_id, username, message_text, chat_title, estado, fecha_gestion, admin_username, url, fecha_solicitud "
                       "FROM historial_solicitudes WHERE ticket_number = %s", (ticket_number,))
             result = c.fetchone()
-            return dict(result) if result else None
+            if result:
+                return dict(result)
+            return buscar_ticket_archivado(c, ticket_number)
     except Exception as e:
         logger.error(f"Error en get_historial_solicitud: {str(e)}")
         return None
@@ -206,28 +1197,59 @@ def set_historial_solicitud(ticket_number, data):
     try:
         with get_db_connection() as conn:
             c = conn.cursor()
-            c.execute("""INSERT INTO historial_solicitudes 
-                         (ticket_number, chat_id, username, message_text, chat_title, estado, fecha_gestion, admin_username, url) 
-                         VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                         ON CONFLICT (ticket_number) DO UPDATE SET 
-                         chat_id = EXCLUDED.chat_id, username = EXCLUDED.username, message_text = EXCLUDED.message_text, 
-                         chat_title = EXCLUDED.chat_title, estado = EXCLUDED.estado, fecha_gestion = EXCLUDED.fecha_gestion, 
-                         admin_username = EXCLUDED.admin_username, url = EXCLUDED.url""",
-                      (ticket_number, data["chat_id"], data["username"], data["message_text"],
-                       data["chat_title"], data["estado"], data["fecha_gestion"], data["admin_username"], data.get("url")))
+            valores = (data["chat_id"], data["username"], data["message_text"], data["chat_title"], data["estado"],
+                       data["fecha_gestion"], data["admin_username"], data.get("url"), data.get("fecha_solicitud"), ticket_number)
+            # El historial particionado no tiene clave única por ticket: el lock de transacción por ticket
+            # serializa las escrituras concurrentes y el UPDATE mueve la fila de partición si cambia de mes
+            c.execute("SELECT pg_advisory_xact_lock(%s, %s)", (HISTORIAL_LOCK_ID, ticket_number % 2147483647))
+            c.execute("""UPDATE historial_solicitudes SET chat_id = %s, username = %s, message_text = %s, chat_title = %s, 
+                         estado = %s, fecha_gestion = %s, admin_username = %s, url = %s, 
+                         fecha_solicitud = COALESCE(%s, fecha_solicitud) WHERE ticket_number = %s""", valores)
+            if c.rowcount == 0:
+                c.execute("""INSERT INTO historial_solicitudes 
+                             (chat_id, username, message_text, chat_title, estado, fecha_gestion, admin_username, url, fecha_solicitud, ticket_number) 
+                             VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)""", valores)
             conn.commit()
     except Exception as e:
         logger.error(f"Error en set_historial_solicitud: {str(e)}")
 
+# Caché en proceso del estado de los grupos. Se actualiza al escribir y se invalida en los demás
+# workers mediante LISTEN/NOTIFY; GRUPOS_CACHE_TTL acota el desfase si se pierde algún aviso.
+CANAL_GRUPOS = "grupos_estados"
+_grupos_cache = {"datos": None, "cargado": 0.0, "generacion": 0, "pid": None}
+_grupos_cache_lock = threading.Lock()
+
+def invalidar_cache_grupos(payload=None):
+    with _grupos_cache_lock:
+        _grupos_cache["datos"] = None
+        _grupos_cache["generacion"] += 1
+
 def get_grupos_estados():
+    with _grupos_cache_lock:
+        if _grupos_cache["pid"] != os.getpid():
+            _grupos_cache.update(datos=None, pid=os.getpid())
+        datos = _grupos_cache["datos"]
+        if datos is not None and time.monotonic() - _grupos_cache["cargado"] < GRUPOS_CACHE_TTL:
+            return dict(datos)
+        generacion = _grupos_cache["generacion"]
     try:
         with get_db_connection() as conn:
             c = conn.cursor()
             c.execute("SELECT chat_id, title, activo FROM grupos_estados")
-            return {row['chat_id']: {'title': row['title'], 'activo': row['activo']} for row in c.fetchall()}
+            datos = {row['chat_id']: {'title': row['title'], 'activo': row['activo']} for row in c.fetchall()}
     except Exception as e:
         logger.error(f"Error en get_grupos_estados: {str(e)}")
         return {}
+    with _grupos_cache_lock:
+        # Si llegó una invalidación durante la lectura, no se guarda un resultado que puede estar obsoleto
+        if _grupos_cache["generacion"] == generacion:
+            _grupos_cache.update(datos=datos, cargado=time.monotonic())
+    return dict(datos)
+
+def _actualizar_cache_grupo(chat_id, title, activo):
+    with _grupos_cache_lock:
+        if _grupos_cache["datos"] is not None:
+            _grupos_cache["datos"] = {**_grupos_cache["datos"], chat_id: {'title': title, 'activo': activo}}
 
 def set_grupo_estado(chat_id, title, activo=True):
     try:
@@ -237,63 +1259,1014 @@ def set_grupo_estado(chat_id, title, activo=True):
                          VALUES (%s, %s, %s) 
                          ON CONFLICT (chat_id) DO UPDATE SET title = EXCLUDED.title, activo = EXCLUDED.activo""",
                       (chat_id, title, activo))
-            conn.commit()
+            c.execute("SELECT pg_notify(%s, %s)", (CANAL_GRUPOS, str(chat_id)))  # Se entrega al hacer commit
+        _actualizar_cache_grupo(chat_id, title, activo)
     except Exception as e:
         logger.error(f"Error en set_grupo_estado: {str(e)}")
 
-def get_peticiones_incorrectas(user_id):
+def registrar_grupo(chat_id, title):
+    # Alta del grupo o actualización de su título sin tocar el estado activo/inactivo
     try:
         with get_db_connection() as conn:
             c = conn.cursor()
-            c.execute("SELECT timestamp, chat_id FROM peticiones_incorrectas WHERE user_id = %s", (user_id,))
-            return [dict(row) for row in c.fetchall()]
+            c.execute("""INSERT INTO grupos_estados (chat_id, title, activo) 
+                         VALUES (%s, %s, TRUE) 
+                         ON CONFLICT (chat_id) DO UPDATE SET title = EXCLUDED.title
+                         WHERE grupos_estados.title IS DISTINCT FROM EXCLUDED.title
+                         RETURNING activo""",
+                      (chat_id, title))
+            cambio = c.fetchone()
+            if cambio:
+                c.execute("SELECT pg_notify(%s, %s)", (CANAL_GRUPOS, str(chat_id)))
+        if cambio:
+            _actualizar_cache_grupo(chat_id, title, cambio["activo"])
+        return True
     except Exception as e:
-        logger.error(f"Error en get_peticiones_incorrectas: {str(e)}")
-        return []
+        logger.error(f"Error en registrar_grupo: {str(e)}")
+        return False
+
+# Estado de conversación compartido entre workers (selección de grupos, URL pendiente de cada admin):
+# claves con caducidad en una tabla UNLOGGED y versión para compare-and-set, con una caché local de
+# lectura que se invalida por LISTEN/NOTIFY igual que la de grupos
+CANAL_ESTADO = "estado_compartido"
+_estado_cache = {}  # clave -> (valor, versión, caduca_monotonic)
+_estado_cache_lock = threading.Lock()
+_estado_generacion = [0]
+
+def invalidar_cache_estado(payload=None):
+    with _estado_cache_lock:
+        if payload:
+            _estado_cache.pop(payload, None)
+        else:
+            _estado_cache.clear()
+        _estado_generacion[0] += 1
+
+class EstadoCompartido:
+    def __init__(self, espacio, ttl):
+        self.espacio = espacio
+        self.ttl = ttl
+
+    def _clave(self, clave):
+        return f"{self.espacio}:{clave}"
+
+    def _cachear(self, clave, valor, version, generacion=None):
+        with _estado_cache_lock:
+            if generacion is None or _estado_generacion[0] == generacion:
+                _estado_cache[clave] = (valor, version, time.monotonic() + ESTADO_CACHE_TTL)
+
+    def leer(self, clave):
+        # Devuelve (valor, versión); (None, None) si la clave no existe o ha caducado
+        clave = self._clave(clave)
+        with _estado_cache_lock:
+            entrada = _estado_cache.get(clave)
+            generacion = _estado_generacion[0]
+        if entrada and entrada[2] > time.monotonic():
+            return entrada[0], entrada[1]
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            c.execute("""SELECT valor, version FROM estado_compartido 
+                         WHERE clave = %s AND (expira_en IS NULL OR expira_en > now())""", (clave,))
+            row = c.fetchone()
+        valor, version = (row["valor"], row["version"]) if row else (None, None)
+        self._cachear(clave, valor, version, generacion)
+        return valor, version
+
+    def get(self, clave):
+        return self.leer(clave)[0]
+
+    def set(self, clave, valor):
+        clave = self._clave(clave)
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            c.execute("""INSERT INTO estado_compartido (clave, valor, version, expira_en) 
+                         VALUES (%s, %s, 1, now() + %s * interval '1 second')
+                         ON CONFLICT (clave) DO UPDATE SET valor = EXCLUDED.valor, expira_en = EXCLUDED.expira_en,
+                         version = estado_compartido.version + 1
+                         RETURNING version""",
+                      (clave, Json(valor), self.ttl))
+            version = c.fetchone()[0]
+            c.execute("SELECT pg_notify(%s, %s)", (CANAL_ESTADO, clave))
+        self._cachear(clave, valor, version)
+        return version
+
+    def compare_and_set(self, clave, valor, version):
+        # Escribe solo si la clave sigue en la versión leída (None = no existía); devuelve la nueva versión o None
+        clave = self._clave(clave)
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            if version is None:
+                c.execute("""INSERT INTO estado_compartido (clave, valor, version, expira_en) 
+                             VALUES (%s, %s, 1, now() + %s * interval '1 second')
+                             ON CONFLICT (clave) DO UPDATE SET valor = EXCLUDED.valor, expira_en = EXCLUDED.expira_en,
+                             version = estado_compartido.version + 1
+                             WHERE estado_compartido.expira_en <= now()
+                             RETURNING version""",
+                          (clave, Json(valor), self.ttl))
+            else:
+                c.execute("""UPDATE estado_compartido SET valor = %s, version = version + 1, 
+                             expira_en = now() + %s * interval '1 second'
+                             WHERE clave = %s AND version = %s AND (expira_en IS NULL OR expira_en > now())
+                             RETURNING version""",
+                          (Json(valor), self.ttl, clave, version))
+            row = c.fetchone()
+            if row:
+                c.execute("SELECT pg_notify(%s, %s)", (CANAL_ESTADO, clave))
+        if not row:
+            invalidar_cache_estado(clave)
+            return None
+        self._cachear(clave, valor, row[0])
+        return row[0]
+
+    def actualizar(self, clave, funcion, intentos=5):
+        # Lectura-modificación-escritura con reintento si otro worker cambió la clave entre medias
+        for _ in range(intentos):
+            valor, version = self.leer(clave)
+            if valor is None:
+                return None
+            nuevo = funcion(valor)
+            if self.compare_and_set(clave, nuevo, version) is not None:
+                return nuevo
+        return None
+
+    def delete(self, clave, version=None):
+        # Con versión solo borra si nadie la ha cambiado: sirve para reclamar un paso final una única vez
+        clave = self._clave(clave)
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            if version is None:
+                c.execute("DELETE FROM estado_compartido WHERE clave = %s", (clave,))
+            else:
+                c.execute("DELETE FROM estado_compartido WHERE clave = %s AND version = %s", (clave, version))
+            borrado = c.rowcount > 0
+            if borrado:
+                c.execute("SELECT pg_notify(%s, %s)", (CANAL_ESTADO, clave))
+        invalidar_cache_estado(clave)
+        return borrado
+
+def purgar_estado_caducado():
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute("DELETE FROM estado_compartido WHERE expira_en <= now()")
+        return c.rowcount
+
+seleccion_grupos = EstadoCompartido("seleccion", MENU_TIMEOUT)  # chat de administración -> grupos marcados en /menu on|off
+urls_pendientes = EstadoCompartido("url", MENU_TIMEOUT)  # admin -> ticket y URL a enviar al aprobar
+
+# Índice en memoria de solicitudes parecidas: las abiertas (peticiones_registradas) y las aprobadas en los
+# últimos DUPLICADOS_APROBADAS_DIAS días. Cada título normalizado se reduce a sus trigramas y a una firma
+# MinHash repartida en bandas (LSH): una consulta solo compara con los tickets que comparten alguna banda y
+# confirma con el Jaccard exacto. Se carga entero al conectar el oyente de notificaciones y después se
+# mantiene con los avisos del trigger notificar_similares, así que cada proceso ve también lo que hacen los demás
+CANAL_SIMILARES = "similares"
+SIMILARES_BANDAS = 16
+SIMILARES_FILAS = 3  # 16 bandas de 3 valores: un parecido de 0,6 sale candidato el 98 % de las veces y uno de 0,3 el 35 %
+# Cortesía, artículos y etiquetas de formato: "latino" o "4K" aparecen en miles de títulos y acabarían
+# dominando los mínimos de la firma, juntando en la misma banda peticiones que no se parecen
+PALABRAS_VACIAS = {"hola", "buenas", "buenos", "dias", "tardes", "noches", "saludos", "gracias", "por", "favor", "porfa",
+                   "porfavor", "alguien", "tiene", "teneis", "quisiera", "me", "si", "el", "la", "los", "las", "lo",
+                   "un", "una", "de", "del", "y", "e", "en", "a", "al", "para", "con", "pelicula", "serie", "temporada",
+                   "temporadas", "capitulo", "completa", "castellano", "espanol", "latino", "subtitulos", "subtitulada",
+                   "subtitulado", "vose", "hd", "4k", "1080p", "720p"}
+# Las funciones hash de MinHash salen de un único shake_128 por trigrama cortado en valores de 16 bits, y el
+# mínimo de cada una lo calculan map/zip en C: unas 10 veces menos que permutar (a·h + b) mod p en Python.
+# El vocabulario de trigramas es pequeño, así que sus hashes se cachean
+@lru_cache(maxsize=65536)
+def hashes_trigrama(trigrama):
+    return memoryview(hashlib.shake_128(trigrama.encode()).digest(2 * SIMILARES_BANDAS * SIMILARES_FILAS)).cast('H').tolist()
+
+def normalizar_titulo(texto):
+    # Sin tildes, comandos (/solicito, #peticion), enlaces ni palabras de cortesía; los números se guardan
+    # aparte porque "Matrix 2" y "Matrix 3" comparten casi todos los trigramas y no son la misma petición
+    texto = ''.join(c for c in unicodedata.normalize('NFD', (texto or '').lower()) if not unicodedata.combining(c))
+    texto = re.sub(r"https?://\S+|[/#]\w+", " ", texto)
+    palabras = [p for p in re.findall(r"\w+", texto) if p not in PALABRAS_VACIAS]
+    trigramas = frozenset(f"  {p} "[i:i + 3] for p in palabras for i in range(len(p) + 1))
+    return trigramas, frozenset(p for p in palabras if p.isdigit())
+
+class IndiceSimilares:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entradas = {}  # (origen, ticket) -> (trigramas, números, firma, fecha de aprobación o None)
+        self.bandas = [{} for _ in range(SIMILARES_BANDAS)]  # trozo de firma -> claves que lo comparten
+        self.cargado = False
+        self.proxima_poda = 0.0
+
+    @staticmethod
+    def firma(trigramas):
+        return tuple(map(min, zip(*map(hashes_trigrama, trigramas))))
+
+    @staticmethod
+    def trozos(firma):
+        return [firma[i * SIMILARES_FILAS:(i + 1) * SIMILARES_FILAS] for i in range(SIMILARES_BANDAS)]
+
+    @staticmethod
+    def preparar(texto, fecha=None):
+        trigramas, numeros = normalizar_titulo(texto)
+        return (trigramas, numeros, IndiceSimilares.firma(trigramas), fecha) if trigramas else None
+
+    def _poner(self, clave, entrada):
+        self.entradas[clave] = entrada
+        for banda, trozo in zip(self.bandas, self.trozos(entrada[2])):
+            banda.setdefault(trozo, set()).add(clave)
+
+    def _quitar(self, clave):
+        entrada = self.entradas.pop(clave, None)
+        if not entrada:
+            return
+        for banda, trozo in zip(self.bandas, self.trozos(entrada[2])):
+            claves = banda.get(trozo)
+            if claves:
+                claves.discard(clave)
+                if not claves:
+                    del banda[trozo]
+
+    def _podar(self):
+        # Las aprobadas que salen de la ventana se retiran como mucho una vez por hora
+        if time.monotonic() < self.proxima_poda:
+            return
+        self.proxima_poda = time.monotonic() + 3600
+        corte = datetime.now(SPAIN_TZ) - timedelta(days=DUPLICADOS_APROBADAS_DIAS)
+        for clave in [clave for clave, entrada in self.entradas.items() if entrada[3] and entrada[3] < corte]:
+            self._quitar(clave)
+
+    def agregar(self, origen, ticket, texto, fecha=None):
+        entrada = self.preparar(texto, fecha)  # La firma se calcula fuera del lock
+        with self.lock:
+            self._quitar((origen, ticket))
+            if entrada:
+                self._poner((origen, ticket), entrada)
+            self._podar()
+
+    def quitar(self, origen, ticket):
+        with self.lock:
+            self._quitar((origen, ticket))
+
+    def cargar(self, filas):
+        entradas = {(origen, ticket): self.preparar(texto, fecha) for origen, ticket, texto, fecha in filas}
+        with self.lock:
+            self.entradas, self.bandas = {}, [{} for _ in range(SIMILARES_BANDAS)]
+            for clave, entrada in entradas.items():
+                if entrada:
+                    self._poner(clave, entrada)
+            self.cargado = True
+
+    def buscar(self, texto, excluir=None):
+        # Devuelve (origen, ticket, parecido) del ticket más parecido por encima del umbral, o None
+        consulta = self.preparar(texto)
+        if not consulta:
+            return None
+        trigramas, numeros, firma, _ = consulta
+        corte = datetime.now(SPAIN_TZ) - timedelta(days=DUPLICADOS_APROBADAS_DIAS)
+        mejor = None
+        with self.lock:
+            candidatos = set()
+            for banda, trozo in zip(self.bandas, self.trozos(firma)):
+                candidatos.update(banda.get(trozo, ()))
+            for clave in candidatos:
+                otros, otros_numeros, _, fecha = self.entradas[clave]
+                if clave[1] == excluir or (fecha and fecha < corte) or (numeros and otros_numeros and numeros != otros_numeros):
+                    continue
+                comunes = len(trigramas & otros)
+                parecido = comunes / (len(trigramas) + len(otros) - comunes)
+                if parecido >= DUPLICADOS_UMBRAL and (not mejor or parecido > mejor[2]):
+                    mejor = (clave[0], clave[1], parecido)
+                    if parecido == 1:
+                        break
+        return mejor
+
+    def estadisticas(self):
+        with self.lock:
+            return {"cargado": self.cargado, "entradas": len(self.entradas)}
+
+indice_similares = IndiceSimilares()
+
+def aplicar_aviso_similares(payload=None):
+    try:
+        if payload is None:
+            with get_db_connection() as conn:
+                c = conn.cursor()
+                c.execute("""SELECT 'pendiente', ticket_number, message_text, NULL FROM peticiones_registradas 
+                             UNION ALL 
+                             SELECT 'aprobada', ticket_number, message_text, fecha_gestion FROM historial_solicitudes 
+                             WHERE estado = 'subido' AND fecha_gestion >= now() - %s * interval '1 day'""",
+                          (DUPLICADOS_APROBADAS_DIAS,))
+                filas = [tuple(row) for row in c.fetchall()]
+            indice_similares.cargar(filas)
+            logger.info(f"Índice de duplicados cargado: {len(indice_similares.entradas)} solicitudes")
+            return
+        aviso = json.loads(payload)
+        if aviso["op"] == "quitar":
+            indice_similares.quitar(aviso["origen"], aviso["ticket"])
+        else:
+            fecha = datetime.fromisoformat(aviso["fecha"]) if aviso.get("fecha") else None
+            indice_similares.agregar(aviso["origen"], aviso["ticket"], aviso["texto"], fecha)
+    except Exception as e:
+        logger.error(f"Error en aplicar_aviso_similares: {str(e)}")
+
+# Escucha de notificaciones de PostgreSQL en una conexión dedicada (fuera del pool) por proceso
+def aviso_estado(payload):
+    invalidar_cache_estado(payload)
+    aviso_busqueda_en_espera(payload)
+
+OYENTES_NOTIFY = {CANAL_GRUPOS: invalidar_cache_grupos, CANAL_ESTADO: aviso_estado,
+                  CANAL_SIMILARES: aplicar_aviso_similares}
+
+def escuchar_notificaciones():
+    while True:
+        conn = None
+        try:
+            conn = psycopg2.connect(DATABASE_URL, connect_timeout=DB_CONNECT_TIMEOUT)
+            conn.autocommit = True
+            c = conn.cursor()
+            for canal in OYENTES_NOTIFY:
+                c.execute(f"LISTEN {canal}")
+            # Los avisos emitidos mientras no se escuchaba se han perdido: se parte de cachés vacías
+            for callback in OYENTES_NOTIFY.values():
+                callback(None)
+            logger.info(f"Escuchando notificaciones en: {', '.join(OYENTES_NOTIFY)}")
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    aviso = conn.notifies.pop(0)
+                    callback = OYENTES_NOTIFY.get(aviso.channel)
+                    if callback:
+                        callback(aviso.payload)
+        except Exception as e:
+            logger.error(f"Error en escuchar_notificaciones: {str(e)}")
+            time.sleep(5)
+        finally:
+            if conn is not None:
+                conn.close()
 
 def add_peticion_incorrecta(user_id, timestamp, chat_id):
+    # Inserta el intento y devuelve cuántos lleva el usuario en las últimas 24 h (incluido este) en un solo
+    # viaje: el recuento usa idx_incorrectas_user_ts y solo lee la ventana, no todo el historial del usuario.
+    # La fila insertada por el CTE no es visible para el SELECT de la misma sentencia, de ahí el + 1
     try:
         with get_db_connection() as conn:
             c = conn.cursor()
-            c.execute("INSERT INTO peticiones_incorrectas (user_id, timestamp, chat_id) VALUES (%s, %s, %s)",
-                      (user_id, timestamp, chat_id))
-            conn.commit()
+            c.execute("""WITH nuevo AS (
+                             INSERT INTO peticiones_incorrectas (user_id, timestamp, chat_id) VALUES (%(user_id)s, %(ts)s, %(chat_id)s))
+                         SELECT COUNT(*) + 1 FROM peticiones_incorrectas
+                         WHERE user_id = %(user_id)s AND timestamp > %(ts)s - interval '24 hours'""",
+                      {"user_id": user_id, "ts": timestamp, "chat_id": chat_id})
+            return c.fetchone()[0]
     except Exception as e:
         logger.error(f"Error en add_peticion_incorrecta: {str(e)}")
+        return 1
+
+# Retención por lotes: cada lote borra como mucho RETENCION_LOTE filas en una transacción corta, salta
+# las filas que el bot tiene bloqueadas (SKIP LOCKED) y cede el turno si no consigue un bloqueo en
+# RETENCION_LOCK_TIMEOUT. La pausa entre lotes deja paso a las solicitudes aunque se ejecute en hora punta
+SQL_RETENCION_PETICIONES = """DELETE FROM peticiones_registradas WHERE ticket_number IN
+                              (SELECT p.ticket_number FROM peticiones_registradas p
+                               JOIN historial_solicitudes h ON h.ticket_number = p.ticket_number
+                               WHERE h.estado = 'eliminado' LIMIT %(lote)s FOR UPDATE OF p SKIP LOCKED)"""
+SQL_RETENCION_INCORRECTAS = """DELETE FROM peticiones_incorrectas WHERE id IN
+                               (SELECT id FROM peticiones_incorrectas WHERE timestamp < %(corte)s
+                                LIMIT %(lote)s FOR UPDATE SKIP LOCKED)"""
+# No se borra del historial un ticket que siga en peticiones_registradas: quedaría huérfano para siempre
+SQL_RETENCION_HISTORIAL = """DELETE FROM historial_solicitudes WHERE ticket_number IN
+                             (SELECT h.ticket_number FROM historial_solicitudes h
+                              WHERE h.estado = %(estado)s AND h.fecha_gestion < %(corte)s
+                              AND NOT EXISTS (SELECT 1 FROM peticiones_registradas p WHERE p.ticket_number = h.ticket_number)
+                              LIMIT %(lote)s FOR UPDATE SKIP LOCKED)"""
+
+def borrar_por_lotes(nombre, sql, parametros, plazo):
+    total, lotes, inicio = 0, 0, time.monotonic()
+    completado = False
+    while time.monotonic() < plazo:
+        try:
+            with get_db_connection() as conn:
+                c = conn.cursor()
+                c.execute("SELECT set_config('lock_timeout', %s, true)", (RETENCION_LOCK_TIMEOUT,))
+                c.execute(sql, dict(parametros, lote=RETENCION_LOTE))
+                borradas = c.rowcount
+        except psycopg2.errors.LockNotAvailable:
+            logger.warning(f"Retención {nombre}: lote cedido por un bloqueo, se reintenta tras la pausa")
+            time.sleep(RETENCION_PAUSA)
+            continue
+        total, lotes = total + borradas, lotes + 1
+        transcurrido = time.monotonic() - inicio
+        logger.debug(f"Retención {nombre}: lote {lotes}, {total} filas ({total / transcurrido:.0f} filas/s)")
+        if borradas < RETENCION_LOTE:
+            completado = True
+            break
+        time.sleep(RETENCION_PAUSA)
+    transcurrido = time.monotonic() - inicio
+    ritmo = total / transcurrido if transcurrido else 0
+    logger.info(f"Retención {nombre}: {total} filas en {lotes} lotes y {transcurrido:.1f} s ({ritmo:.0f} filas/s)"
+                + ("" if completado else "; quedan filas para la próxima ejecución"))
+    return total, completado
 
 def clean_database():
     try:
-        with get_db_connection() as conn:
-            c = conn.cursor()
-            c.execute("DELETE FROM peticiones_registradas WHERE ticket_number IN (SELECT ticket_number FROM historial_solicitudes WHERE estado = 'eliminado')")
-            deleted_reg = c.rowcount
-            c.execute("DELETE FROM peticiones_incorrectas WHERE timestamp < %s", (datetime.now(SPAIN_TZ) - timedelta(days=30),))
-            deleted_inc = c.rowcount
-            conn.commit()
-            total_deleted = deleted_reg + deleted_inc
-            safe_bot_method(bot.send_message, chat_id=GROUP_DESTINO, 
-                            text=f"🧹 *Limpieza completada* ✅\nSe eliminaron {total_deleted} registros obsoletos ({deleted_reg} peticiones, {deleted_inc} incorrectas).", 
-                            parse_mode='Markdown')
+        ahora = datetime.now(SPAIN_TZ)
+        plazo = time.monotonic() + RETENCION_MAX_SEGUNDOS
+        deleted_reg, completo_reg = borrar_por_lotes("peticiones eliminadas", SQL_RETENCION_PETICIONES, {}, plazo)
+        deleted_inc, completo_inc = borrar_por_lotes("peticiones incorrectas", SQL_RETENCION_INCORRECTAS,
+                                                     {"corte": ahora - timedelta(days=RETENCION_INCORRECTAS_DIAS)}, plazo)
+        deleted_hist, completo_hist = 0, True
+        for estado, dias in RETENCION_HISTORIAL.items():
+            borradas, completo = borrar_por_lotes(f"historial {estado}", SQL_RETENCION_HISTORIAL,
+                                                  {"estado": estado, "corte": ahora - timedelta(days=dias)}, plazo)
+            deleted_hist += borradas
+            completo_hist = completo_hist and completo
+        total_deleted = deleted_reg + deleted_inc + deleted_hist
+        safe_bot_method_async(bot.send_message, chat_id=GROUP_DESTINO, 
+                        text=f"🧹 *Limpieza completada* ✅\nSe eliminaron {total_deleted} registros obsoletos "
+                             f"({deleted_reg} peticiones, {deleted_inc} incorrectas, {deleted_hist} del historial).", 
+                        parse_mode='Markdown')
         logger.info("Base de datos limpiada de registros obsoletos.")
+        return {"peticiones": deleted_reg, "incorrectas": deleted_inc, "historial": deleted_hist,
+                "completa": completo_reg and completo_inc and completo_hist}
     except Exception as e:
         logger.error(f"Error en clean_database: {str(e)}")
+        raise
 
-def auto_clean_cache():
+# Particiones mensuales del historial (historial_solicitudes_AAAA_MM, mes natural en hora de Madrid).
+# Una fila de un mes sin partición cae en historial_solicitudes_default; al crear la partición se traslada
+COLUMNAS_HISTORIAL = ["ticket_number", "chat_id", "username", "message_text", "chat_title", "estado",
+                      "fecha_gestion", "admin_username", "url", "fecha_solicitud"]
+
+def inicio_mes(fecha, desplazamiento=0):
+    anio, mes = divmod(fecha.year * 12 + fecha.month - 1 + desplazamiento, 12)
+    return SPAIN_TZ.localize(datetime(anio, mes + 1, 1))
+
+def particion_historial(mes):
+    return f"historial_solicitudes_{mes:%Y_%m}"
+
+def crear_particion_historial(c, mes):
+    nombre, fin = particion_historial(mes), inicio_mes(mes, 1)
+    c.execute("SELECT to_regclass(%s) IS NOT NULL", (nombre,))
+    if c.fetchone()[0]:
+        return False
+    c.execute(f"CREATE TABLE {nombre} (LIKE historial_solicitudes INCLUDING DEFAULTS)")
+    c.execute("SELECT set_config('entreshijos.omitir_estadisticas', 'on', true)")  # Es un traslado, no un cambio de estado
+    c.execute(f"""WITH movidas AS (DELETE FROM historial_solicitudes_default 
+                                   WHERE fecha_gestion >= %s AND fecha_gestion < %s RETURNING *)
+                  INSERT INTO {nombre} SELECT * FROM movidas""", (mes, fin))
+    c.execute(f"ALTER TABLE historial_solicitudes ATTACH PARTITION {nombre} FOR VALUES FROM (%s) TO (%s)", (mes, fin))
+    logger.info(f"Partición {nombre} creada")
+    return True
+
+def get_particiones_historial(c):
+    c.execute("""SELECT r.relname FROM pg_inherits i JOIN pg_class r ON r.oid = i.inhrelid 
+                 WHERE i.inhparent = 'historial_solicitudes'::regclass AND r.relname ~ '_[0-9]{4}_[0-9]{2}$'""")
+    return sorted((SPAIN_TZ.localize(datetime.strptime(row[0][-7:], "%Y_%m")), row[0]) for row in c.fetchall())
+
+# Archivo frío: cada mes es un fichero historial_AAAA_MM.jsonl.gz al que solo se añade (un miembro gzip por
+# volcado) y historial_archivo lleva el recuento, el rango de tickets y el desglose por estado de cada mes.
+# El fichero se escribe y sincroniza antes de confirmar el borrado en PostgreSQL: si el proceso cae entre
+# medias, el siguiente volcado repite filas y la lectura se queda con la última versión de cada ticket
+def ruta_archivo_historial(mes):
+    return os.path.join(HISTORIAL_ARCHIVO_DIR, f"historial_{mes:%Y_%m}.jsonl.gz")
+
+def escribir_archivo_historial(c, mes, filas):
+    # Sin filas no se abre el fichero: cada apertura en modo "ab" añade un miembro gzip aunque quede vacío
+    filas = iter(filas)
+    primera = next(filas, None)
+    if primera is None:
+        return 0
+    filas = itertools.chain([primera], filas)
+    ruta = ruta_archivo_historial(mes)
+    os.makedirs(HISTORIAL_ARCHIVO_DIR, exist_ok=True)
+    por_estado, tickets = {}, []
+    with open(ruta, "ab") as f:
+        with gzip.GzipFile(fileobj=f, mode="wb") as gz:
+            for fila in filas:
+                registro = {columna: valor.isoformat() if isinstance(valor, datetime) else valor
+                            for columna, valor in zip(COLUMNAS_HISTORIAL, fila)}
+                gz.write((json.dumps(registro, ensure_ascii=False) + "\n").encode("utf-8"))
+                por_estado[registro["estado"]] = por_estado.get(registro["estado"], 0) + 1
+                tickets.append(registro["ticket_number"])
+        f.flush()
+        os.fsync(f.fileno())
+    nuevas = len(tickets)
+    c.execute("SELECT filas, ticket_min, ticket_max, por_estado FROM historial_archivo WHERE mes = %s FOR UPDATE", (mes.date(),))
+    previo = c.fetchone()
+    if previo:
+        for estado, cantidad in previo["por_estado"].items():
+            por_estado[estado] = por_estado.get(estado, 0) + cantidad
+        tickets += [previo["ticket_min"], previo["ticket_max"]]
+    c.execute("""INSERT INTO historial_archivo (mes, fichero, filas, ticket_min, ticket_max, por_estado) 
+                 VALUES (%s, %s, %s, %s, %s, %s) 
+                 ON CONFLICT (mes) DO UPDATE SET filas = historial_archivo.filas + EXCLUDED.filas, 
+                 ticket_min = EXCLUDED.ticket_min, ticket_max = EXCLUDED.ticket_max, por_estado = EXCLUDED.por_estado, 
+                 archivado_en = now()""",
+              (mes.date(), os.path.basename(ruta), nuevas, min(tickets), max(tickets), Json(por_estado)))
+    return nuevas
+
+def archivar_particion(nombre, mes):
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT set_config('lock_timeout', %s, true)", (RETENCION_LOCK_TIMEOUT,))
+        c.execute(f"LOCK TABLE {nombre} IN EXCLUSIVE MODE")  # Se sigue pudiendo leer, pero no escribir
+        lector = conn.cursor(name=f"archivo_{nombre}")
+        lector.itersize = 2000
+        lector.execute(f"SELECT {', '.join(COLUMNAS_HISTORIAL)} FROM {nombre} ORDER BY ticket_number")
+        filas = escribir_archivo_historial(c, mes, lector)
+        lector.close()
+        c.execute(f"ALTER TABLE historial_solicitudes DETACH PARTITION {nombre}")
+        c.execute(f"DROP TABLE {nombre}")
+    logger.info(f"Partición {nombre} archivada en {ruta_archivo_historial(mes)} ({filas} filas)")
+    return filas
+
+def archivar_rezagados(corte):
+    # Filas antiguas que cayeron en la partición por defecto (p. ej. un mes ya archivado): se añaden a su fichero
+    archivadas = 0
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT set_config('lock_timeout', %s, true)", (RETENCION_LOCK_TIMEOUT,))
+        c.execute("LOCK TABLE historial_solicitudes_default IN EXCLUSIVE MODE")
+        c.execute("SELECT set_config('entreshijos.omitir_estadisticas', 'on', true)")  # Lo archivado sigue contando
+        c.execute(f"SELECT {', '.join(COLUMNAS_HISTORIAL)} FROM historial_solicitudes_default "
+                  "WHERE fecha_gestion < %s ORDER BY fecha_gestion", (corte,))
+        por_mes = {}
+        for fila in c.fetchall():
+            por_mes.setdefault(inicio_mes(fila["fecha_gestion"].astimezone(SPAIN_TZ)), []).append(fila)
+        for mes, filas in sorted(por_mes.items()):
+            archivadas += escribir_archivo_historial(c, mes, filas)
+        if por_mes:
+            c.execute("DELETE FROM historial_solicitudes_default WHERE fecha_gestion < %s", (corte,))
+    return archivadas
+
+def mantener_historial():
+    ahora = datetime.now(SPAIN_TZ)
+    corte = inicio_mes(ahora, -HISTORIAL_ARCHIVO_MESES) if HISTORIAL_ARCHIVO_MESES > 0 else None
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        # Los meses próximos y los que aún no se archivan pero tienen filas en la partición por defecto
+        c.execute("""SELECT DISTINCT date_trunc('month', fecha_gestion AT TIME ZONE 'Europe/Madrid') FROM historial_solicitudes_default 
+                     WHERE %s::TIMESTAMPTZ IS NULL OR fecha_gestion >= %s""", (corte, corte))
+        meses = {SPAIN_TZ.localize(row[0]) for row in c.fetchall()}
+        meses.update(inicio_mes(ahora, n) for n in range(HISTORIAL_PARTICIONES_ADELANTE + 1))
+        creadas = sum(crear_particion_historial(c, mes) for mes in sorted(meses))
+    archivadas = 0
+    if corte:
+        with get_db_connection() as conn:
+            particiones = get_particiones_historial(conn.cursor())
+        for mes, nombre in particiones:
+            if inicio_mes(mes, 1) <= corte:
+                archivadas += archivar_particion(nombre, mes)
+        archivadas += archivar_rezagados(corte)
+    return {"particiones_creadas": creadas, "filas_archivadas": archivadas}
+
+# Reconciliación de los contadores con las tablas. Cada bloque bloquea la tabla en modo SHARE (las lecturas
+# siguen, las escrituras esperan) para que ningún trigger cambie los contadores mientras se recalculan.
+# Del historial solo se recalculan los días que siguen en PostgreSQL: lo archivado se conserva tal cual
+def reconciliar_estadisticas():
+    correcciones = {}
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        particiones = get_particiones_historial(c)
+    desde = particiones[0][0] if particiones else None
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT set_config('lock_timeout', %s, true)", (RETENCION_LOCK_TIMEOUT,))
+        c.execute("LOCK TABLE historial_solicitudes IN SHARE MODE")
+        c.execute("""WITH reales AS (
+                         SELECT COALESCE(estado, 'desconocido') AS estado, COALESCE(chat_id, 0) AS chat_id, 
+                                (fecha_gestion AT TIME ZONE 'Europe/Madrid')::date AS dia, COUNT(*) AS cantidad 
+                         FROM historial_solicitudes WHERE %(desde)s::TIMESTAMPTZ IS NULL OR fecha_gestion >= %(desde)s 
+                         GROUP BY 1, 2, 3),
+                     actuales AS (
+                         SELECT estado, chat_id, dia, cantidad FROM estadisticas 
+                         WHERE estado NOT IN ('pendiente', 'usuario', 'recibida') 
+                         AND (%(desde)s::TIMESTAMPTZ IS NULL OR dia >= (%(desde)s::TIMESTAMPTZ AT TIME ZONE 'Europe/Madrid')::date)),
+                     diferencias AS (
+                         SELECT COALESCE(r.estado, a.estado) AS estado, COALESCE(r.chat_id, a.chat_id) AS chat_id, 
+                                COALESCE(r.dia, a.dia) AS dia, COALESCE(r.cantidad, 0) AS cantidad 
+                         FROM reales r FULL JOIN actuales a ON a.estado = r.estado AND a.chat_id = r.chat_id AND a.dia = r.dia 
+                         WHERE COALESCE(r.cantidad, 0) <> COALESCE(a.cantidad, 0))
+                     INSERT INTO estadisticas (estado, chat_id, dia, cantidad) SELECT estado, chat_id, dia, cantidad FROM diferencias 
+                     ON CONFLICT (estado, chat_id, dia) DO UPDATE SET cantidad = EXCLUDED.cantidad""",
+                  {"desde": desde})
+        correcciones["historial"] = c.rowcount
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT set_config('lock_timeout', %s, true)", (RETENCION_LOCK_TIMEOUT,))
+        c.execute("LOCK TABLE peticiones_registradas IN SHARE MODE")
+        c.execute("""WITH reales AS (
+                         SELECT COALESCE(chat_id, 0) AS chat_id, (COALESCE(timestamp, now()) AT TIME ZONE 'Europe/Madrid')::date AS dia, 
+                                COUNT(*) AS cantidad 
+                         FROM peticiones_registradas GROUP BY 1, 2),
+                     actuales AS (SELECT chat_id, dia, cantidad FROM estadisticas WHERE estado = 'pendiente'),
+                     diferencias AS (
+                         SELECT COALESCE(r.chat_id, a.chat_id) AS chat_id, COALESCE(r.dia, a.dia) AS dia, COALESCE(r.cantidad, 0) AS cantidad 
+                         FROM reales r FULL JOIN actuales a ON a.chat_id = r.chat_id AND a.dia = r.dia 
+                         WHERE COALESCE(r.cantidad, 0) <> COALESCE(a.cantidad, 0))
+                     INSERT INTO estadisticas (estado, chat_id, dia, cantidad) SELECT 'pendiente', chat_id, dia, cantidad FROM diferencias 
+                     ON CONFLICT (estado, chat_id, dia) DO UPDATE SET cantidad = EXCLUDED.cantidad""")
+        correcciones["pendientes"] = c.rowcount
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT set_config('lock_timeout', %s, true)", (RETENCION_LOCK_TIMEOUT,))
+        c.execute("LOCK TABLE usuarios IN SHARE MODE")
+        # usuarios no guarda la fecha de alta: se corrige el total imputando la diferencia al día de hoy
+        c.execute("""SELECT (SELECT COUNT(*) FROM usuarios) - 
+                            (SELECT COALESCE(SUM(cantidad), 0) FROM estadisticas WHERE estado = 'usuario')""")
+        diferencia = c.fetchone()[0]
+        if diferencia:
+            c.execute("SELECT sumar_estadistica('usuario', 0, now(), %s)", (diferencia,))
+        correcciones["usuarios"] = int(diferencia != 0)
+        c.execute("DELETE FROM estadisticas WHERE cantidad = 0")
+    if any(correcciones.values()):
+        logger.warning(f"Estadísticas corregidas en la reconciliación: {correcciones}")
+    return correcciones
+
+# Resumen diario para las gráficas: gestiones por admin y tiempo de resolución (fecha_gestion menos la
+# fecha de la solicitud) agrupado en tramos. Cada pasada recalcula solo los últimos GRAFICAS_RECALCULO_DIAS
+# días (los anteriores ya no cambian); con la tabla vacía se calcula todo lo que sigue en PostgreSQL
+TRAMOS_RESOLUCION = [("< 1 h", 1), ("1-6 h", 6), ("6-24 h", 24), ("1-3 d", 72), ("3-7 d", 168), ("> 7 d", None)]
+SQL_TRAMO_RESOLUCION = "CASE " + " ".join(
+    f"WHEN fecha_gestion - fecha_solicitud < interval '{horas} hours' THEN '{tramo}'"
+    for tramo, horas in TRAMOS_RESOLUCION if horas) + f" ELSE '{TRAMOS_RESOLUCION[-1][0]}' END"
+
+def actualizar_resumen_diario():
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT EXISTS (SELECT 1 FROM resumen_diario)")
+        desde = inicio_dia(datetime.now(SPAIN_TZ) - timedelta(days=GRAFICAS_RECALCULO_DIAS)) if c.fetchone()[0] else None
+        parametros = {"desde": desde, "dia": desde.date() if desde else None}
+        c.execute("DELETE FROM resumen_diario WHERE %(dia)s::DATE IS NULL OR dia >= %(dia)s", parametros)
+        c.execute(f"""INSERT INTO resumen_diario (dimension, dia, clave, cantidad) 
+                      SELECT 'admin', (fecha_gestion AT TIME ZONE 'Europe/Madrid')::date, admin_username, COUNT(*) 
+                      FROM historial_solicitudes 
+                      WHERE admin_username IS NOT NULL AND (%(desde)s::TIMESTAMPTZ IS NULL OR fecha_gestion >= %(desde)s) 
+                      GROUP BY 2, 3 
+                      UNION ALL 
+                      SELECT 'resolucion', (fecha_gestion AT TIME ZONE 'Europe/Madrid')::date, {SQL_TRAMO_RESOLUCION}, COUNT(*) 
+                      FROM historial_solicitudes 
+                      WHERE fecha_solicitud IS NOT NULL AND (%(desde)s::TIMESTAMPTZ IS NULL OR fecha_gestion >= %(desde)s) 
+                      GROUP BY 2, 3""", parametros)
+        return {"filas": c.rowcount, "desde": parametros["dia"].isoformat() if desde else None}
+
+def inicio_dia(fecha):
+    return SPAIN_TZ.localize(datetime(fecha.year, fecha.month, fecha.day))
+
+# Tareas programadas con horario tipo cron (minuto hora día mes día_semana, hora de Madrid). Todos los
+# procesos arrancan el ejecutor, pero solo el que obtiene el advisory lock JOBS_LOCK_ID en una conexión
+# dedicada las lanza: cada tarea se ejecuta una vez en todo el despliegue. Si el líder cae, su conexión
+# se cierra, el lock se libera y otro proceso toma el relevo en menos de JOBS_LEADER_RETRY segundos
+class Cron:
+    RANGOS = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]  # Día de la semana: 0 y 7 son domingo
+    MESES = {nombre: i for i, nombre in enumerate(["jan", "feb", "mar", "apr", "may", "jun",
+                                                   "jul", "aug", "sep", "oct", "nov", "dec"], 1)}
+    DIAS_SEMANA = {nombre: i for i, nombre in enumerate(["sun", "mon", "tue", "wed", "thu", "fri", "sat"])}
+
+    def __init__(self, expresion):
+        campos = expresion.split()
+        if len(campos) != 5:
+            raise ValueError(f"Expresión cron inválida: {expresion}")
+        self.expresion = expresion
+        nombres = [{}, {}, {}, self.MESES, self.DIAS_SEMANA]
+        self.minutos, self.horas, self.dias, self.meses, self.dias_semana = (
+            self._campo(campo, *rango, nombres=n) for campo, rango, n in zip(campos, self.RANGOS, nombres))
+        if 7 in self.dias_semana:
+            self.dias_semana = (self.dias_semana - {7}) | {0}
+        self.dia_libre, self.semana_libre = campos[2] == '*', campos[4] == '*'
+
+    @staticmethod
+    def _campo(texto, minimo, maximo, nombres):
+        valores = set()
+        valor = lambda v: nombres[v.lower()] if v.lower() in nombres else int(v)  # "mon", "jan"... o número
+        for parte in texto.split(','):
+            rango, _, paso = parte.partition('/')
+            paso = int(paso) if paso else 1
+            if rango == '*':
+                inicio, fin = minimo, maximo
+            elif '-' in rango:
+                inicio, fin = map(valor, rango.split('-'))
+                if fin == 0 and maximo == 7:
+                    fin = 7  # "fri-sun": el domingo al final de un rango cuenta como 7
+            else:
+                inicio = valor(rango)
+                fin = maximo if paso > 1 else inicio
+            if inicio < minimo or fin > maximo or inicio > fin or paso < 1:
+                raise ValueError(f"Campo cron fuera de rango: {parte}")
+            valores.update(range(inicio, fin + 1, paso))
+        return valores
+
+    def _dia_valido(self, fecha):
+        # Como en cron: si se restringen día del mes y día de la semana, basta con que se cumpla uno
+        dia, semana = fecha.day in self.dias, (fecha.weekday() + 1) % 7 in self.dias_semana
+        if self.dia_libre:
+            return semana
+        if self.semana_libre:
+            return dia
+        return dia or semana
+
+    def siguiente(self, desde):
+        t = desde.astimezone(SPAIN_TZ).replace(tzinfo=None, second=0, microsecond=0) + timedelta(minutes=1)
+        limite = t + timedelta(days=366 * 5)
+        while t < limite:
+            if t.month not in self.meses:
+                t = (t.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._dia_valido(t):
+                t = t.replace(hour=0, minute=0) + timedelta(days=1)
+            elif t.hour not in self.horas:
+                t = t.replace(minute=0) + timedelta(hours=1)
+            elif t.minute not in self.minutos:
+                t += timedelta(minutes=1)
+            else:
+                return SPAIN_TZ.localize(t)
+        raise ValueError(f"La expresión cron {self.expresion} no tiene próximas ejecuciones")
+
+CANAL_TAREAS = "tareas"  # Aviso al líder de que hay una ejecución manual pedida en jobs_ejecuciones
+TAREAS = {}
+_tareas_en_curso = set()
+_tareas_lock = threading.Lock()
+
+def registrar_tarea(nombre, cron, funcion, jitter=0):
+    TAREAS[nombre] = {"cron": Cron(cron), "funcion": funcion, "jitter": jitter}
+
+def registrar_ejecucion(nombre, fecha, duracion, resultado, detalle):
+    try:
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            c.execute("""INSERT INTO jobs_ejecuciones AS j 
+                         (nombre, ultima_ejecucion, duracion, resultado, detalle, ejecutado_por, ejecuciones, errores) 
+                         VALUES (%s, %s, %s, %s, %s, %s, 1, %s)
+                         ON CONFLICT (nombre) DO UPDATE SET ultima_ejecucion = EXCLUDED.ultima_ejecucion, 
+                         duracion = EXCLUDED.duracion, resultado = EXCLUDED.resultado, detalle = EXCLUDED.detalle, 
+                         ejecutado_por = EXCLUDED.ejecutado_por, ejecuciones = j.ejecuciones + 1, 
+                         errores = j.errores + EXCLUDED.errores""",
+                      (nombre, fecha, duracion, resultado, detalle, f"{socket.gethostname()}:{os.getpid()}",
+                       1 if resultado == "error" else 0))
+    except Exception as e:
+        logger.error(f"Error en registrar_ejecucion: {str(e)}")
+
+def get_jobs_estado():
+    try:
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            c.execute("SELECT nombre, ultima_ejecucion, duracion, resultado, detalle, ejecutado_por, ejecuciones, errores FROM jobs_ejecuciones")
+            return {row["nombre"]: {**dict(row), "ultima_ejecucion": row["ultima_ejecucion"].isoformat() if row["ultima_ejecucion"] else None}
+                    for row in c.fetchall()}
+    except Exception as e:
+        logger.error(f"Error en get_jobs_estado: {str(e)}")
+        return {}
+
+def ejecutar_tarea(nombre):
+    fecha, inicio = datetime.now(SPAIN_TZ), time.monotonic()
+    resultado, detalle = "ok", None
+    try:
+        salida = TAREAS[nombre]["funcion"]()
+        detalle = None if salida is None else str(salida)
+    except Exception as e:
+        resultado, detalle = "error", str(e)
+        logger.error(f"Error en la tarea {nombre}: {str(e)}")
+    finally:
+        with _tareas_lock:
+            _tareas_en_curso.discard(nombre)
+    registrar_ejecucion(nombre, fecha, time.monotonic() - inicio, resultado, detalle)
+    logger.info(f"Tarea {nombre} terminada ({resultado}) en {time.monotonic() - inicio:.1f} s")
+
+def lanzar_tarea(nombre):
+    with _tareas_lock:
+        if nombre in _tareas_en_curso:  # La ejecución anterior sigue en marcha: no se solapan
+            logger.warning(f"Tarea {nombre} omitida: la ejecución anterior no ha terminado")
+            return
+        _tareas_en_curso.add(nombre)
+    threading.Thread(target=ejecutar_tarea, args=(nombre,), daemon=True).start()
+
+def solicitar_tarea(nombre):
+    # Ejecución manual (p. ej. 🧹 Limpiar): la pide cualquier worker, pero la lanza el líder, así que no se
+    # solapa con la ejecución programada de la misma tarea en otro proceso
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute("""INSERT INTO jobs_ejecuciones (nombre, solicitada_en) VALUES (%s, now()) 
+                     ON CONFLICT (nombre) DO UPDATE SET solicitada_en = EXCLUDED.solicitada_en""", (nombre,))
+        c.execute("SELECT pg_notify(%s, %s)", (CANAL_TAREAS, nombre))
+
+def atender_solicitudes(c, segundos):
+    # Espera hasta `segundos` o hasta un aviso de CANAL_TAREAS y lanza las ejecuciones manuales pendientes;
+    # la consulta comprueba además que la conexión que sostiene el liderazgo sigue viva
+    if select.select([c.connection], [], [], segundos) != ([], [], []):
+        c.connection.poll()
+        c.connection.notifies.clear()
+    c.execute("UPDATE jobs_ejecuciones SET solicitada_en = NULL WHERE solicitada_en IS NOT NULL RETURNING nombre")
+    for (nombre,) in c.fetchall():
+        if nombre in TAREAS:
+            logger.info(f"Ejecución manual de la tarea {nombre}")
+            lanzar_tarea(nombre)
+
+def _planificar(tarea, desde):
+    return tarea["cron"].siguiente(desde) + timedelta(seconds=random.uniform(0, tarea["jitter"]))
+
+def coordinar_tareas(c):
+    # Se parte de la última ejecución registrada: una ejecución perdida mientras no había líder se lanza al momento
+    ahora = datetime.now(SPAIN_TZ)
+    ultimas = {nombre: datetime.fromisoformat(info["ultima_ejecucion"]) for nombre, info in get_jobs_estado().items()
+               if info["ultima_ejecucion"]}
+    proximas = {nombre: _planificar(tarea, ultimas.get(nombre, ahora)) for nombre, tarea in TAREAS.items()}
+    while proximas:
+        nombre = min(proximas, key=proximas.get)
+        espera = (proximas[nombre] - datetime.now(SPAIN_TZ)).total_seconds()
+        if espera > 0:
+            atender_solicitudes(c, min(espera, 30))
+            continue
+        lanzar_tarea(nombre)
+        proximas[nombre] = _planificar(TAREAS[nombre], datetime.now(SPAIN_TZ))
     while True:
-        clean_database()
-        time.sleep(86400)  # Limpieza cada 24 horas
+        atender_solicitudes(c, 30)
+
+def ejecutor_tareas():
+    while True:
+        conn = None
+        try:
+            conn = psycopg2.connect(DATABASE_URL, connect_timeout=DB_CONNECT_TIMEOUT)
+            conn.autocommit = True
+            c = conn.cursor()
+            while True:
+                c.execute("SELECT pg_try_advisory_lock(%s)", (JOBS_LOCK_ID,))
+                if c.fetchone()[0]:
+                    break
+                time.sleep(JOBS_LEADER_RETRY)
+            c.execute(f"LISTEN {CANAL_TAREAS}")
+            logger.info(f"Proceso {os.getpid()} elegido para ejecutar las tareas programadas: {', '.join(TAREAS)}")
+            coordinar_tareas(c)
+        except Exception as e:
+            logger.error(f"Error en ejecutor_tareas: {str(e)}")
+            time.sleep(5)
+        finally:
+            if conn is not None:
+                conn.close()  # Cerrar la conexión libera el lock y permite que otro proceso tome el relevo
+
+registrar_tarea("limpieza", os.getenv('JOB_LIMPIEZA_CRON', '30 4 * * *'), clean_database, jitter=120)
+registrar_tarea("caducidad_estado", os.getenv('JOB_CADUCIDAD_CRON', '*/10 * * * *'), purgar_estado_caducado, jitter=30)
+registrar_tarea("historial", os.getenv('JOB_HISTORIAL_CRON', '15 4 * * *'), mantener_historial, jitter=120)
+registrar_tarea("estadisticas", os.getenv('JOB_ESTADISTICAS_CRON', '0 5 * * *'), reconciliar_estadisticas, jitter=120)
+registrar_tarea("resumen_diario", os.getenv('JOB_RESUMEN_CRON', '*/15 * * * *'), actualizar_resumen_diario, jitter=60)
+
+ITEMS_PER_PAGE = 5
+CONTEO_EXACTO_MAX = 50000  # Por encima de este tamaño estimado se usa la estadística del planificador
+
+def contar_filas(c, tabla):
+    # En una tabla particionada la estimación es la suma de la de sus particiones
+    c.execute("""SELECT SUM(GREATEST(reltuples, 0))::BIGINT FROM pg_class 
+                 WHERE oid = %s::regclass OR oid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = %s::regclass)""",
+              (tabla, tabla))
+    estimado = c.fetchone()[0]
+    if estimado is not None and estimado > CONTEO_EXACTO_MAX:
+        return estimado
+    c.execute(f"SELECT COUNT(*) FROM {tabla}")
+    return c.fetchone()[0]
+
+# Paginación por clave (keyset) sobre ticket_number: direccion "a" = página posterior a ticket,
+# "b" = página anterior a ticket, None = primera página
+def get_pagina_tickets(tabla, columnas, descendente=False, direccion=None, ticket=None):
+    avanza, retrocede = ("<", ">") if descendente else (">", "<")
+    orden, orden_inverso = ("DESC", "ASC") if descendente else ("ASC", "DESC")
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        filas = []
+        if direccion == "b":
+            c.execute(f"SELECT {columnas} FROM {tabla} WHERE ticket_number {retrocede} %s ORDER BY ticket_number {orden_inverso} LIMIT %s",
+                      (ticket, ITEMS_PER_PAGE))
+            filas = c.fetchall()[::-1]
+        elif direccion == "a":
+            c.execute(f"SELECT {columnas} FROM {tabla} WHERE ticket_number {avanza} %s ORDER BY ticket_number {orden} LIMIT %s",
+                      (ticket, ITEMS_PER_PAGE))
+            filas = c.fetchall()
+        if not filas:  # Primera página, o la página pedida se ha vaciado mientras tanto
+            c.execute(f"SELECT {columnas} FROM {tabla} ORDER BY ticket_number {orden} LIMIT %s", (ITEMS_PER_PAGE,))
+            filas = c.fetchall()
+        hay_anterior = hay_siguiente = False
+        if filas:
+            c.execute(f"SELECT EXISTS (SELECT 1 FROM {tabla} WHERE ticket_number {retrocede} %s), "
+                      f"EXISTS (SELECT 1 FROM {tabla} WHERE ticket_number {avanza} %s)",
+                      (filas[0][0], filas[-1][0]))
+            hay_anterior, hay_siguiente = c.fetchone()
+        total = contar_filas(c, tabla)
+    return {"filas": filas, "total": total, "anterior": hay_anterior, "siguiente": hay_siguiente}
+
+def get_pagina_pendientes(direccion=None, ticket=None):
+    return get_pagina_tickets("peticiones_registradas", "ticket_number, username, chat_title",
+                              descendente=False, direccion=direccion, ticket=ticket)
+
+# Lectura del archivo frío. Cada proceso guarda en memoria los últimos HISTORIAL_ARCHIVO_CACHE ficheros
+# leídos (filas por ticket descendente, una por ticket); un fichero que ha crecido desde entonces se relee
+_archivo_cache = OrderedDict()
+_archivo_cache_lock = threading.Lock()
+
+def leer_archivo_historial(fichero):
+    ruta = os.path.join(HISTORIAL_ARCHIVO_DIR, fichero)
+    try:
+        tamano = os.path.getsize(ruta)
+    except OSError:
+        logger.warning(f"Fichero del historial archivado no disponible: {ruta}")
+        return []
+    with _archivo_cache_lock:
+        cacheado = _archivo_cache.get(fichero)
+        if cacheado and cacheado[0] == tamano:
+            _archivo_cache.move_to_end(fichero)
+            return cacheado[1]
+    por_ticket = {}
+    with gzip.open(ruta, "rt", encoding="utf-8") as f:
+        for linea in f:
+            registro = json.loads(linea)
+            for columna in ("fecha_gestion", "fecha_solicitud"):
+                if registro.get(columna):
+                    registro[columna] = datetime.fromisoformat(registro[columna])
+            por_ticket[registro["ticket_number"]] = registro
+    filas = sorted(por_ticket.values(), key=lambda registro: registro["ticket_number"], reverse=True)
+    with _archivo_cache_lock:
+        _archivo_cache[fichero] = (tamano, filas)
+        _archivo_cache.move_to_end(fichero)
+        while len(_archivo_cache) > HISTORIAL_ARCHIVO_CACHE:
+            _archivo_cache.popitem(last=False)
+    return filas
+
+def buscar_ticket_archivado(c, ticket_number):
+    c.execute("SELECT fichero FROM historial_archivo WHERE ticket_min <= %s AND ticket_max >= %s", (ticket_number, ticket_number))
+    for row in c.fetchall():
+        for registro in leer_archivo_historial(row["fichero"]):
+            if registro["ticket_number"] == ticket_number:
+                return {k: v for k, v in registro.items() if k != "ticket_number"}
+    return None
+
+def get_filas_archivadas(c, columnas, mayor_que, menor_que, limite, descendente):
+    # Tickets archivados en el intervalo abierto (mayor_que, menor_que); None = sin cota por ese lado
+    c.execute(f"""SELECT fichero, ticket_min, ticket_max FROM historial_archivo 
+                  WHERE (%(mayor)s::BIGINT IS NULL OR ticket_max > %(mayor)s) AND (%(menor)s::BIGINT IS NULL OR ticket_min < %(menor)s) 
+                  ORDER BY {"ticket_max DESC" if descendente else "ticket_min ASC"}""",
+              {"mayor": mayor_que, "menor": menor_que})
+    filas = []
+    for fichero, ticket_min, ticket_max in c.fetchall():
+        # Los meses pueden solaparse en tickets: se para cuando ningún fichero restante puede mejorar la página
+        if len(filas) >= limite and (ticket_max <= filas[limite - 1][0] if descendente else ticket_min >= filas[limite - 1][0]):
+            break
+        filas += [tuple(registro[columna] for columna in columnas) for registro in leer_archivo_historial(fichero)
+                  if (mayor_que is None or registro["ticket_number"] > mayor_que)
+                  and (menor_que is None or registro["ticket_number"] < menor_que)]
+        filas.sort(key=lambda fila: fila[0], reverse=descendente)
+    return filas[:limite]
+
+# Página del historial (ticket descendente) combinando las filas vivas con las archivadas: mientras la
+# página cabe entera en PostgreSQL no se abre ningún fichero; al pasar de la ventana viva se completa
+# con el archivo, y si un ticket está en ambos sitios prevalece la versión viva
+def get_pagina_historial(direccion=None, ticket=None):
+    columnas = ["ticket_number", "username", "message_text", "chat_title", "estado", "fecha_gestion", "admin_username"]
+    seleccion = ", ".join(columnas)
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        filas = []
+        if direccion == "b":
+            c.execute(f"SELECT {seleccion} FROM historial_solicitudes WHERE ticket_number > %s ORDER BY ticket_number ASC LIMIT %s",
+                      (ticket, ITEMS_PER_PAGE))
+            vivas = [tuple(fila) for fila in c.fetchall()]
+            tope = vivas[-1][0] if len(vivas) == ITEMS_PER_PAGE else None
+            archivadas = get_filas_archivadas(c, columnas, ticket, tope, ITEMS_PER_PAGE, descendente=False)
+            filas = sorted({fila[0]: fila for fila in archivadas + vivas}.values())[:ITEMS_PER_PAGE][::-1]
+        elif direccion == "a":
+            c.execute(f"SELECT {seleccion} FROM historial_solicitudes WHERE ticket_number < %s ORDER BY ticket_number DESC LIMIT %s",
+                      (ticket, ITEMS_PER_PAGE))
+            vivas = [tuple(fila) for fila in c.fetchall()]
+            suelo = vivas[-1][0] if len(vivas) == ITEMS_PER_PAGE else None
+            archivadas = get_filas_archivadas(c, columnas, suelo, ticket, ITEMS_PER_PAGE, descendente=True)
+            filas = sorted({fila[0]: fila for fila in archivadas + vivas}.values(), reverse=True)[:ITEMS_PER_PAGE]
+        if not filas:  # Primera página, o la página pedida se ha vaciado mientras tanto
+            c.execute(f"SELECT {seleccion} FROM historial_solicitudes ORDER BY ticket_number DESC LIMIT %s", (ITEMS_PER_PAGE,))
+            vivas = [tuple(fila) for fila in c.fetchall()]
+            suelo = vivas[-1][0] if len(vivas) == ITEMS_PER_PAGE else None
+            archivadas = get_filas_archivadas(c, columnas, suelo, None, ITEMS_PER_PAGE, descendente=True)
+            filas = sorted({fila[0]: fila for fila in archivadas + vivas}.values(), reverse=True)[:ITEMS_PER_PAGE]
+        hay_anterior = hay_siguiente = False
+        if filas:
+            c.execute("""SELECT EXISTS (SELECT 1 FROM historial_solicitudes WHERE ticket_number > %(primero)s) 
+                                OR EXISTS (SELECT 1 FROM historial_archivo WHERE ticket_max > %(primero)s), 
+                                EXISTS (SELECT 1 FROM historial_solicitudes WHERE ticket_number < %(ultimo)s) 
+                                OR EXISTS (SELECT 1 FROM historial_archivo WHERE ticket_min < %(ultimo)s)""",
+                      {"primero": filas[0][0], "ultimo": filas[-1][0]})
+            hay_anterior, hay_siguiente = c.fetchone()
+        total = contar_filas(c, "historial_solicitudes") + contar_archivadas(c)
+    return {"filas": filas, "total": total, "anterior": hay_anterior, "siguiente": hay_siguiente}
+
+def contar_archivadas(c):
+    c.execute("SELECT COALESCE(SUM(filas), 0) FROM historial_archivo")
+    return c.fetchone()[0]
+
+# Las pantallas de estadísticas leen los contadores de la tabla estadisticas (migración 12): el coste
+# depende del número de combinaciones estado/grupo/día, no del tamaño del historial
+ESTADISTICAS_AUXILIARES = ("pendiente", "usuario", "recibida")  # Contadores que no son estados del historial
+def get_totales_estadisticas(c):
+    c.execute("SELECT estado, SUM(cantidad)::BIGINT FROM estadisticas GROUP BY estado")
+    return {estado: cantidad for estado, cantidad in c.fetchall() if cantidad}
+
+def get_estados_historial(c):
+    return {estado: cantidad for estado, cantidad in get_totales_estadisticas(c).items() if estado not in ESTADISTICAS_AUXILIARES}
 
 def get_advanced_stats():
     try:
         with get_db_connection() as conn:
             c = conn.cursor()
-            c.execute("SELECT COUNT(*) FROM peticiones_registradas")
-            pendientes = c.fetchone()[0]
-            c.execute("SELECT COUNT(*) FROM historial_solicitudes")
-            gestionadas = c.fetchone()[0]
-            c.execute("SELECT COUNT(*) FROM usuarios")
-            usuarios = c.fetchone()[0]
-            return {"pendientes": pendientes, "gestionadas": gestionadas, "usuarios": usuarios}
+            totales = get_totales_estadisticas(c)
+            gestionadas = sum(cantidad for estado, cantidad in totales.items() if estado not in ESTADISTICAS_AUXILIARES)
+            return {"pendientes": totales.get("pendiente", 0), "gestionadas": gestionadas, "usuarios": totales.get("usuario", 0)}
     except Exception as e:
         logger.error(f"Error en get_advanced_stats: {str(e)}")
         return {"pendientes": 0, "gestionadas": 0, "usuarios": 0}
@@ -311,12 +2284,36 @@ CANALES_PETICIONES = {
     -1001918569531: {"chat_id": -1001918569531, "thread_id": 228298},
     -1002570010967: {"chat_id": -1002570010967, "thread_id": 10},
 }
-VALID_REQUEST_COMMANDS = [
-    '/solicito', '/solícito', '/SOLÍCITO', '/SOLICITO', '/Solicito', '/Solícito',
-    '#solicito', '#solícito', '#SOLÍCITO', '#SOLICITO', '#Solicito', '#Solícito',
-    '/petición', '/peticion', '/PETICIÓN', '/PETICION', '/Petición', '/Peticion',
-    '#petición', '#peticion', '#PETICIÓN', '#PETICION', '#Petición', '#Peticion',
-]
+# Vocabulario de solicitudes: palabras base y prefijos de comando. Las variantes de mayúsculas y
+# tildes (/SOLICITÓ, #PeTiCiOn...) las cubre el clasificador, no hace falta enumerarlas
+PALABRAS_SOLICITUD = [p.strip() for p in os.getenv('REQUEST_COMMANDS', 'solicito,petición').split(',') if p.strip()]
+PREFIJOS_SOLICITUD = os.getenv('REQUEST_PREFIXES', '/#')
+VALID_REQUEST_COMMANDS = [f"{prefijo}{palabra}" for palabra in PALABRAS_SOLICITUD for prefijo in PREFIJOS_SOLICITUD]
+
+def _patron_palabra(palabra):
+    sin_tildes = ''.join(c for c in unicodedata.normalize('NFD', palabra.lower()) if not unicodedata.combining(c))
+    variantes = {'a': '[aá]', 'e': '[eé]', 'i': '[ií]', 'o': '[oó]', 'u': '[uúü]', 'n': '[nñ]'}
+    return ''.join(variantes.get(c, re.escape(c)) for c in sin_tildes)
+
+# Se busca sobre el texto en minúsculas y sin grupo opcional delante: así el motor de re descarta
+# rápido las posiciones que no empiezan por la primera letra de alguna palabra. El prefijo (/ o #)
+# se comprueba mirando el carácter anterior a cada coincidencia
+PATRON_SOLICITUD = re.compile('|'.join(_patron_palabra(p) for p in PALABRAS_SOLICITUD))
+
+def clasificar_mensaje(texto):
+    if not texto:
+        return None
+    if not texto.isascii() and not unicodedata.is_normalized('NFC', texto):
+        texto = unicodedata.normalize('NFC', texto)  # Tildes compuestas (o + ◌́) como las escriben algunos teclados
+    texto = texto.lower()
+    casi = False
+    for coincidencia in PATRON_SOLICITUD.finditer(texto):
+        inicio = coincidencia.start()
+        if inicio and texto[inicio - 1] in PREFIJOS_SOLICITUD:
+            return "valida"
+        casi = True
+    return "casi" if casi else None
+
 frases_agradecimiento = [
     "Agradecemos tu paciencia y confianza. 😊",
     "Gracias por utilizar nuestros servicios. 🤝",
@@ -331,37 +2328,528 @@ ping_respuestas = [
 ]
 
 # Funciones de utilidad
-def escape_markdown(text, preserve_username=False):
+# Todos los mensajes se envían con parse_mode='Markdown' (v1): solo _ * ` [ tienen significado y
+# admiten la barra invertida; escapar cualquier otro carácter deja la barra visible en el mensaje
+TABLA_MARKDOWN = str.maketrans({c: '\\' + c for c in '_*`['})
+
+def escape_markdown(text):
     if not text:
         return text
-    if preserve_username and text.startswith('@'):
-        return ''.join(['\\' + c if c in '_*[]()~`>#+-=|{}.!' else c for c in text])
-    characters_to_escape = ['_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|', '{', '}', '.', '!']
-    for char in characters_to_escape:
-        text = text.replace(char, f'\\{char}')
-    return text
+    return text.translate(TABLA_MARKDOWN)
+
+# Plantilla precompilada: el texto se trocea una sola vez y al renderizar solo se escapan los campos
+# marcados con !e ("{username!e}"); el resto se formatea tal cual (fechas con "{fecha:%d/%m/%Y}")
+class Plantilla:
+    def __init__(self, texto):
+        self.segmentos = [(literal, campo, conversion == 'e', formato)
+                          for literal, campo, formato, conversion in string.Formatter().parse(texto)]
+
+    def render(self, **campos):
+        partes = []
+        for literal, campo, escapar, formato in self.segmentos:
+            partes.append(literal)
+            if campo is None:
+                continue
+            valor = campos[campo]
+            valor = format(valor, formato) if formato else str(valor)
+            partes.append(escape_markdown(valor) if escapar else valor)
+        return ''.join(partes)
+
+PLANTILLA_DESTINO = Plantilla(
+    "📩 *Nueva solicitud recibida* ✅\n"
+    "👤 *Usuario:* {username!e} (ID: {user_id})\n"
+    "🎟️ *Ticket:* #{ticket}\n"
+    "📊 *Petición:* {count}/{limite}\n"
+    "✉️ *Mensaje:* {message_text!e}\n"
+    "📍 *Grupo:* {chat_title!e}\n"
+    "⏰ *Fecha:* {fecha:%d/%m/%Y %H:%M:%S}\n"
+    "📎 *Adjunto:* {adjunto}\n"
+    "🤝 *Bot de Entreshijos*"
+)
+PLANTILLA_DUPLICADO = Plantilla("\n🔁 *Posible duplicado de:* Ticket #{ticket} ({estado}, {parecido:.0%} parecido)")
+PLANTILLA_CONFIRMACION = Plantilla(
+    "✅ *Solicitud registrada con éxito* 😊\n"
+    "Hola {username!e}, tu solicitud (Ticket #{ticket}) ha sido recibida.\n"
+    "📌 *Detalles:*\n"
+    "🆔 ID: {user_id}\n"
+    "📍 Grupo: {chat_title!e}\n"
+    "⏰ Fecha: {fecha:%d/%m/%Y %H:%M:%S}\n"
+    "✉️ Mensaje: {message_text!e}\n"
+    "📎 Adjunto: {adjunto}\n"
+    "⌛ Será procesada a la mayor brevedad posible. Gracias por tu paciencia."
+)
+PLANTILLA_DETALLE = Plantilla(
+    "📋 *Solicitud #{ticket}* ✅\n"
+    "👤 Usuario: {username!e}\n"
+    "✉️ Mensaje: {message_text!e}\n"
+    "📍 Grupo: {chat_title!e}\n"
+    "⏰ Fecha: {fecha:%d/%m/%Y %H:%M:%S}\n"
+    "📎 Adjunto: {adjunto}\n"
+    "Selecciona una acción:"
+)
+PLANTILLA_HISTORIAL = Plantilla(
+    "🎟️ *Ticket #{ticket}*\n"
+    "👤 Usuario: {username!e}\n"
+    "✉️ Mensaje: {message_text!e}\n"
+    "📍 Grupo: {chat_title!e}\n"
+    "⏰ Gestionada: {fecha:%d/%m/%Y %H:%M:%S}\n"
+    "👥 Admin: {admin!e}\n"
+    "📌 Estado: {estado}\n"
+)
+PLANTILLA_APROBADA_URL = Plantilla(
+    "✅ {username!e}, tu solicitud (Ticket #{ticket}) \"{message_text!e}\" ha sido aprobada por el *Equipo de EntresHijos*. "
+    "Aquí tienes el enlace: {url!e}\nGracias por tu paciencia! 😊"
+)
+PLANTILLA_APROBADA = Plantilla(
+    "✅ {username!e}, tu solicitud (Ticket #{ticket}) \"{message_text!e}\" ha sido aprobada por el *Equipo de EntresHijos*.\n{frase}"
+)
+PLANTILLA_RECHAZADA = Plantilla(
+    "❌ {username!e}, tu solicitud (Ticket #{ticket}) \"{message_text!e}\" ha sido rechazada por el *Equipo de EntresHijos*. "
+    "Contacta a un administrador para más detalles."
+)
+ESTADOS_HISTORIAL = {
+    "subido": "✅ Aprobada",
+    "denegado": "❌ Rechazada",
+    "eliminado": "🗑️ Eliminada",
+    "notificado": "📢 Respondida",
+    "limite_excedido": "⛔ Límite excedido"
+}
+
+# Grupos ya registrados por este proceso (chat_id -> título): solo se escribe en la base de datos
+# la primera vez que se ve un grupo o cuando cambia su título
+grupos_vistos = {}
 
 def update_grupos_estados(chat_id, title=None):
     if str(chat_id) == GROUP_DESTINO or chat_id not in GRUPOS_PREDEFINIDOS:
         return
-    grupos = get_grupos_estados()
-    if chat_id not in grupos:
-        set_grupo_estado(chat_id, title if title else f"Grupo {chat_id}")
-    elif title and grupos[chat_id]["title"] == f"Grupo {chat_id}":
-        set_grupo_estado(chat_id, title)
-    logger.info(f"Grupo registrado/actualizado: {chat_id} - {title or grupos.get(chat_id, {}).get('title')}")
+    title = title or f"Grupo {chat_id}"
+    if grupos_vistos.get(chat_id) == title:
+        return
+    if registrar_grupo(chat_id, title):
+        grupos_vistos[chat_id] = title
+        logger.info(f"Grupo registrado/actualizado: {chat_id} - {title}")
 
 def get_spain_time():
     return datetime.now(SPAIN_TZ).strftime('%d/%m/%Y %H:%M:%S')
 
-def check_menu_timeout():
+def parse_pagina(data):
+    # "pend_page_3" -> (3, None, None); "pend_page_3_a120" -> (3, "a", 120)
+    partes = data.split("_")
+    page = int(partes[2])
+    if len(partes) > 3 and partes[3][:1] in ("a", "b"):
+        return page, partes[3][0], int(partes[3][1:])
+    return page, None, None
+
+def botones_pagina(prefijo, page, pagina):
+    nav_buttons = [
+        InlineKeyboardButton("↩️ Menú", callback_data="menu_principal"),
+        InlineKeyboardButton("❌ Cerrar", callback_data="menu_close")
+    ]
+    filas = pagina["filas"]
+    if pagina["anterior"]:
+        nav_buttons.insert(0, InlineKeyboardButton("⬅️ Anterior", callback_data=f"{prefijo}_page_{page-1}_b{filas[0][0]}"))
+    if pagina["siguiente"]:
+        nav_buttons.append(InlineKeyboardButton("Siguiente ➡️", callback_data=f"{prefijo}_page_{page+1}_a{filas[-1][0]}"))
+    return nav_buttons
+
+def total_paginas(page, pagina):
+    if not pagina["siguiente"]:
+        return page
+    return max(page + 1, (pagina["total"] + ITEMS_PER_PAGE - 1) // ITEMS_PER_PAGE)
+
+def render_pendientes(page=1, direccion=None, ticket=None):
+    pagina = get_pagina_pendientes(direccion, ticket)
+    if not pagina["filas"]:
+        return None, None
+    if not pagina["anterior"]:
+        page = 1
+    keyboard = [[InlineKeyboardButton(f"#{ticket} - {username} ({chat_title})",
+                                      callback_data=f"pend_{ticket}")] for ticket, username, chat_title in pagina["filas"]]
+    keyboard.append(botones_pagina("pend", page, pagina))
+    texto = f"📋 *Solicitudes Pendientes (Página {page}/{total_paginas(page, pagina)})* ✅\nSelecciona una solicitud:"
+    return texto, InlineKeyboardMarkup(keyboard)
+
+def render_historial(page=1, direccion=None, ticket=None):
+    pagina = get_pagina_historial(direccion, ticket)
+    if not pagina["filas"]:
+        return None, None
+    if not pagina["anterior"]:
+        page = 1
+    historial = [
+        PLANTILLA_HISTORIAL.render(ticket=ticket, username=username, message_text=message_text, chat_title=chat_title,
+                                   fecha=fecha_gestion, admin=admin_username,
+                                   estado=ESTADOS_HISTORIAL.get(estado, "🔄 Estado desconocido"))
+        for ticket, username, message_text, chat_title, estado, fecha_gestion, admin_username in pagina["filas"]
+    ]
+    texto = f"📜 *Historial de Solicitudes Gestionadas (Página {page}/{total_paginas(page, pagina)})* ✅\n\n" + "\n".join(historial)
+    return texto, InlineKeyboardMarkup([botones_pagina("hist", page, pagina)])
+
+# Búsqueda de tickets pendientes y del historial vivo (lo archivado no se indexa). Sintaxis de /buscar:
+# texto libre, @usuario, #ticket, grupo:nombre, desde:dd/mm/aaaa, hasta:dd/mm/aaaa y en:pendientes|historial.
+# Los resultados se guardan en el estado compartido y las páginas se sirven desde ahí sin repetir la consulta
+busquedas = EstadoCompartido("busqueda", MENU_TIMEOUT)  # clave aleatoria -> consulta y resultados
+busquedas_en_espera = EstadoCompartido("busqueda_espera", MENU_TIMEOUT)  # admin que pulsó 🔎 Buscar -> True
+# Copia en memoria de busquedas_en_espera para no leer la base de datos con cada texto del grupo de administración:
+# user_id -> caducidad (monotonic), o None si algún worker ha tocado su clave y hay que confirmarla en la tabla
+_esperas_busqueda = {}
+_esperas_busqueda_lock = threading.Lock()
+_trigramas = {"disponible": None}
+
+def marcar_busqueda_en_espera(user_id):
+    busquedas_en_espera.set(user_id, True)
+    with _esperas_busqueda_lock:
+        _esperas_busqueda[user_id] = time.monotonic() + MENU_TIMEOUT
+
+def aviso_busqueda_en_espera(payload):
+    # Avisos de estado_compartido: si la clave es de un admin conocido se marca como dudosa; sin payload
+    # (reconexión del oyente) se han podido perder avisos y todas lo son
+    with _esperas_busqueda_lock:
+        if payload is None:
+            for user_id in _esperas_busqueda:
+                _esperas_busqueda[user_id] = None
+        elif payload.startswith(f"{busquedas_en_espera.espacio}:"):
+            try:
+                _esperas_busqueda[int(payload.split(':', 1)[1])] = None
+            except ValueError:
+                pass
+
+def tomar_busqueda_en_espera(user_id):
+    # True si el admin estaba esperando para buscar; la espera se consume
+    with _esperas_busqueda_lock:
+        if user_id not in _esperas_busqueda:
+            return False
+        caduca = _esperas_busqueda.pop(user_id)
+    if caduca is not None and caduca <= time.monotonic():
+        return False
+    if caduca is None and not busquedas_en_espera.get(user_id):
+        return False
+    busquedas_en_espera.delete(user_id)
+    return True
+
+PLANTILLA_BUSQUEDA = Plantilla("🔎 *Resultados para* {consulta!e} ({total}) (Página {page}/{paginas})\n\n")
+PLANTILLA_RESULTADO = Plantilla(
+    "🎟️ *#{ticket}* · {estado} · {fecha:%d/%m/%Y}\n"
+    "👤 {username!e} · 📍 {chat_title!e}\n"
+    "✉️ {mensaje!e}\n"
+)
+AYUDA_BUSQUEDA = (
+    "🔎 *Búsqueda de solicitudes* ✅\n"
+    "Escribe los términos a buscar. Puedes combinar:\n"
+    "• Texto libre (también comienzos de palabra y erratas)\n"
+    "• @usuario o #ticket\n"
+    "• grupo:nombre\n"
+    "• desde:dd/mm/aaaa y hasta:dd/mm/aaaa\n"
+    "• en:pendientes o en:historial\n"
+    "Ejemplo: /buscar dune @usuario desde:01/01/2025"
+)
+
+def tiene_trigramas(c):
+    if _trigramas["disponible"] is None:
+        c.execute("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')")
+        _trigramas["disponible"] = c.fetchone()[0]
+    return _trigramas["disponible"]
+
+def parsear_fecha_busqueda(valor):
+    for formato in ("%d/%m/%Y", "%Y-%m-%d", "%d-%m-%Y"):
+        try:
+            return SPAIN_TZ.localize(datetime.strptime(valor, formato))
+        except ValueError:
+            continue
+    raise ValueError(f"Fecha no válida: {valor} (usa dd/mm/aaaa)")
+
+def parsear_busqueda(texto):
+    filtros = {"texto": [], "usuario": None, "ticket": None, "grupo": None, "desde": None, "hasta": None, "en": None}
+    try:
+        terminos = shlex.split(texto)
+    except ValueError:  # Comillas sin cerrar: se toma tal cual
+        terminos = texto.split()
+    for termino in terminos:
+        clave, separador, valor = termino.partition(":")
+        clave = clave.lower()
+        if termino.startswith("@") and len(termino) > 1:
+            filtros["usuario"] = termino
+        elif termino.startswith("#") and termino[1:].isdigit():
+            filtros["ticket"] = int(termino[1:])
+        elif separador and valor and clave in ("desde", "hasta"):
+            filtros[clave] = parsear_fecha_busqueda(valor)
+        elif separador and valor and clave == "grupo":
+            filtros["grupo"] = valor
+        elif separador and clave == "en" and valor.lower() in ("pendientes", "historial"):
+            filtros["en"] = valor.lower()
+        else:
+            filtros["texto"].append(termino)
+    filtros["texto"] = " ".join(filtros["texto"]) or None
+    if filtros["hasta"]:
+        filtros["hasta"] += timedelta(days=1)  # hasta: incluye el día indicado
+    return filtros
+
+def patron_ilike(texto):
+    return "%" + texto.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+def buscar_tickets(filtros):
+    palabras = re.findall(r"\w+", filtros["texto"] or "")
+    parametros = {"texto": filtros["texto"], "prefijos": " & ".join(f"{palabra}:*" for palabra in palabras),
+                  "usuario": patron_ilike(filtros["usuario"] or ""), "ticket": filtros["ticket"],
+                  "grupo": patron_ilike(filtros["grupo"] or ""), "grupo_id": filtros["grupo"],
+                  "desde": filtros["desde"], "hasta": filtros["hasta"], "limite": BUSQUEDA_MAX_RESULTADOS,
+                  "candidatos": BUSQUEDA_CANDIDATOS}
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        trigramas = tiene_trigramas(c)
+        if trigramas:
+            c.execute("SELECT set_config('pg_trgm.word_similarity_threshold', %s, true)", (str(BUSQUEDA_SIMILITUD),))
+        documento = "to_tsvector('spanish', COALESCE(message_text, ''))"  # La misma expresión que los índices GIN
+        consultas = []
+        for origen, tabla, fecha, estado in (("pendientes", "peticiones_registradas", "timestamp", "'pendiente'"),
+                                             ("historial", "historial_solicitudes", "fecha_gestion", "estado")):
+            if filtros["en"] and filtros["en"] != origen:
+                continue
+            condiciones, rango = [], "0"
+            if filtros["texto"]:
+                # Texto completo más prefijos (matri -> Matrix) para que todo lo resuelva el índice GIN;
+                # un ILIKE en el OR obligaría a recorrer la tabla entera
+                coincidencia = f"{documento} @@ (websearch_to_tsquery('spanish', %(texto)s) || to_tsquery('spanish', %(prefijos)s))"
+                rango = f"ts_rank({documento}, websearch_to_tsquery('spanish', %(texto)s))"
+                if trigramas:
+                    coincidencia += " OR %(texto)s <%% message_text"
+                    rango += " + word_similarity(%(texto)s, message_text)"
+                condiciones.append(f"({coincidencia})")
+            if filtros["usuario"]:
+                condiciones.append("username ILIKE %(usuario)s")
+            if filtros["ticket"]:
+                condiciones.append("ticket_number = %(ticket)s")
+            if filtros["grupo"]:
+                condiciones.append("(chat_title ILIKE %(grupo)s OR chat_id::TEXT = %(grupo_id)s)")
+            if filtros["desde"]:
+                condiciones.append(f"{fecha} >= %(desde)s")
+            if filtros["hasta"]:
+                condiciones.append(f"{fecha} < %(hasta)s")
+            # Solo se puntúan los candidatos más recientes: un término que aparece en casi todas las filas
+            # ("solicito") no obliga a recalcular to_tsvector en toda la tabla para ordenar
+            consultas.append(f"""(SELECT '{origen}' AS origen, ticket_number, username, chat_title, message_text, estado, fecha, {rango} AS rango 
+                                  FROM (SELECT ticket_number, username, chat_title, message_text, {estado} AS estado, {fecha} AS fecha 
+                                        FROM {tabla} WHERE {" AND ".join(condiciones) or "TRUE"} 
+                                        ORDER BY ticket_number DESC LIMIT %(candidatos)s) AS candidatos 
+                                  ORDER BY rango DESC, ticket_number DESC LIMIT %(limite)s)""")
+        c.execute(f"""SELECT * FROM ({" UNION ALL ".join(consultas)}) AS resultados 
+                      ORDER BY rango DESC, ticket_number DESC LIMIT %(limite)s""", parametros)
+        return [{"origen": row["origen"], "ticket": row["ticket_number"], "username": row["username"] or "",
+                 "chat_title": row["chat_title"] or "", "mensaje": (row["message_text"] or "")[:80], "estado": row["estado"],
+                 "fecha": row["fecha"].isoformat() if row["fecha"] else None} for row in c.fetchall()]
+
+def nueva_busqueda(texto):
+    filtros = parsear_busqueda(texto)
+    clave = secrets.token_hex(4)
+    busquedas.set(clave, {"consulta": texto, "resultados": buscar_tickets(filtros)})
+    return clave
+
+def render_busqueda(clave, page=1):
+    busqueda = busquedas.get(clave)
+    if not busqueda:
+        return None, None
+    resultados = busqueda["resultados"]
+    paginas = max(1, (len(resultados) + ITEMS_PER_PAGE - 1) // ITEMS_PER_PAGE)
+    page = min(max(1, page), paginas)
+    trozo = resultados[(page - 1) * ITEMS_PER_PAGE:page * ITEMS_PER_PAGE]
+    texto = PLANTILLA_BUSQUEDA.render(consulta=busqueda["consulta"], total=len(resultados), page=page, paginas=paginas)
+    if not resultados:
+        texto += "ℹ️ No se encontraron solicitudes. 😊"
+    texto += "\n".join(
+        PLANTILLA_RESULTADO.render(ticket=r["ticket"], username=r["username"], chat_title=r["chat_title"], mensaje=r["mensaje"],
+                                   estado="⏳ Pendiente" if r["origen"] == "pendientes" else ESTADOS_HISTORIAL.get(r["estado"], "🔄 Estado desconocido"),
+                                   fecha=datetime.fromisoformat(r["fecha"]) if r["fecha"] else datetime.now(SPAIN_TZ))
+        for r in trozo)
+    keyboard = [[InlineKeyboardButton(f"📋 #{r['ticket']} - {r['username']}", callback_data=f"pend_{r['ticket']}")]
+                for r in trozo if r["origen"] == "pendientes"]
+    keyboard.append([InlineKeyboardButton("🔎 Nueva búsqueda", callback_data="menu_buscar")])
+    nav_buttons = [
+        InlineKeyboardButton("↩️ Menú", callback_data="menu_principal"),
+        InlineKeyboardButton("❌ Cerrar", callback_data="menu_close")
+    ]
+    if page > 1:
+        nav_buttons.insert(0, InlineKeyboardButton("⬅️ Anterior", callback_data=f"busq_{clave}_{page - 1}"))
+    if page < paginas:
+        nav_buttons.append(InlineKeyboardButton("Siguiente ➡️", callback_data=f"busq_{clave}_{page + 1}"))
+    keyboard.append(nav_buttons)
+    return texto, InlineKeyboardMarkup(keyboard)
+
+def enviar_busqueda(chat_id, texto):
+    try:
+        clave = nueva_busqueda(texto)
+    except ValueError as e:
+        safe_bot_method_async(bot.send_message, chat_id=chat_id, text=f"❗ {escape_markdown(str(e))}\n\n{AYUDA_BUSQUEDA}", parse_mode='Markdown')
+        return
+    texto_resultados, reply_markup = render_busqueda(clave)
+    sent_message = safe_bot_method(bot.send_message, chat_id=chat_id, text=texto_resultados, reply_markup=reply_markup, parse_mode='Markdown')
+    if sent_message:
+        registrar_menu(chat_id, sent_message.message_id)
+
+# Gráficas: se dibujan a partir de los contadores (estadisticas) y del resumen diario, nunca del historial.
+# La versión de los datos es un hash de lo que se va a dibujar; si coincide con la de la última imagen
+# subida se reenvía su file_id sin dibujar ni subir nada
+graficas_cache = EstadoCompartido("graficas", GRAFICAS_CACHE_TTL)
+
+def texto_graficas(stats):
+    return (
+        f"📊 *Estadísticas de Solicitudes* ✅\n"
+        f"Total gestionadas: {sum(stats.values())}\n"
+        f"✅ Aprobadas: {stats.get('subido', 0)}\n"
+        f"❌ Rechazadas: {stats.get('denegado', 0)}\n"
+        f"🗑️ Eliminadas: {stats.get('eliminado', 0)}\n"
+        f"⛔ Límite excedido: {stats.get('limite_excedido', 0)}"
+    )
+
+def get_datos_graficas():
+    desde = (datetime.now(SPAIN_TZ) - timedelta(days=GRAFICAS_DIAS - 1)).date()
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        stats = get_estados_historial(c)
+        c.execute("""SELECT dia, chat_id, SUM(cantidad)::BIGINT FROM estadisticas 
+                     WHERE estado = 'recibida' AND dia >= %s GROUP BY 1, 2 ORDER BY 1, 2""", (desde,))
+        recibidas = [(dia.isoformat(), chat_id, cantidad) for dia, chat_id, cantidad in c.fetchall()]
+        c.execute("""SELECT dia, estado, SUM(cantidad)::BIGINT FROM estadisticas 
+                     WHERE estado IN ('subido', 'denegado') AND dia >= %s GROUP BY 1, 2 ORDER BY 1, 2""", (desde,))
+        resueltas = [(dia.isoformat(), estado, cantidad) for dia, estado, cantidad in c.fetchall()]
+        c.execute("""SELECT clave, SUM(cantidad)::BIGINT FROM resumen_diario WHERE dimension = 'admin' AND dia >= %s 
+                     GROUP BY 1 ORDER BY 2 DESC, 1 LIMIT 10""", (desde,))
+        admins = [tuple(row) for row in c.fetchall()]
+        c.execute("""SELECT clave, SUM(cantidad)::BIGINT FROM resumen_diario WHERE dimension = 'resolucion' AND dia >= %s 
+                     GROUP BY 1""", (desde,))
+        resolucion = dict(c.fetchall())
+    return {"desde": desde.isoformat(), "stats": stats, "recibidas": recibidas, "resueltas": resueltas,
+            "admins": admins, "resolucion": [(tramo, resolucion.get(tramo, 0)) for tramo, _ in TRAMOS_RESOLUCION]}
+
+def dibujar_graficas(datos):
+    dias = [(datetime.fromisoformat(datos["desde"]) + timedelta(days=n)).date().isoformat() for n in range(GRAFICAS_DIAS)]
+    etiquetas = [dia[8:10] + "/" + dia[5:7] for dia in dias]
+    figura = Figure(figsize=(12, 8), dpi=100)
+    (recibidas, ratio), (admins, resolucion) = figura.subplots(2, 2)
+
+    por_grupo = {}
+    for dia, chat_id, cantidad in datos["recibidas"]:
+        por_grupo.setdefault(chat_id, {})[dia] = cantidad
+    for chat_id, serie in por_grupo.items():
+        recibidas.plot(etiquetas, [serie.get(dia, 0) for dia in dias], marker=".", label=GRUPOS_PREDEFINIDOS.get(chat_id, str(chat_id)))
+    recibidas.set_title("Solicitudes recibidas por día y grupo")
+    if por_grupo:
+        recibidas.legend(fontsize="small")
+
+    aprobadas = {dia: cantidad for dia, estado, cantidad in datos["resueltas"] if estado == "subido"}
+    rechazadas = {dia: cantidad for dia, estado, cantidad in datos["resueltas"] if estado == "denegado"}
+    ratio.bar(etiquetas, [aprobadas.get(dia, 0) for dia in dias], color="tab:green", label="Aprobadas")
+    ratio.bar(etiquetas, [rechazadas.get(dia, 0) for dia in dias], bottom=[aprobadas.get(dia, 0) for dia in dias],
+              color="tab:red", label="Rechazadas")
+    porcentaje = ratio.twinx()
+    porcentaje.plot(etiquetas, [100 * aprobadas.get(dia, 0) / (aprobadas.get(dia, 0) + rechazadas.get(dia, 0))
+                                if aprobadas.get(dia, 0) + rechazadas.get(dia, 0) else None for dia in dias],
+                    color="black", marker=".", label="% aprobadas")
+    porcentaje.set_ylim(0, 100)
+    ratio.set_title("Aprobadas y rechazadas por día")
+    ratio.legend(loc="upper left", fontsize="small")
+
+    nombres = [admin for admin, _ in datos["admins"]][::-1]
+    admins.barh(nombres, [cantidad for _, cantidad in datos["admins"]][::-1], color="tab:blue")
+    admins.set_title(f"Gestiones por admin ({GRAFICAS_DIAS} días)")
+
+    resolucion.bar([tramo for tramo, _ in datos["resolucion"]], [cantidad for _, cantidad in datos["resolucion"]], color="tab:purple")
+    resolucion.set_title("Tiempo hasta la resolución")
+
+    for eje in (recibidas, ratio):
+        eje.set_xticks(etiquetas[::max(1, GRAFICAS_DIAS // 10)])
+        eje.tick_params(axis="x", labelsize="small", rotation=45)
+    for eje in (recibidas.yaxis, ratio.yaxis, admins.xaxis, resolucion.yaxis):
+        eje.set_major_locator(MaxNLocator(integer=True))
+    figura.tight_layout()
+    salida = io.BytesIO()
+    figura.savefig(salida, format="png")
+    return salida.getvalue()
+
+def enviar_graficas(chat_id, reply_markup):
+    datos = get_datos_graficas()
+    texto = texto_graficas(datos["stats"])
+    if Figure is None:
+        return safe_bot_method(bot.send_message, chat_id=chat_id, text=texto, reply_markup=reply_markup, parse_mode='Markdown')
+    version = hashlib.sha1(json.dumps(datos, sort_keys=True).encode("utf-8")).hexdigest()
+    cacheado = graficas_cache.get("panel")
+    if cacheado and cacheado["version"] == version:
+        sent_message = safe_bot_method(bot.send_photo, chat_id=chat_id, photo=cacheado["file_id"], caption=texto,
+                                       reply_markup=reply_markup, parse_mode='Markdown')
+        if sent_message:
+            metricas.incrementar("bot_graficas_total", origen="cache")
+            return sent_message
+    sent_message = safe_bot_method(bot.send_photo, chat_id=chat_id, photo=dibujar_graficas(datos), caption=texto,
+                                   reply_markup=reply_markup, parse_mode='Markdown')
+    if sent_message and sent_message.photo:
+        metricas.incrementar("bot_graficas_total", origen="dibujada")
+        graficas_cache.set("panel", {"version": version, "file_id": sent_message.photo[-1].file_id})
+    return sent_message
+
+# Caducidad de menús: los plazos viven en menus_activos (sobreviven a reinicios y los ven todos los
+# workers). Cada proceso guarda en un montículo los plazos que ha creado y duerme hasta el más próximo;
+# el borrado se reclama con DELETE ... RETURNING, así cada menú lo borra un único proceso
+_menus_plazos = []
+_menus_cond = threading.Condition()
+
+def registrar_menu(chat_id, message_id):
+    try:
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            c.execute("""INSERT INTO menus_activos (chat_id, message_id, expira_en) 
+                         VALUES (%s, %s, now() + %s * interval '1 second')
+                         ON CONFLICT (chat_id, message_id) DO UPDATE SET expira_en = EXCLUDED.expira_en""",
+                      (chat_id, message_id, MENU_TIMEOUT))
+    except Exception as e:
+        logger.error(f"Error en registrar_menu: {str(e)}")
+        return
+    with _menus_cond:
+        heapq.heappush(_menus_plazos, time.time() + MENU_TIMEOUT)
+        _menus_cond.notify()
+
+def quitar_menu(chat_id, message_id):
+    try:
+        with get_db_connection() as conn:
+            conn.cursor().execute("DELETE FROM menus_activos WHERE chat_id = %s AND message_id = %s", (chat_id, message_id))
+    except Exception as e:
+        logger.error(f"Error en quitar_menu: {str(e)}")
+
+def borrar_menu(mensaje):
+    quitar_menu(mensaje.chat_id, mensaje.message_id)
+    safe_bot_method_async(mensaje.delete)
+
+def reclamar_menus_caducados():
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute("DELETE FROM menus_activos WHERE expira_en <= now() RETURNING chat_id, message_id")
+        caducados = c.fetchall()
+        c.execute("SELECT EXTRACT(EPOCH FROM MIN(expira_en)) FROM menus_activos")
+        siguiente = c.fetchone()[0]
+    return caducados, float(siguiente) if siguiente is not None else None
+
+def planificador_menus():
+    proximo_barrido = time.time()  # Al arrancar se borran los menús que caducaron con el proceso parado
     while True:
-        current_time = datetime.now(SPAIN_TZ)
-        for (chat_id, message_id), timestamp in list(menu_activos.items()):
-            if (current_time - timestamp).total_seconds() >= 3600:  # 1 hora
-                safe_bot_method(bot.delete_message, chat_id=chat_id, message_id=message_id)
-                del menu_activos[(chat_id, message_id)]
-        time.sleep(60)  # Revisar cada minuto
+        with _menus_cond:
+            while True:
+                objetivo = min(proximo_barrido, _menus_plazos[0]) if _menus_plazos else proximo_barrido
+                espera = objetivo - time.time()
+                if espera <= 0:
+                    break
+                _menus_cond.wait(espera)
+            ahora = time.time()
+            while _menus_plazos and _menus_plazos[0] <= ahora:
+                heapq.heappop(_menus_plazos)
+        try:
+            caducados, siguiente = reclamar_menus_caducados()
+            for chat_id, message_id in caducados:
+                safe_bot_method_async(bot.delete_message, chat_id=chat_id, message_id=message_id)
+            if caducados:
+                logger.info(f"Menús caducados borrados: {len(caducados)}")
+            proximo_barrido = time.time() + MENU_SWEEP_MAX
+            if siguiente is not None:
+                proximo_barrido = min(proximo_barrido, siguiente)
+        except Exception as e:
+            logger.error(f"Error en planificador_menus: {str(e)}")
+            proximo_barrido = time.time() + 30
 
 # Función para manejar mensajes
 def handle_message(update, context):
@@ -379,136 +2867,118 @@ def handle_message(update, context):
         canal_info = CANALES_PETICIONES.get(chat_id, {"chat_id": chat_id, "thread_id": None})
         has_attachment = bool(message.photo or message.document or message.video)
 
+        # Clasificación previa: la charla normal del grupo sale aquí sin tocar la base de datos ni Telegram
+        clase = clasificar_mensaje(message_text)
+        is_valid_request = clase == "valida"
+        is_near_miss = clase == "casi" and chat_id in CANALES_PETICIONES
+        is_admin_url = chat_id == int(GROUP_DESTINO) and message_text.startswith('http')
+        # Tras pulsar 🔎 Buscar, el siguiente texto del admin en el grupo de administración es la consulta
+        is_busqueda = (chat_id == int(GROUP_DESTINO) and bool(message.text) and not is_admin_url
+                       and not message_text.startswith('/') and tomar_busqueda_en_espera(user_id))
+
         update_grupos_estados(chat_id, chat_title)
+        if is_busqueda:
+            enviar_busqueda(chat_id, message_text)
+            return
+        if not (is_valid_request or is_near_miss or is_admin_url):
+            return
 
         timestamp = datetime.now(SPAIN_TZ)
-        timestamp_str = get_spain_time()
-        username_escaped = escape_markdown(username, preserve_username=True)
-        chat_title_escaped = escape_markdown(chat_title)
-        message_text_escaped = escape_markdown(message_text)
-
-        is_valid_request = any(cmd in message_text for cmd in VALID_REQUEST_COMMANDS)
-        grupos_estados = get_grupos_estados()
 
         if is_valid_request:
             logger.info(f"Solicitud recibida de {username} en {chat_title}: {message_text}")
             if chat_id not in CANALES_PETICIONES or thread_id != CANALES_PETICIONES[chat_id]["thread_id"]:
-                notificacion = f"⚠️ {username_escaped}, las solicitudes deben realizarse en el canal correspondiente. 😊"
-                warn_message = f"/warn {username_escaped} (Solicitud fuera del canal permitido)"
-                safe_bot_method(bot.send_message, chat_id=canal_info["chat_id"], text=notificacion, message_thread_id=canal_info["thread_id"], parse_mode='Markdown')
-                safe_bot_method(bot.send_message, chat_id=canal_info["chat_id"], text=warn_message, message_thread_id=canal_info["thread_id"])
+                notificacion = f"⚠️ {escape_markdown(username)}, las solicitudes deben realizarse en el canal correspondiente. 😊"
+                warn_message = f"/warn {username} (Solicitud fuera del canal permitido)"
+                safe_bot_method_async(bot.send_message, chat_id=canal_info["chat_id"], text=notificacion, message_thread_id=canal_info["thread_id"], parse_mode='Markdown')
+                safe_bot_method_async(bot.send_message, chat_id=canal_info["chat_id"], text=warn_message, message_thread_id=canal_info["thread_id"])
                 logger.info(f"Solicitud de {username} denegada: fuera del canal correcto")
                 return
 
-            if not grupos_estados.get(chat_id, {}).get("activo", True):
-                notificacion = f"⚠️ {username_escaped}, las solicitudes están temporalmente desactivadas en este grupo. Contacta a un administrador para más información. 😊"
-                safe_bot_method(bot.send_message, chat_id=canal_info["chat_id"], text=notificacion, message_thread_id=canal_info["thread_id"], parse_mode='Markdown')
+            resultado = registrar_peticion(user_id, {
+                "chat_id": chat_id,
+                "username": username,
+                "message_text": message_text,
+                "timestamp": timestamp,
+                "chat_title": chat_title,
+                "thread_id": thread_id,
+                "has_attachment": has_attachment
+            })
+
+            if resultado["estado"] == "desactivado":
+                notificacion = f"⚠️ {escape_markdown(username)}, las solicitudes están temporalmente desactivadas en este grupo. Contacta a un administrador para más información. 😊"
+                safe_bot_method_async(bot.send_message, chat_id=canal_info["chat_id"], text=notificacion, message_thread_id=canal_info["thread_id"], parse_mode='Markdown')
                 logger.info(f"Solicitudes desactivadas en {chat_id}, notificado a {username}")
                 return
 
-            user_data = get_peticiones_por_usuario(user_id)
-            if not user_data:
-                set_peticiones_por_usuario(user_id, 0, chat_id, username)
-                user_data = {"count": 0, "chat_id": chat_id, "username": username}
-            elif user_data["count"] >= 2:
-                limite_message = f"⚠️ Estimado {username_escaped}, has alcanzado el límite diario de 2 solicitudes. Por favor, intenta de nuevo mañana. 😊"
-                warn_message = f"/warn {username_escaped} (Límite diario de solicitudes alcanzado)"
-                safe_bot_method(bot.send_message, chat_id=canal_info["chat_id"], text=limite_message, message_thread_id=canal_info["thread_id"], parse_mode='Markdown')
-                safe_bot_method(bot.send_message, chat_id=canal_info["chat_id"], text=warn_message, message_thread_id=canal_info["thread_id"])
+            if resultado["estado"] == "limite":
+                limite_message = f"⚠️ Estimado {escape_markdown(username)}, has alcanzado el límite diario de {resultado['limite']} solicitudes. Por favor, intenta de nuevo mañana. 😊"
+                warn_message = f"/warn {username} (Límite diario de solicitudes alcanzado)"
+                safe_bot_method_async(bot.send_message, chat_id=canal_info["chat_id"], text=limite_message, message_thread_id=canal_info["thread_id"], parse_mode='Markdown')
+                safe_bot_method_async(bot.send_message, chat_id=canal_info["chat_id"], text=warn_message, message_thread_id=canal_info["thread_id"])
                 logger.info(f"Límite excedido por {username}, advertencia enviada")
                 return
 
-            ticket_number = increment_ticket_counter()
-            destino_message = (
-                f"📩 *Nueva solicitud recibida* ✅\n"
-                f"👤 *Usuario:* {username_escaped} (ID: {user_id})\n"
-                f"🎟️ *Ticket:* #{ticket_number}\n"
-                f"✉️ *Mensaje:* {message_text_escaped}\n"
-                f"📍 *Grupo:* {chat_title_escaped}\n"
-                f"⏰ *Fecha:* {timestamp_str}\n"
-                f"📎 *Adjunto:* {'Sí' if has_attachment else 'No'}\n"
-                "🤝 *Bot de Entreshijos*"
-            )
-            sent_message = safe_bot_method(bot.send_message, chat_id=GROUP_DESTINO, text=destino_message, parse_mode='Markdown')
-            if sent_message and has_attachment:
-                if message.photo:
-                    safe_bot_method(bot.send_photo, chat_id=GROUP_DESTINO, photo=message.photo[-1].file_id, caption=f"Adjunto del Ticket #{ticket_number}")
-                elif message.document:
-                    safe_bot_method(bot.send_document, chat_id=GROUP_DESTINO, document=message.document.file_id, caption=f"Adjunto del Ticket #{ticket_number}")
-                elif message.video:
-                    safe_bot_method(bot.send_video, chat_id=GROUP_DESTINO, video=message.video.file_id, caption=f"Adjunto del Ticket #{ticket_number}")
-
+            ticket_number = resultado["ticket_number"]
+            campos = {"username": username, "user_id": user_id, "ticket": ticket_number, "message_text": message_text,
+                      "chat_title": chat_title, "fecha": timestamp, "adjunto": 'Sí' if has_attachment else 'No'}
+            destino_message = PLANTILLA_DESTINO.render(count=resultado["count"], limite=resultado["limite"], **campos)
+            # Antes de que llegue el aviso del trigger: la propia solicitud no cuenta como duplicado de sí misma
+            duplicado = indice_similares.buscar(message_text, excluir=ticket_number)
+            indice_similares.agregar("pendiente", ticket_number, message_text)
+            reply_markup = None
+            if duplicado:
+                origen, ticket_parecido, parecido = duplicado
+                destino_message += PLANTILLA_DUPLICADO.render(ticket=ticket_parecido, parecido=parecido,
+                                                              estado="⏳ Pendiente" if origen == "pendiente" else "✅ Aprobada")
+                reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton(f"🔁 Ver Ticket #{ticket_parecido}", callback_data=f"dup_{ticket_parecido}")]])
+                metricas.incrementar("bot_duplicados_total", origen=origen)
+                logger.info(f"Solicitud #{ticket_number} marcada como posible duplicado de #{ticket_parecido} ({parecido:.0%})")
+            sent_message = safe_bot_method(bot.send_message, chat_id=GROUP_DESTINO, text=destino_message, reply_markup=reply_markup, parse_mode='Markdown')
             if sent_message:
-                set_peticion_registrada(ticket_number, {
-                    "chat_id": chat_id,
-                    "username": username,
-                    "message_text": message_text,
-                    "message_id": sent_message.message_id,
-                    "timestamp": timestamp,
-                    "chat_title": chat_title,
-                    "thread_id": thread_id,
-                    "has_attachment": has_attachment
-                })
+                set_message_id_peticion(ticket_number, sent_message.message_id)
                 logger.info(f"Solicitud #{ticket_number} registrada en la base de datos")
-
-            user_data["count"] += 1
-            set_peticiones_por_usuario(user_id, user_data["count"], user_data["chat_id"], user_data["username"])
-
-            destino_message = (
-                f"📩 *Nueva solicitud recibida* ✅\n"
-                f"👤 *Usuario:* {username_escaped} (ID: {user_id})\n"
-                f"🎟️ *Ticket:* #{ticket_number}\n"
-                f"📊 *Petición:* {user_data['count']}/2\n"
-                f"✉️ *Mensaje:* {message_text_escaped}\n"
-                f"📍 *Grupo:* {chat_title_escaped}\n"
-                f"⏰ *Fecha:* {timestamp_str}\n"
-                f"📎 *Adjunto:* {'Sí' if has_attachment else 'No'}\n"
-                "🤝 *Bot de Entreshijos*"
-            )
-            if sent_message:
-                safe_bot_method(bot.edit_message_text, chat_id=GROUP_DESTINO, message_id=sent_message.message_id, text=destino_message, parse_mode='Markdown')
-
-            confirmacion_message = (
-                f"✅ *Solicitud registrada con éxito* 😊\n"
-                f"Hola {username_escaped}, tu solicitud (Ticket #{ticket_number}) ha sido recibida.\n"
-                f"📌 *Detalles:*\n"
-                f"🆔 ID: {user_id}\n"
-                f"📍 Grupo: {chat_title_escaped}\n"
-                f"⏰ Fecha: {timestamp_str}\n"
-                f"✉️ Mensaje: {message_text_escaped}\n"
-                f"📎 Adjunto: {'Sí' if has_attachment else 'No'}\n"
-                "⌛ Será procesada a la mayor brevedad posible. Gracias por tu paciencia."
-            )
-            safe_bot_method(bot.send_message, chat_id=canal_info["chat_id"], text=confirmacion_message, parse_mode='Markdown', message_thread_id=canal_info["thread_id"])
+                if has_attachment:
+                    if message.photo:
+                        safe_bot_method_async(bot.send_photo, chat_id=GROUP_DESTINO, photo=message.photo[-1].file_id, caption=f"Adjunto del Ticket #{ticket_number}")
+                    elif message.document:
+                        safe_bot_method_async(bot.send_document, chat_id=GROUP_DESTINO, document=message.document.file_id, caption=f"Adjunto del Ticket #{ticket_number}")
+                    elif message.video:
+                        safe_bot_method_async(bot.send_video, chat_id=GROUP_DESTINO, video=message.video.file_id, caption=f"Adjunto del Ticket #{ticket_number}")
+            else:
+                # Sin aviso en el grupo de administración la solicitud no queda pendiente (la cuota sí se consume)
+                del_peticion_registrada(ticket_number)
+
+            confirmacion_message = PLANTILLA_CONFIRMACION.render(**campos)
+            safe_bot_method_async(bot.send_message, chat_id=canal_info["chat_id"], text=confirmacion_message, parse_mode='Markdown', message_thread_id=canal_info["thread_id"])
             logger.info(f"Confirmación enviada a {username} en chat {canal_info['chat_id']}")
 
-        elif any(word in message_text.lower() for word in ['solicito', 'solícito', 'peticion', 'petición']) and chat_id in CANALES_PETICIONES:
-            add_peticion_incorrecta(user_id, timestamp, chat_id)
-            intentos_recientes = [i for i in get_peticiones_incorrectas(user_id) 
-                                if i["timestamp"].astimezone(SPAIN_TZ) > timestamp - timedelta(hours=24)]
+        elif is_near_miss:
+            intentos_recientes = add_peticion_incorrecta(user_id, timestamp, chat_id)
 
             notificacion_incorrecta = (
-                f"⚠️ {username_escaped}, por favor utiliza únicamente: {', '.join(VALID_REQUEST_COMMANDS)}.\n"
+                f"⚠️ {escape_markdown(username)}, por favor utiliza únicamente: {', '.join(VALID_REQUEST_COMMANDS)}.\n"
                 "Consulta /ayuda para más información. 😊"
             )
-            warn_message = f"/warn {username_escaped} (Solicitud incorrecta)" if len(intentos_recientes) <= 2 else f"/warn {username_escaped} (Uso repetido de formato incorrecto)"
+            warn_message = f"/warn {username} (Solicitud incorrecta)" if intentos_recientes <= 2 else f"/warn {username} (Uso repetido de formato incorrecto)"
 
-            safe_bot_method(bot.send_message, chat_id=canal_info["chat_id"], text=notificacion_incorrecta, parse_mode='Markdown', message_thread_id=canal_info["thread_id"])
-            safe_bot_method(bot.send_message, chat_id=canal_info["chat_id"], text=warn_message, message_thread_id=canal_info["thread_id"])
+            safe_bot_method_async(bot.send_message, chat_id=canal_info["chat_id"], text=notificacion_incorrecta, parse_mode='Markdown', message_thread_id=canal_info["thread_id"])
+            safe_bot_method_async(bot.send_message, chat_id=canal_info["chat_id"], text=warn_message, message_thread_id=canal_info["thread_id"])
             logger.info(f"Notificación de solicitud incorrecta enviada a {username} en {chat_id}")
 
         # Manejo de URLs enviadas por administradores
-        if chat_id == int(GROUP_DESTINO) and message_text.startswith('http'):
-            if user_id in pending_urls:
-                ticket = pending_urls[user_id]["ticket"]
-                pending_urls[user_id]["url"] = message_text
+        if is_admin_url:
+            pendiente = urls_pendientes.get(user_id)
+            if pendiente:
+                ticket = pendiente["ticket"]
+                urls_pendientes.set(user_id, {"ticket": ticket, "url": message_text})
                 keyboard = [
                     [InlineKeyboardButton("✅ Confirmar y Enviar", callback_data=f"pend_{ticket}_subido_url_confirm")],
                     [InlineKeyboardButton("✏️ Editar URL", callback_data=f"pend_{ticket}_subido_url_edit")],
                     [InlineKeyboardButton("↩️ Pendientes", callback_data="pend_page_1"), InlineKeyboardButton("❌ Cerrar", callback_data="menu_close")]
                 ]
                 reply_markup = InlineKeyboardMarkup(keyboard)
-                safe_bot_method(bot.send_message, chat_id=chat_id, 
+                safe_bot_method_async(bot.send_message, chat_id=chat_id, 
                                 text=f"🔗 *URL recibida para Ticket #{ticket}* ✅\nURL: {escape_markdown(message_text)}\nConfirma o edita:", 
                                 reply_markup=reply_markup, parse_mode='Markdown')
     except Exception as e:
@@ -523,7 +2993,7 @@ def handle_menu(update, context):
         chat_id = message.chat_id
         admin_username = f"@{message.from_user.username}" if message.from_user.username else "Admin sin @"
         if str(chat_id) != GROUP_DESTINO:
-            safe_bot_method(bot.send_message, chat_id=chat_id, text="❌ Este comando está reservado para el grupo de administración. 😊", parse_mode='Markdown')
+            safe_bot_method_async(bot.send_message, chat_id=chat_id, text="❌ Este comando está reservado para el grupo de administración. 😊", parse_mode='Markdown')
             return
         keyboard = [
             [InlineKeyboardButton("📋 Pendientes", callback_data="menu_pendientes"), InlineKeyboardButton("📜 Historial", callback_data="menu_historial")],
@@ -531,12 +3001,13 @@ def handle_menu(update, context):
             [InlineKeyboardButton("✅ Activar", callback_data="menu_on"), InlineKeyboardButton("⛔ Desactivar", callback_data="menu_off")],
             [InlineKeyboardButton("➕ Sumar", callback_data="menu_sumar"), InlineKeyboardButton("➖ Restar", callback_data="menu_restar")],
             [InlineKeyboardButton("🧹 Limpiar", callback_data="menu_clean"), InlineKeyboardButton("📡 Ping", callback_data="menu_ping")],
-            [InlineKeyboardButton("📈 Estadísticas", callback_data="menu_stats"), InlineKeyboardButton("❌ Cerrar", callback_data="menu_close")]
+            [InlineKeyboardButton("📈 Estadísticas", callback_data="menu_stats"), InlineKeyboardButton("🔎 Buscar", callback_data="menu_buscar")],
+            [InlineKeyboardButton("❌ Cerrar", callback_data="menu_close")]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         sent_message = safe_bot_method(bot.send_message, chat_id=chat_id, text=f"👤 {admin_username}\n📋 *Menú de Administración* ✅\nSelecciona una opción:", reply_markup=reply_markup, parse_mode='Markdown')
         if sent_message:
-            menu_activos[(chat_id, sent_message.message_id)] = datetime.now(SPAIN_TZ)
+            registrar_menu(chat_id, sent_message.message_id)
     except Exception as e:
         logger.error(f"Error en handle_menu: {str(e)}")
 
@@ -547,11 +3018,11 @@ def handle_sumar_command(update, context):
         message = update.message
         chat_id = message.chat_id
         if str(chat_id) != GROUP_DESTINO:
-            safe_bot_method(bot.send_message, chat_id=chat_id, text="❌ Este comando está reservado para el grupo de administración. 😊", parse_mode='Markdown')
+            safe_bot_method_async(bot.send_message, chat_id=chat_id, text="❌ Este comando está reservado para el grupo de administración. 😊", parse_mode='Markdown')
             return
         args = context.args
         if len(args) < 2:
-            safe_bot_method(bot.send_message, chat_id=chat_id, text="❗ Uso correcto: /sumar @username [número] 😊", parse_mode='Markdown')
+            safe_bot_method_async(bot.send_message, chat_id=chat_id, text="❗ Uso correcto: /sumar @username [número] 😊", parse_mode='Markdown')
             return
         target_username = args[0]
         try:
@@ -559,22 +3030,19 @@ def handle_sumar_command(update, context):
             if amount < 0:
                 raise ValueError("El número debe ser positivo")
         except ValueError:
-            safe_bot_method(bot.send_message, chat_id=chat_id, text="❗ El valor debe ser un número entero positivo. 😊", parse_mode='Markdown')
+            safe_bot_method_async(bot.send_message, chat_id=chat_id, text="❗ El valor debe ser un número entero positivo. 😊", parse_mode='Markdown')
             return
 
         user_id = get_user_id_by_username(target_username)
         if not user_id:
-            safe_bot_method(bot.send_message, chat_id=chat_id, text=f"❗ No se encontró al usuario {target_username}. 😊", parse_mode='Markdown')
+            safe_bot_method_async(bot.send_message, chat_id=chat_id, text=f"❗ No se encontró al usuario {target_username}. 😊", parse_mode='Markdown')
             return
 
-        user_data = get_peticiones_por_usuario(user_id)
-        if not user_data:
-            set_peticiones_por_usuario(user_id, amount, chat_id, target_username)
-            safe_bot_method(bot.send_message, chat_id=chat_id, text=f"✅ Se han añadido {amount} solicitudes a {target_username}. Total: {amount}/2 😊", parse_mode='Markdown')
-        else:
-            new_count = user_data['count'] + amount
-            set_peticiones_por_usuario(user_id, new_count, user_data['chat_id'], target_username)
-            safe_bot_method(bot.send_message, chat_id=chat_id, text=f"✅ Se han añadido {amount} solicitudes a {target_username}. Nuevo total: {new_count}/2 😊", parse_mode='Markdown')
+        cuota = ajustar_cuota(user_id, amount, target_username)
+        if not cuota:
+            safe_bot_method_async(bot.send_message, chat_id=chat_id, text=f"❌ No se pudo actualizar la cuota de {target_username}. 😊", parse_mode='Markdown')
+            return
+        safe_bot_method_async(bot.send_message, chat_id=chat_id, text=f"✅ Se han añadido {amount} solicitudes a {target_username}. Nuevo total: {cuota['count']}/{limite_de(cuota['chat_id'])} 😊", parse_mode='Markdown')
     except Exception as e:
         logger.error(f"Error en handle_sumar_command: {str(e)}")
 
@@ -585,11 +3053,11 @@ def handle_restar_command(update, context):
         message = update.message
         chat_id = message.chat_id
         if str(chat_id) != GROUP_DESTINO:
-            safe_bot_method(bot.send_message, chat_id=chat_id, text="❌ Este comando está reservado para el grupo de administración. 😊", parse_mode='Markdown')
+            safe_bot_method_async(bot.send_message, chat_id=chat_id, text="❌ Este comando está reservado para el grupo de administración. 😊", parse_mode='Markdown')
             return
         args = context.args
         if len(args) < 2:
-            safe_bot_method(bot.send_message, chat_id=chat_id, text="❗ Uso correcto: /restar @username [número] 😊", parse_mode='Markdown')
+            safe_bot_method_async(bot.send_message, chat_id=chat_id, text="❗ Uso correcto: /restar @username [número] 😊", parse_mode='Markdown')
             return
         username = args[0]
         try:
@@ -597,19 +3065,17 @@ def handle_restar_command(update, context):
             if amount < 0:
                 raise ValueError("El número debe ser positivo")
         except ValueError:
-            safe_bot_method(bot.send_message, chat_id=chat_id, text="❗ El valor debe ser un número entero positivo. 😊", parse_mode='Markdown')
+            safe_bot_method_async(bot.send_message, chat_id=chat_id, text="❗ El valor debe ser un número entero positivo. 😊", parse_mode='Markdown')
             return
         user_id = get_user_id_by_username(username)
         if not user_id:
-            safe_bot_method(bot.send_message, chat_id=chat_id, text=f"❗ No se encontró al usuario {username}. 😊", parse_mode='Markdown')
+            safe_bot_method_async(bot.send_message, chat_id=chat_id, text=f"❗ No se encontró al usuario {username}. 😊", parse_mode='Markdown')
             return
-        user_data = get_peticiones_por_usuario(user_id)
-        if not user_data:
-            safe_bot_method(bot.send_message, chat_id=chat_id, text=f"❗ El usuario {username} no tiene solicitudes registradas. 😊", parse_mode='Markdown')
+        cuota = ajustar_cuota(user_id, -amount)
+        if not cuota:
+            safe_bot_method_async(bot.send_message, chat_id=chat_id, text=f"❗ El usuario {username} no tiene solicitudes registradas. 😊", parse_mode='Markdown')
         else:
-            new_count = max(0, user_data['count'] - amount)
-            set_peticiones_por_usuario(user_id, new_count, user_data['chat_id'], user_data['username'])
-            safe_bot_method(bot.send_message, chat_id=chat_id, text=f"✅ Se han reducido {amount} solicitudes a {username}. Nuevo total: {new_count}/2 😊", parse_mode='Markdown')
+            safe_bot_method_async(bot.send_message, chat_id=chat_id, text=f"✅ Se han reducido {amount} solicitudes a {username}. Nuevo total: {cuota['count']}/{limite_de(cuota['chat_id'])} 😊", parse_mode='Markdown')
     except Exception as e:
         logger.error(f"Error en handle_restar_command: {str(e)}")
 
@@ -620,9 +3086,9 @@ def handle_ping(update, context):
         message = update.message
         chat_id = message.chat_id
         if str(chat_id) != GROUP_DESTINO:
-            safe_bot_method(bot.send_message, chat_id=chat_id, text="❌ Este comando está reservado para el grupo de administración. 😊", parse_mode='Markdown')
+            safe_bot_method_async(bot.send_message, chat_id=chat_id, text="❌ Este comando está reservado para el grupo de administración. 😊", parse_mode='Markdown')
             return
-        safe_bot_method(bot.send_message, chat_id=chat_id, text=random.choice(ping_respuestas), parse_mode='Markdown')
+        safe_bot_method_async(bot.send_message, chat_id=chat_id, text=random.choice(ping_respuestas), parse_mode='Markdown')
     except Exception as e:
         logger.error(f"Error en handle_ping: {str(e)}")
 
@@ -633,15 +3099,15 @@ def handle_ayuda(update, context):
         message = update.message
         chat_id = message.chat_id
         thread_id = message.message_thread_id if chat_id in CANALES_PETICIONES else None
-        username = escape_markdown(f"@{message.from_user.username}", True) if message.from_user.username else "Usuario"
+        username = escape_markdown(f"@{message.from_user.username}") if message.from_user.username else "Usuario"
         canal_info = CANALES_PETICIONES.get(chat_id, {"chat_id": chat_id, "thread_id": None})
         ayuda_message = (
             f"📖 *Guía de Uso* ✅\n"
-            f"Hola {username}, utiliza {', '.join(VALID_REQUEST_COMMANDS)} para enviar tu solicitud (máximo 2 por día).\n"
+            f"Hola {username}, utiliza {', '.join(VALID_REQUEST_COMMANDS)} para enviar tu solicitud (máximo {limite_de(chat_id)} por día).\n"
             "📎 Puedes adjuntar fotos, documentos o videos.\n"
             "🤝 *Gracias por colaborar con nosotros!*"
         )
-        safe_bot_method(bot.send_message, chat_id=canal_info["chat_id"], text=ayuda_message, parse_mode='Markdown', 
+        safe_bot_method_async(bot.send_message, chat_id=canal_info["chat_id"], text=ayuda_message, parse_mode='Markdown', 
                         message_thread_id=canal_info["thread_id"] if thread_id == canal_info["thread_id"] else None)
     except Exception as e:
         logger.error(f"Error en handle_ayuda: {str(e)}")
@@ -653,35 +3119,38 @@ def handle_graficas(update, context):
         message = update.message
         chat_id = message.chat_id
         if str(chat_id) != GROUP_DESTINO:
-            safe_bot_method(bot.send_message, chat_id=chat_id, text="❌ Este comando está reservado para el grupo de administración. 😊", parse_mode='Markdown')
+            safe_bot_method_async(bot.send_message, chat_id=chat_id, text="❌ Este comando está reservado para el grupo de administración. 😊", parse_mode='Markdown')
             return
-        with get_db_connection() as conn:
-            c = conn.cursor()
-            c.execute("SELECT estado, COUNT(*) as count FROM historial_solicitudes GROUP BY estado")
-            stats = dict(c.fetchall())
-
-        total = sum(stats.values())
-        stats_msg = (
-            f"📊 *Estadísticas de Solicitudes* ✅\n"
-            f"Total gestionadas: {total}\n"
-            f"✅ Aprobadas: {stats.get('subido', 0)}\n"
-            f"❌ Rechazadas: {stats.get('denegado', 0)}\n"
-            f"🗑️ Eliminadas: {stats.get('eliminado', 0)}\n"
-            f"⛔ Límite excedido: {stats.get('limite_excedido', 0)}"
-        )
         keyboard = [[InlineKeyboardButton("↩️ Menú", callback_data="menu_principal"), InlineKeyboardButton("❌ Cerrar", callback_data="menu_close")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
-        safe_bot_method(bot.send_message, chat_id=chat_id, text=stats_msg, reply_markup=reply_markup, parse_mode='Markdown')
+        enviar_graficas(chat_id, reply_markup)
     except Exception as e:
         logger.error(f"Error en handle_graficas: {str(e)}")
 
+def handle_buscar(update, context):
+    try:
+        if not update.message:
+            return
+        message = update.message
+        chat_id = message.chat_id
+        if str(chat_id) != GROUP_DESTINO:
+            safe_bot_method_async(bot.send_message, chat_id=chat_id, text="❌ Este comando está reservado para el grupo de administración. 😊", parse_mode='Markdown')
+            return
+        consulta = " ".join(context.args) if context.args else ""
+        if not consulta:
+            safe_bot_method_async(bot.send_message, chat_id=chat_id, text=AYUDA_BUSQUEDA, parse_mode='Markdown')
+            return
+        enviar_busqueda(chat_id, consulta)
+    except Exception as e:
+        logger.error(f"Error en handle_buscar: {str(e)}")
+
 # Manejador de botones
 def button_handler(update, context):
     try:
         query = update.callback_query
         if not query:
             return
-        query.answer()
+        safe_bot_method_async(query.answer)
         data = query.data
         chat_id = query.message.chat_id
         admin_username = f"@{update.effective_user.username}" if update.effective_user.username else "Admin sin @"
@@ -694,134 +3163,60 @@ def button_handler(update, context):
                 [InlineKeyboardButton("✅ Activar", callback_data="menu_on"), InlineKeyboardButton("⛔ Desactivar", callback_data="menu_off")],
                 [InlineKeyboardButton("➕ Sumar", callback_data="menu_sumar"), InlineKeyboardButton("➖ Restar", callback_data="menu_restar")],
                 [InlineKeyboardButton("🧹 Limpiar", callback_data="menu_clean"), InlineKeyboardButton("📡 Ping", callback_data="menu_ping")],
-                [InlineKeyboardButton("📈 Estadísticas", callback_data="menu_stats"), InlineKeyboardButton("❌ Cerrar", callback_data="menu_close")]
+                [InlineKeyboardButton("📈 Estadísticas", callback_data="menu_stats"), InlineKeyboardButton("🔎 Buscar", callback_data="menu_buscar")],
+                [InlineKeyboardButton("❌ Cerrar", callback_data="menu_close")]
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
-            safe_bot_method(query.edit_message_text, text=f"👤 {admin_username}\n📋 *Menú de Administración* ✅\nSelecciona una opción:", reply_markup=reply_markup, parse_mode='Markdown')
-            menu_activos[(chat_id, query.message.message_id)] = datetime.now(SPAIN_TZ)
+            texto = f"👤 {admin_username}\n📋 *Menú de Administración* ✅\nSelecciona una opción:"
+            if query.message.photo:  # Desde las gráficas: una foto no se puede editar como texto
+                sent_message = safe_bot_method(bot.send_message, chat_id=chat_id, text=texto, reply_markup=reply_markup, parse_mode='Markdown')
+                if sent_message:
+                    registrar_menu(chat_id, sent_message.message_id)
+                borrar_menu(query.message)
+                return
+            safe_bot_method_async(query.edit_message_text, text=texto, reply_markup=reply_markup, parse_mode='Markdown')
+            registrar_menu(chat_id, query.message.message_id)
             return
 
         if data == "menu_close":
-            safe_bot_method(query.message.delete)
-            if (chat_id, query.message.message_id) in menu_activos:
-                del menu_activos[(chat_id, query.message.message_id)]
+            borrar_menu(query.message)
             return
 
         if data == "menu_pendientes":
-            with get_db_connection() as conn:
-                c = conn.cursor()
-                c.execute("SELECT ticket_number, username, chat_title FROM peticiones_registradas ORDER BY ticket_number")
-                pendientes = c.fetchall()
-            if not pendientes:
+            texto, reply_markup = render_pendientes()
+            if not texto:
                 keyboard = [[InlineKeyboardButton("↩️ Menú", callback_data="menu_principal"), InlineKeyboardButton("❌ Cerrar", callback_data="menu_close")]]
                 reply_markup = InlineKeyboardMarkup(keyboard)
-                safe_bot_method(bot.send_message, chat_id=chat_id, text="ℹ️ No hay solicitudes pendientes en este momento. 😊", reply_markup=reply_markup, parse_mode='Markdown')
-                safe_bot_method(query.message.delete)
+                safe_bot_method_async(bot.send_message, chat_id=chat_id, text="ℹ️ No hay solicitudes pendientes en este momento. 😊", reply_markup=reply_markup, parse_mode='Markdown')
+                borrar_menu(query.message)
                 return
-
-            ITEMS_PER_PAGE = 5
-            page = 1
-            start_idx = (page - 1) * ITEMS_PER_PAGE
-            end_idx = start_idx + ITEMS_PER_PAGE
-            page_items = pendientes[start_idx:end_idx]
-            total_pages = (len(pendientes) + ITEMS_PER_PAGE - 1) // ITEMS_PER_PAGE
-
-            keyboard = [[InlineKeyboardButton(f"#{ticket} - {escape_markdown(username, True)} ({escape_markdown(chat_title)})",
-                                            callback_data=f"pend_{ticket}")] for ticket, username, chat_title in page_items]
-            nav_buttons = [
-                InlineKeyboardButton("↩️ Menú", callback_data="menu_principal"),
-                InlineKeyboardButton("❌ Cerrar", callback_data="menu_close")
-            ]
-            if page > 1:
-                nav_buttons.insert(0, InlineKeyboardButton("⬅️ Anterior", callback_data=f"pend_page_{page-1}"))
-            if page < total_pages:
-                nav_buttons.append(InlineKeyboardButton("Siguiente ➡️", callback_data=f"pend_page_{page+1}"))
-            keyboard.append(nav_buttons)
-            reply_markup = InlineKeyboardMarkup(keyboard)
-
-            sent_message = safe_bot_method(bot.send_message, chat_id=chat_id, text=f"📋 *Solicitudes Pendientes (Página {page}/{total_pages})* ✅\nSelecciona una solicitud:", reply_markup=reply_markup, parse_mode='Markdown')
+            sent_message = safe_bot_method(bot.send_message, chat_id=chat_id, text=texto, reply_markup=reply_markup, parse_mode='Markdown')
             if sent_message:
-                menu_activos[(chat_id, sent_message.message_id)] = datetime.now(SPAIN_TZ)
-            safe_bot_method(query.message.delete)
+                registrar_menu(chat_id, sent_message.message_id)
+            borrar_menu(query.message)
             return
 
         if data == "menu_historial":
-            with get_db_connection() as conn:
-                c = conn.cursor()
-                c.execute("SELECT ticket_number, username, message_text, chat_title, estado, fecha_gestion, admin_username "
-                          "FROM historial_solicitudes ORDER BY ticket_number DESC")
-                solicitudes = c.fetchall()
-            if not solicitudes:
+            texto, reply_markup = render_historial()
+            if not texto:
                 keyboard = [[InlineKeyboardButton("↩️ Menú", callback_data="menu_principal"), InlineKeyboardButton("❌ Cerrar", callback_data="menu_close")]]
                 reply_markup = InlineKeyboardMarkup(keyboard)
-                safe_bot_method(bot.send_message, chat_id=chat_id, text="ℹ️ No hay solicitudes gestionadas en el historial. 😊", reply_markup=reply_markup, parse_mode='Markdown')
-                safe_bot_method(query.message.delete)
+                safe_bot_method_async(bot.send_message, chat_id=chat_id, text="ℹ️ No hay solicitudes gestionadas en el historial. 😊", reply_markup=reply_markup, parse_mode='Markdown')
+                borrar_menu(query.message)
                 return
-
-            ITEMS_PER_PAGE = 5
-            page = 1
-            start_idx = (page - 1) * ITEMS_PER_PAGE
-            end_idx = start_idx + ITEMS_PER_PAGE
-            page_items = solicitudes[start_idx:end_idx]
-            total_pages = (len(solicitudes) + ITEMS_PER_PAGE - 1) // ITEMS_PER_PAGE
-
-            historial = []
-            for row in page_items:
-                ticket, username, message_text, chat_title, estado, fecha_gestion, admin_username = row
-                estado_str = {
-                    "subido": "✅ Aprobada",
-                    "denegado": "❌ Rechazada",
-                    "eliminado": "🗑️ Eliminada",
-                    "notificado": "📢 Respondida",
-                    "limite_excedido": "⛔ Límite excedido"
-                }.get(estado, "🔄 Estado desconocido")
-                historial.append(
-                    f"🎟️ *Ticket #{ticket}*\n"
-                    f"👤 Usuario: {escape_markdown(username, True)}\n"
-                    f"✉️ Mensaje: {escape_markdown(message_text)}\n"
-                    f"📍 Grupo: {escape_markdown(chat_title)}\n"
-                    f"⏰ Gestionada: {fecha_gestion.strftime('%d/%m/%Y %H:%M:%S')}\n"
-                    f"👥 Admin: {admin_username}\n"
-                    f"📌 Estado: {estado_str}\n"
-                )
-            historial_message = f"📜 *Historial de Solicitudes Gestionadas (Página {page}/{total_pages})* ✅\n\n" + "\n".join(historial)
-            nav_buttons = [
-                InlineKeyboardButton("↩️ Menú", callback_data="menu_principal"),
-                InlineKeyboardButton("❌ Cerrar", callback_data="menu_close")
-            ]
-            if page > 1:
-                nav_buttons.insert(0, InlineKeyboardButton("⬅️ Anterior", callback_data=f"hist_page_{page-1}"))
-            if page < total_pages:
-                nav_buttons.append(InlineKeyboardButton("Siguiente ➡️", callback_data=f"hist_page_{page+1}"))
-            keyboard = [nav_buttons]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            sent_message = safe_bot_method(bot.send_message, chat_id=chat_id, text=historial_message, reply_markup=reply_markup, parse_mode='Markdown')
+            sent_message = safe_bot_method(bot.send_message, chat_id=chat_id, text=texto, reply_markup=reply_markup, parse_mode='Markdown')
             if sent_message:
-                menu_activos[(chat_id, sent_message.message_id)] = datetime.now(SPAIN_TZ)
-            safe_bot_method(query.message.delete)
+                registrar_menu(chat_id, sent_message.message_id)
+            borrar_menu(query.message)
             return
 
         if data == "menu_graficas":
-            with get_db_connection() as conn:
-                c = conn.cursor()
-                c.execute("SELECT estado, COUNT(*) as count FROM historial_solicitudes GROUP BY estado")
-                stats = dict(c.fetchall())
-
-            total = sum(stats.values())
-            stats_msg = (
-                f"📊 *Estadísticas de Solicitudes* ✅\n"
-                f"Total gestionadas: {total}\n"
-                f"✅ Aprobadas: {stats.get('subido', 0)}\n"
-                f"❌ Rechazadas: {stats.get('denegado', 0)}\n"
-                f"🗑️ Eliminadas: {stats.get('eliminado', 0)}\n"
-                f"⛔ Límite excedido: {stats.get('limite_excedido', 0)}"
-            )
             keyboard = [[InlineKeyboardButton("↩️ Menú", callback_data="menu_principal"), InlineKeyboardButton("❌ Cerrar", callback_data="menu_close")]]
             reply_markup = InlineKeyboardMarkup(keyboard)
-            sent_message = safe_bot_method(bot.send_message, chat_id=chat_id, text=stats_msg, reply_markup=reply_markup, parse_mode='Markdown')
+            sent_message = enviar_graficas(chat_id, reply_markup)
             if sent_message:
-                menu_activos[(chat_id, sent_message.message_id)] = datetime.now(SPAIN_TZ)
-            safe_bot_method(query.message.delete)
+                registrar_menu(chat_id, sent_message.message_id)
+            borrar_menu(query.message)
             return
 
         if data == "menu_grupos":
@@ -829,8 +3224,8 @@ def button_handler(update, context):
             if not grupos_estados:
                 keyboard = [[InlineKeyboardButton("↩️ Menú", callback_data="menu_principal"), InlineKeyboardButton("❌ Cerrar", callback_data="menu_close")]]
                 reply_markup = InlineKeyboardMarkup(keyboard)
-                safe_bot_method(bot.send_message, chat_id=chat_id, text="ℹ️ No hay grupos registrados actualmente. 😊", reply_markup=reply_markup, parse_mode='Markdown')
-                safe_bot_method(query.message.delete)
+                safe_bot_method_async(bot.send_message, chat_id=chat_id, text="ℹ️ No hay grupos registrados actualmente. 😊", reply_markup=reply_markup, parse_mode='Markdown')
+                borrar_menu(query.message)
                 return
             estado = "\n".join([f"📍 {info['title']}: {'✅ Activo' if info['activo'] else '⛔ Inactivo'} (ID: {gid})"
                                for gid, info in sorted(grupos_estados.items(), key=lambda x: x[1]['title'])])
@@ -838,8 +3233,8 @@ def button_handler(update, context):
             reply_markup = InlineKeyboardMarkup(keyboard)
             sent_message = safe_bot_method(bot.send_message, chat_id=chat_id, text=f"📋 *Estado de los Grupos* ✅\n{estado}", reply_markup=reply_markup, parse_mode='Markdown')
             if sent_message:
-                menu_activos[(chat_id, sent_message.message_id)] = datetime.now(SPAIN_TZ)
-            safe_bot_method(query.message.delete)
+                registrar_menu(chat_id, sent_message.message_id)
+            borrar_menu(query.message)
             return
 
         if data == "menu_on":
@@ -847,8 +3242,8 @@ def button_handler(update, context):
             if not grupos_estados:
                 keyboard = [[InlineKeyboardButton("↩️ Menú", callback_data="menu_principal"), InlineKeyboardButton("❌ Cerrar", callback_data="menu_close")]]
                 reply_markup = InlineKeyboardMarkup(keyboard)
-                safe_bot_method(bot.send_message, chat_id=chat_id, text="ℹ️ No hay grupos registrados actualmente. 😊", reply_markup=reply_markup, parse_mode='Markdown')
-                safe_bot_method(query.message.delete)
+                safe_bot_method_async(bot.send_message, chat_id=chat_id, text="ℹ️ No hay grupos registrados actualmente. 😊", reply_markup=reply_markup, parse_mode='Markdown')
+                borrar_menu(query.message)
                 return
             keyboard = [[InlineKeyboardButton(f"{info['title']} {'✅' if info['activo'] else '⛔'}",
                                             callback_data=f"select_on_{gid}")] 
@@ -857,13 +3252,12 @@ def button_handler(update, context):
                              InlineKeyboardButton("↩️ Menú", callback_data="menu_principal"),
                              InlineKeyboardButton("❌ Cerrar", callback_data="menu_close")])
             reply_markup = InlineKeyboardMarkup(keyboard)
-            grupos_seleccionados[chat_id] = {"accion": "on", "grupos": set(), "mensaje_id": None, "estado": "seleccion"}
             sent_message = safe_bot_method(bot.send_message, chat_id=chat_id, text="✅ *Activar solicitudes* 😊\nSelecciona los grupos:", 
                                           reply_markup=reply_markup, parse_mode='Markdown')
+            seleccion_grupos.set(chat_id, {"accion": "on", "grupos": [], "mensaje_id": sent_message.message_id if sent_message else None, "estado": "seleccion"})
             if sent_message:
-                grupos_seleccionados[chat_id]["mensaje_id"] = sent_message.message_id
-                menu_activos[(chat_id, sent_message.message_id)] = datetime.now(SPAIN_TZ)
-            safe_bot_method(query.message.delete)
+                registrar_menu(chat_id, sent_message.message_id)
+            borrar_menu(query.message)
             return
 
         if data == "menu_off":
@@ -871,8 +3265,8 @@ def button_handler(update, context):
             if not grupos_estados:
                 keyboard = [[InlineKeyboardButton("↩️ Menú", callback_data="menu_principal"), InlineKeyboardButton("❌ Cerrar", callback_data="menu_close")]]
                 reply_markup = InlineKeyboardMarkup(keyboard)
-                safe_bot_method(bot.send_message, chat_id=chat_id, text="ℹ️ No hay grupos registrados actualmente. 😊", reply_markup=reply_markup, parse_mode='Markdown')
-                safe_bot_method(query.message.delete)
+                safe_bot_method_async(bot.send_message, chat_id=chat_id, text="ℹ️ No hay grupos registrados actualmente. 😊", reply_markup=reply_markup, parse_mode='Markdown')
+                borrar_menu(query.message)
                 return
             keyboard = [[InlineKeyboardButton(f"{info['title']} {'✅' if info['activo'] else '⛔'}",
                                             callback_data=f"select_off_{gid}")] 
@@ -881,13 +3275,12 @@ def button_handler(update, context):
                              InlineKeyboardButton("↩️ Menú", callback_data="menu_principal"),
                              InlineKeyboardButton("❌ Cerrar", callback_data="menu_close")])
             reply_markup = InlineKeyboardMarkup(keyboard)
-            grupos_seleccionados[chat_id] = {"accion": "off", "grupos": set(), "mensaje_id": None, "estado": "seleccion"}
             sent_message = safe_bot_method(bot.send_message, chat_id=chat_id, text="⛔ *Desactivar solicitudes* 😊\nSelecciona los grupos:", 
                                           reply_markup=reply_markup, parse_mode='Markdown')
+            seleccion_grupos.set(chat_id, {"accion": "off", "grupos": [], "mensaje_id": sent_message.message_id if sent_message else None, "estado": "seleccion"})
             if sent_message:
-                grupos_seleccionados[chat_id]["mensaje_id"] = sent_message.message_id
-                menu_activos[(chat_id, sent_message.message_id)] = datetime.now(SPAIN_TZ)
-            safe_bot_method(query.message.delete)
+                registrar_menu(chat_id, sent_message.message_id)
+            borrar_menu(query.message)
             return
 
         if data == "menu_sumar":
@@ -895,8 +3288,8 @@ def button_handler(update, context):
             reply_markup = InlineKeyboardMarkup(keyboard)
             sent_message = safe_bot_method(bot.send_message, chat_id=chat_id, text="➕ *Aumentar solicitudes* 😊\nEscribe: /sumar @username [número]", reply_markup=reply_markup, parse_mode='Markdown')
             if sent_message:
-                menu_activos[(chat_id, sent_message.message_id)] = datetime.now(SPAIN_TZ)
-            safe_bot_method(query.message.delete)
+                registrar_menu(chat_id, sent_message.message_id)
+            borrar_menu(query.message)
             return
 
         if data == "menu_restar":
@@ -904,18 +3297,20 @@ def button_handler(update, context):
             reply_markup = InlineKeyboardMarkup(keyboard)
             sent_message = safe_bot_method(bot.send_message, chat_id=chat_id, text="➖ *Reducir solicitudes* 😊\nEscribe: /restar @username [número]", reply_markup=reply_markup, parse_mode='Markdown')
             if sent_message:
-                menu_activos[(chat_id, sent_message.message_id)] = datetime.now(SPAIN_TZ)
-            safe_bot_method(query.message.delete)
+                registrar_menu(chat_id, sent_message.message_id)
+            borrar_menu(query.message)
             return
 
         if data == "menu_clean":
-            clean_database()
+            # La limpieza va por lotes con pausas y puede durar minutos: se pide al líder de las tareas
+            # programadas, que la ejecuta en segundo plano sin solaparla con la limpieza programada
+            solicitar_tarea("limpieza")
             keyboard = [[InlineKeyboardButton("↩️ Menú", callback_data="menu_principal"), InlineKeyboardButton("❌ Cerrar", callback_data="menu_close")]]
             reply_markup = InlineKeyboardMarkup(keyboard)
-            sent_message = safe_bot_method(bot.send_message, chat_id=chat_id, text="🧹 *Limpieza manual iniciada* ✅\nLos datos obsoletos han sido eliminados.", reply_markup=reply_markup, parse_mode='Markdown')
+            sent_message = safe_bot_method(bot.send_message, chat_id=chat_id, text="🧹 *Limpieza manual iniciada* ✅\nLos datos obsoletos se están eliminando en segundo plano; el resultado se publicará en este chat.", reply_markup=reply_markup, parse_mode='Markdown')
             if sent_message:
-                menu_activos[(chat_id, sent_message.message_id)] = datetime.now(SPAIN_TZ)
-            safe_bot_method(query.message.delete)
+                registrar_menu(chat_id, sent_message.message_id)
+            borrar_menu(query.message)
             return
 
         if data == "menu_ping":
@@ -923,8 +3318,32 @@ def button_handler(update, context):
             reply_markup = InlineKeyboardMarkup(keyboard)
             sent_message = safe_bot_method(bot.send_message, chat_id=chat_id, text=random.choice(ping_respuestas), reply_markup=reply_markup, parse_mode='Markdown')
             if sent_message:
-                menu_activos[(chat_id, sent_message.message_id)] = datetime.now(SPAIN_TZ)
-            safe_bot_method(query.message.delete)
+                registrar_menu(chat_id, sent_message.message_id)
+            borrar_menu(query.message)
+            return
+
+        if data == "menu_buscar":
+            marcar_busqueda_en_espera(update.effective_user.id)
+            keyboard = [[InlineKeyboardButton("↩️ Menú", callback_data="menu_principal"), InlineKeyboardButton("❌ Cerrar", callback_data="menu_close")]]
+            reply_markup = InlineKeyboardMarkup(keyboard)
+            sent_message = safe_bot_method(bot.send_message, chat_id=chat_id, text=f"👤 {admin_username}\n{AYUDA_BUSQUEDA}", reply_markup=reply_markup, parse_mode='Markdown')
+            if sent_message:
+                registrar_menu(chat_id, sent_message.message_id)
+            borrar_menu(query.message)
+            return
+
+        if data.startswith("dup_"):
+            enviar_busqueda(chat_id, f"#{int(data.split('_')[1])}")
+            return
+
+        if data.startswith("busq_"):
+            _, clave, page = data.split("_")
+            texto, reply_markup = render_busqueda(clave, int(page))
+            if not texto:
+                safe_bot_method_async(query.edit_message_text, text="⌛ La búsqueda ha caducado. Vuelve a lanzarla con /buscar. 😊", parse_mode='Markdown')
+                return
+            safe_bot_method_async(query.edit_message_text, text=texto, reply_markup=reply_markup, parse_mode='Markdown')
+            registrar_menu(chat_id, query.message.message_id)
             return
 
         if data == "menu_stats":
@@ -940,165 +3359,104 @@ def button_handler(update, context):
             reply_markup = InlineKeyboardMarkup(keyboard)
             sent_message = safe_bot_method(bot.send_message, chat_id=chat_id, text=stats_msg, reply_markup=reply_markup, parse_mode='Markdown')
             if sent_message:
-                menu_activos[(chat_id, sent_message.message_id)] = datetime.now(SPAIN_TZ)
-            safe_bot_method(query.message.delete)
+                registrar_menu(chat_id, sent_message.message_id)
+            borrar_menu(query.message)
             return
 
         if data.startswith("select_") or data.startswith("confirm_"):
-            if chat_id not in grupos_seleccionados:
+            seleccion, version = seleccion_grupos.leer(chat_id)
+            if not seleccion:
                 return
-            estado = grupos_seleccionados[chat_id]["estado"]
+            estado = seleccion["estado"]
 
             if estado == "seleccion" and (data.startswith("select_on_") or data.startswith("select_off_")):
                 accion = "on" if data.startswith("select_on_") else "off"
                 grupo_id = int(data.split("_")[2])
-                if grupo_id in grupos_seleccionados[chat_id]["grupos"]:
-                    grupos_seleccionados[chat_id]["grupos"].remove(grupo_id)
-                else:
-                    grupos_seleccionados[chat_id]["grupos"].add(grupo_id)
+                seleccion = seleccion_grupos.actualizar(chat_id, lambda sel: {**sel, "grupos": sorted(set(sel["grupos"]) ^ {grupo_id})})
+                if not seleccion:
+                    return
                 grupos_estados = get_grupos_estados()
-                keyboard = [[InlineKeyboardButton(f"{info['title']} {'✅' if info['activo'] else '⛔'}{' ✅' if gid in grupos_seleccionados[chat_id]['grupos'] else ''}",
+                keyboard = [[InlineKeyboardButton(f"{info['title']} {'✅' if info['activo'] else '⛔'}{' ✅' if gid in seleccion['grupos'] else ''}",
                                                 callback_data=f"select_{accion}_{gid}")] for gid, info in grupos_estados.items()]
                 keyboard.append([InlineKeyboardButton("✅ Confirmar", callback_data=f"confirm_{accion}"),
                                  InlineKeyboardButton("↩️ Menú", callback_data="menu_principal"),
                                  InlineKeyboardButton("❌ Cerrar", callback_data="menu_close")])
                 reply_markup = InlineKeyboardMarkup(keyboard)
-                safe_bot_method(query.edit_message_text, text=f"{'✅' if accion == 'on' else '⛔'} *{'Activar' if accion == 'on' else 'Desactivar'} solicitudes* 😊\nSelecciona los grupos:", 
+                safe_bot_method_async(query.edit_message_text, text=f"{'✅' if accion == 'on' else '⛔'} *{'Activar' if accion == 'on' else 'Desactivar'} solicitudes* 😊\nSelecciona los grupos:", 
                                         reply_markup=reply_markup, parse_mode='Markdown')
-                menu_activos[(chat_id, query.message.message_id)] = datetime.now(SPAIN_TZ)
+                registrar_menu(chat_id, query.message.message_id)
                 return
 
             if estado == "seleccion" and (data == "confirm_on" or data == "confirm_off"):
                 accion = "on" if data == "confirm_on" else "off"
-                if not grupos_seleccionados[chat_id]["grupos"]:
+                if not seleccion["grupos"]:
                     keyboard = [[InlineKeyboardButton("↩️ Menú", callback_data="menu_principal"), InlineKeyboardButton("❌ Cerrar", callback_data="menu_close")]]
                     reply_markup = InlineKeyboardMarkup(keyboard)
-                    safe_bot_method(query.edit_message_text, text=f"ℹ️ No se seleccionaron grupos para {'activar' if accion == 'on' else 'desactivar'}. 😊", reply_markup=reply_markup, parse_mode='Markdown')
-                    del grupos_seleccionados[chat_id]
+                    safe_bot_method_async(query.edit_message_text, text=f"ℹ️ No se seleccionaron grupos para {'activar' if accion == 'on' else 'desactivar'}. 😊", reply_markup=reply_markup, parse_mode='Markdown')
+                    seleccion_grupos.delete(chat_id)
+                    return
+                # Cada paso avanza el estado con compare-and-set: un doble clic atendido por dos workers avanza una sola vez
+                if seleccion_grupos.compare_and_set(chat_id, {**seleccion, "estado": "confirmacion"}, version) is None:
                     return
                 keyboard = [
                     [InlineKeyboardButton("✅ Confirmar", callback_data=f"confirm_{accion}_final")],
                     [InlineKeyboardButton("❌ Cancelar", callback_data="menu_principal")]
                 ]
                 reply_markup = InlineKeyboardMarkup(keyboard)
-                safe_bot_method(query.edit_message_text, text=f"{'✅' if accion == 'on' else '⛔'} *Confirmar acción* 😊\n¿{'Activar' if accion == 'on' else 'Desactivar'} solicitudes en {len(grupos_seleccionados[chat_id]['grupos'])} grupo(s)?", 
+                safe_bot_method_async(query.edit_message_text, text=f"{'✅' if accion == 'on' else '⛔'} *Confirmar acción* 😊\n¿{'Activar' if accion == 'on' else 'Desactivar'} solicitudes en {len(seleccion['grupos'])} grupo(s)?", 
                                         reply_markup=reply_markup, parse_mode='Markdown')
-                grupos_seleccionados[chat_id]["estado"] = "confirmacion"
-                menu_activos[(chat_id, query.message.message_id)] = datetime.now(SPAIN_TZ)
+                registrar_menu(chat_id, query.message.message_id)
                 return
 
             if estado == "confirmacion" and (data == "confirm_on_final" or data == "confirm_off_final"):
                 accion = "on" if data == "confirm_on_final" else "off"
+                if seleccion_grupos.compare_and_set(chat_id, {**seleccion, "estado": "alerta"}, version) is None:
+                    return
                 keyboard = [
                     [InlineKeyboardButton("✅ Con Alerta", callback_data=f"confirm_{accion}_alert_yes"),
                      InlineKeyboardButton("❌ Sin Alerta", callback_data=f"confirm_{accion}_alert_no")],
                     [InlineKeyboardButton("↩️ Menú", callback_data="menu_principal"), InlineKeyboardButton("❌ Cerrar", callback_data="menu_close")]
                 ]
                 reply_markup = InlineKeyboardMarkup(keyboard)
-                safe_bot_method(query.edit_message_text, text=f"{'✅' if accion == 'on' else '⛔'} *Notificar grupos* 😊\n¿Enviar alerta a los grupos afectados?", 
+                safe_bot_method_async(query.edit_message_text, text=f"{'✅' if accion == 'on' else '⛔'} *Notificar grupos* 😊\n¿Enviar alerta a los grupos afectados?", 
                                         reply_markup=reply_markup, parse_mode='Markdown')
-                grupos_seleccionados[chat_id]["estado"] = "alerta"
-                menu_activos[(chat_id, query.message.message_id)] = datetime.now(SPAIN_TZ)
+                registrar_menu(chat_id, query.message.message_id)
                 return
 
             if estado == "alerta" and (data.startswith("confirm_on_alert_") or data.startswith("confirm_off_alert_")):
                 accion = "on" if data.startswith("confirm_on") else "off"
                 notify = data.endswith("yes")
+                if not seleccion_grupos.delete(chat_id, version):  # Otro worker ya aplicó este paso
+                    return
                 grupos_estados = get_grupos_estados()
-                for grupo_id in grupos_seleccionados[chat_id]["grupos"]:
+                for grupo_id in seleccion["grupos"]:
                     set_grupo_estado(grupo_id, grupos_estados[grupo_id]["title"], accion == "on")
                     if notify:
                         canal_info = CANALES_PETICIONES.get(grupo_id, {"chat_id": grupo_id, "thread_id": None})
-                        mensaje = "✅ *Solicitudes activadas* 😊\nPuedes enviar hasta 2 solicitudes por día." if accion == "on" else \
+                        mensaje = f"✅ *Solicitudes activadas* 😊\nPuedes enviar hasta {limite_de(grupo_id)} solicitudes por día." if accion == "on" else \
                                   "⛔ *Solicitudes desactivadas* 😊\nNo se aceptan nuevas solicitudes hasta nuevo aviso."
-                        safe_bot_method(bot.send_message, chat_id=canal_info["chat_id"], text=mensaje, parse_mode='Markdown', message_thread_id=canal_info["thread_id"])
+                        safe_bot_method_async(bot.send_message, chat_id=canal_info["chat_id"], text=mensaje, parse_mode='Markdown', message_thread_id=canal_info["thread_id"])
                 texto = f"{'✅' if accion == 'on' else '⛔'} *Solicitudes {'activadas' if accion == 'on' else 'desactivadas'} {'y notificadas' if notify else ''}.* 😊"
                 keyboard = [[InlineKeyboardButton("↩️ Menú", callback_data="menu_principal"), InlineKeyboardButton("❌ Cerrar", callback_data="menu_close")]]
                 reply_markup = InlineKeyboardMarkup(keyboard)
-                safe_bot_method(query.edit_message_text, text=texto, reply_markup=reply_markup, parse_mode='Markdown')
-                del grupos_seleccionados[chat_id]
-                menu_activos[(chat_id, query.message.message_id)] = datetime.now(SPAIN_TZ)
+                safe_bot_method_async(query.edit_message_text, text=texto, reply_markup=reply_markup, parse_mode='Markdown')
+                registrar_menu(chat_id, query.message.message_id)
                 return
 
         if data.startswith("pend_") or data.startswith("hist_"):
-            if data.startswith("pend_page_"):
-                page = int(data.split("_")[2])
-                with get_db_connection() as conn:
-                    c = conn.cursor()
-                    c.execute("SELECT ticket_number, username, chat_title FROM peticiones_registradas ORDER BY ticket_number")
-                    pendientes = c.fetchall()
-                ITEMS_PER_PAGE = 5
-                total_pages = (len(pendientes) + ITEMS_PER_PAGE - 1) // ITEMS_PER_PAGE
-                if page < 1 or page > total_pages:
-                    return
-                start_idx = (page - 1) * ITEMS_PER_PAGE
-                end_idx = start_idx + ITEMS_PER_PAGE
-                page_items = pendientes[start_idx:end_idx]
-
-                keyboard = [[InlineKeyboardButton(f"#{ticket} - {escape_markdown(username, True)} ({escape_markdown(chat_title)})",
-                                                callback_data=f"pend_{ticket}")] for ticket, username, chat_title in page_items]
-                nav_buttons = [
-                    InlineKeyboardButton("↩️ Menú", callback_data="menu_principal"),
-                    InlineKeyboardButton("❌ Cerrar", callback_data="menu_close")
-                ]
-                if page > 1:
-                    nav_buttons.insert(0, InlineKeyboardButton("⬅️ Anterior", callback_data=f"pend_page_{page-1}"))
-                if page < total_pages:
-                    nav_buttons.append(InlineKeyboardButton("Siguiente ➡️", callback_data=f"pend_page_{page+1}"))
-                keyboard.append(nav_buttons)
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                safe_bot_method(query.edit_message_text, text=f"📋 *Solicitudes Pendientes (Página {page}/{total_pages})* ✅\nSelecciona una solicitud:", 
-                                        reply_markup=reply_markup, parse_mode='Markdown')
-                menu_activos[(chat_id, query.message.message_id)] = datetime.now(SPAIN_TZ)
-                return
-
-            if data.startswith("hist_page_"):
-                page = int(data.split("_")[2])
-                with get_db_connection() as conn:
-                    c = conn.cursor()
-                    c.execute("SELECT ticket_number, username, message_text, chat_title, estado, fecha_gestion, admin_username "
-                              "FROM historial_solicitudes ORDER BY ticket_number DESC")
-                    solicitudes = c.fetchall()
-                ITEMS_PER_PAGE = 5
-                total_pages = (len(solicitudes) + ITEMS_PER_PAGE - 1) // ITEMS_PER_PAGE
-                if page < 1 or page > total_pages:
-                    return
-                start_idx = (page - 1) * ITEMS_PER_PAGE
-                end_idx = start_idx + ITEMS_PER_PAGE
-                page_items = solicitudes[start_idx:end_idx]
-
-                historial = []
-                for row in page_items:
-                    ticket, username, message_text, chat_title, estado, fecha_gestion, admin_username = row
-                    estado_str = {
-                        "subido": "✅ Aprobada",
-                        "denegado": "❌ Rechazada",
-                        "eliminado": "🗑️ Eliminada",
-                        "notificado": "📢 Respondida",
-                        "limite_excedido": "⛔ Límite excedido"
-                    }.get(estado, "🔄 Estado desconocido")
-                    historial.append(
-                        f"🎟️ *Ticket #{ticket}*\n"
-                        f"👤 Usuario: {escape_markdown(username, True)}\n"
-                        f"✉️ Mensaje: {escape_markdown(message_text)}\n"
-                        f"📍 Grupo: {escape_markdown(chat_title)}\n"
-                        f"⏰ Gestionada: {fecha_gestion.strftime('%d/%m/%Y %H:%M:%S')}\n"
-                        f"👥 Admin: {admin_username}\n"
-                        f"📌 Estado: {estado_str}\n"
-                    )
-                historial_message = f"📜 *Historial de Solicitudes Gestionadas (Página {page}/{total_pages})* ✅\n\n" + "\n".join(historial)
-                nav_buttons = [
-                    InlineKeyboardButton("↩️ Menú", callback_data="menu_principal"),
-                    InlineKeyboardButton("❌ Cerrar", callback_data="menu_close")
-                ]
-                if page > 1:
-                    nav_buttons.insert(0, InlineKeyboardButton("⬅️ Anterior", callback_data=f"hist_page_{page-1}"))
-                if page < total_pages:
-                    nav_buttons.append(InlineKeyboardButton("Siguiente ➡️", callback_data=f"hist_page_{page+1}"))
-                keyboard = [nav_buttons]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                safe_bot_method(query.edit_message_text, text=historial_message, reply_markup=reply_markup, parse_mode='Markdown')
-                menu_activos[(chat_id, query.message.message_id)] = datetime.now(SPAIN_TZ)
+            if data.startswith("pend_page_") or data.startswith("hist_page_"):
+                page, direccion, cursor_ticket = parse_pagina(data)
+                if data.startswith("pend_page_"):
+                    texto, reply_markup = render_pendientes(page, direccion, cursor_ticket)
+                    vacio = "ℹ️ No hay solicitudes pendientes en este momento. 😊"
+                else:
+                    texto, reply_markup = render_historial(page, direccion, cursor_ticket)
+                    vacio = "ℹ️ No hay solicitudes gestionadas en el historial. 😊"
+                if not texto:
+                    keyboard = [[InlineKeyboardButton("↩️ Menú", callback_data="menu_principal"), InlineKeyboardButton("❌ Cerrar", callback_data="menu_close")]]
+                    texto, reply_markup = vacio, InlineKeyboardMarkup(keyboard)
+                safe_bot_method_async(query.edit_message_text, text=texto, reply_markup=reply_markup, parse_mode='Markdown')
+                registrar_menu(chat_id, query.message.message_id)
                 return
 
             ticket = int(data.split("_")[1])
@@ -1106,8 +3464,8 @@ def button_handler(update, context):
             if not info:
                 keyboard = [[InlineKeyboardButton("↩️ Pendientes", callback_data="pend_page_1"), InlineKeyboardButton("❌ Cerrar", callback_data="menu_close")]]
                 reply_markup = InlineKeyboardMarkup(keyboard)
-                safe_bot_method(query.edit_message_text, text=f"❌ El Ticket #{ticket} no se encuentra disponible. 😊", reply_markup=reply_markup, parse_mode='Markdown')
-                menu_activos[(chat_id, query.message.message_id)] = datetime.now(SPAIN_TZ)
+                safe_bot_method_async(query.edit_message_text, text=f"❌ El Ticket #{ticket} no se encuentra disponible. 😊", reply_markup=reply_markup, parse_mode='Markdown')
+                registrar_menu(chat_id, query.message.message_id)
                 return
 
             if len(data.split("_")) == 2:  # Mostrar opciones iniciales
@@ -1118,17 +3476,11 @@ def button_handler(update, context):
                     [InlineKeyboardButton("↩️ Pendientes", callback_data="pend_page_1"), InlineKeyboardButton("❌ Cerrar", callback_data="menu_close")]
                 ]
                 reply_markup = InlineKeyboardMarkup(keyboard)
-                texto = (
-                    f"📋 *Solicitud #{ticket}* ✅\n"
-                    f"👤 Usuario: {escape_markdown(info['username'], True)}\n"
-                    f"✉️ Mensaje: {escape_markdown(info['message_text'])}\n"
-                    f"📍 Grupo: {escape_markdown(info['chat_title'])}\n"
-                    f"⏰ Fecha: {info['timestamp'].strftime('%d/%m/%Y %H:%M:%S')}\n"
-                    f"📎 Adjunto: {'Sí' if info['has_attachment'] else 'No'}\n"
-                    "Selecciona una acción:"
-                )
-                safe_bot_method(query.edit_message_text, text=texto, reply_markup=reply_markup, parse_mode='Markdown')
-                menu_activos[(chat_id, query.message.message_id)] = datetime.now(SPAIN_TZ)
+                texto = PLANTILLA_DETALLE.render(ticket=ticket, username=info['username'], message_text=info['message_text'],
+                                                 chat_title=info['chat_title'], fecha=info['timestamp'],
+                                                 adjunto='Sí' if info['has_attachment'] else 'No')
+                safe_bot_method_async(query.edit_message_text, text=texto, reply_markup=reply_markup, parse_mode='Markdown')
+                registrar_menu(chat_id, query.message.message_id)
                 return
 
             if len(data.split("_")) == 3 and data.split("_")[2] in ["subido", "denegado", "eliminar"]:  # Mostrar confirmación
@@ -1140,8 +3492,8 @@ def button_handler(update, context):
                 ]
                 reply_markup = InlineKeyboardMarkup(keyboard)
                 texto = f"📋 *Confirmar acción* ✅\n¿Marcar el Ticket #{ticket} como {accion_str}? 🔍\n(Hora: {datetime.now(SPAIN_TZ).strftime('%H:%M:%S')})"
-                safe_bot_method(query.edit_message_text, text=texto, reply_markup=reply_markup, parse_mode='Markdown')
-                menu_activos[(chat_id, query.message.message_id)] = datetime.now(SPAIN_TZ)
+                safe_bot_method_async(query.edit_message_text, text=texto, reply_markup=reply_markup, parse_mode='Markdown')
+                registrar_menu(chat_id, query.message.message_id)
                 return
 
             if data.endswith("subido_confirm"):  # Preguntar por URL
@@ -1152,7 +3504,8 @@ def button_handler(update, context):
                     "chat_title": info["chat_title"],
                     "estado": "subido",
                     "fecha_gestion": datetime.now(SPAIN_TZ),
-                    "admin_username": admin_username
+                    "admin_username": admin_username,
+                    "fecha_solicitud": info["timestamp"]
                 })
                 keyboard = [
                     [InlineKeyboardButton("🔗 Con URL", callback_data=f"pend_{ticket}_subido_url_yes"),
@@ -1161,40 +3514,40 @@ def button_handler(update, context):
                 ]
                 reply_markup = InlineKeyboardMarkup(keyboard)
                 texto = f"✅ *Ticket #{ticket} procesado como Aprobado* 😊\n¿Deseas agregar una URL al mensaje de notificación?"
-                safe_bot_method(query.edit_message_text, text=texto, reply_markup=reply_markup, parse_mode='Markdown')
-                menu_activos[(chat_id, query.message.message_id)] = datetime.now(SPAIN_TZ)
+                safe_bot_method_async(query.edit_message_text, text=texto, reply_markup=reply_markup, parse_mode='Markdown')
+                registrar_menu(chat_id, query.message.message_id)
                 return
 
             if data.endswith("subido_url_yes"):  # Solicitar URL
-                pending_urls[update.effective_user.id] = {"ticket": ticket, "url": None}
+                urls_pendientes.set(update.effective_user.id, {"ticket": ticket, "url": None})
                 keyboard = [
                     [InlineKeyboardButton("↩️ Pendientes", callback_data="pend_page_1"), InlineKeyboardButton("❌ Cerrar", callback_data="menu_close")]
                 ]
                 reply_markup = InlineKeyboardMarkup(keyboard)
                 texto = f"🔗 *Añadir URL para Ticket #{ticket}* ✅\nPor favor, envía la URL como mensaje (ejemplo: https://ejemplo.com)"
-                safe_bot_method(query.edit_message_text, text=texto, reply_markup=reply_markup, parse_mode='Markdown')
-                menu_activos[(chat_id, query.message.message_id)] = datetime.now(SPAIN_TZ)
+                safe_bot_method_async(query.edit_message_text, text=texto, reply_markup=reply_markup, parse_mode='Markdown')
+                registrar_menu(chat_id, query.message.message_id)
                 return
 
             if data.endswith("subido_url_edit"):  # Editar URL
-                user_id = update.effective_user.id
-                if user_id in pending_urls and pending_urls[user_id]["ticket"] == ticket:
-                    del pending_urls[user_id]
-                pending_urls[user_id] = {"ticket": ticket, "url": None}
+                urls_pendientes.set(update.effective_user.id, {"ticket": ticket, "url": None})
                 keyboard = [
                     [InlineKeyboardButton("↩️ Pendientes", callback_data="pend_page_1"), InlineKeyboardButton("❌ Cerrar", callback_data="menu_close")]
                 ]
                 reply_markup = InlineKeyboardMarkup(keyboard)
                 texto = f"✏️ *Editar URL para Ticket #{ticket}* ✅\nPor favor, envía la nueva URL como mensaje (ejemplo: https://ejemplo.com)"
-                safe_bot_method(query.edit_message_text, text=texto, reply_markup=reply_markup, parse_mode='Markdown')
-                menu_activos[(chat_id, query.message.message_id)] = datetime.now(SPAIN_TZ)
+                safe_bot_method_async(query.edit_message_text, text=texto, reply_markup=reply_markup, parse_mode='Markdown')
+                registrar_menu(chat_id, query.message.message_id)
                 return
 
             if data.endswith("subido_url_confirm"):  # Confirmar y enviar con URL
                 user_id = update.effective_user.id
-                if user_id not in pending_urls or pending_urls[user_id]["ticket"] != ticket:
+                pendiente, version = urls_pendientes.leer(user_id)
+                if not pendiente or pendiente["ticket"] != ticket:
                     return
-                url = pending_urls[user_id]["url"]
+                if not urls_pendientes.delete(user_id, version):  # Confirmación ya atendida por otro worker
+                    return
+                url = pendiente["url"]
                 set_historial_solicitud(ticket, {
                     "chat_id": info["chat_id"],
                     "username": info["username"],
@@ -1203,19 +3556,19 @@ def button_handler(update, context):
                     "estado": "subido",
                     "fecha_gestion": datetime.now(SPAIN_TZ),
                     "admin_username": admin_username,
-                    "url": url
+                    "url": url,
+                    "fecha_solicitud": info["timestamp"]
                 })
                 canal_info = CANALES_PETICIONES.get(info["chat_id"], {"chat_id": info["chat_id"], "thread_id": info["thread_id"]})
-                safe_bot_method(bot.send_message, chat_id=canal_info["chat_id"], 
-                                text=f"✅ {escape_markdown(info['username'], True)}, tu solicitud (Ticket #{ticket}) \"{escape_markdown(info['message_text'])}\" ha sido aprobada por el *Equipo de EntresHijos*. Aquí tienes el enlace: {url}\nGracias por tu paciencia! 😊", 
+                safe_bot_method_async(bot.send_message, chat_id=canal_info["chat_id"], 
+                                text=PLANTILLA_APROBADA_URL.render(username=info['username'], ticket=ticket, message_text=info['message_text'], url=url), 
                                 parse_mode='Markdown', message_thread_id=canal_info["thread_id"])
                 del_peticion_registrada(ticket)
-                del pending_urls[user_id]
                 keyboard = [[InlineKeyboardButton("↩️ Pendientes", callback_data="pend_page_1"), InlineKeyboardButton("❌ Cerrar", callback_data="menu_close")]]
                 reply_markup = InlineKeyboardMarkup(keyboard)
                 texto = f"✅ *Ticket #{ticket} procesado y notificado con URL* 😊\n(Finalizado: {datetime.now(SPAIN_TZ).strftime('%H:%M:%S')})"
-                safe_bot_method(query.edit_message_text, text=texto, reply_markup=reply_markup, parse_mode='Markdown')
-                menu_activos[(chat_id, query.message.message_id)] = datetime.now(SPAIN_TZ)
+                safe_bot_method_async(query.edit_message_text, text=texto, reply_markup=reply_markup, parse_mode='Markdown')
+                registrar_menu(chat_id, query.message.message_id)
                 return
 
             if data.endswith("subido_url_no") or data.endswith("denegado_confirm") or data.endswith("eliminar_confirm"):  # Procesar sin URL o denegado/eliminar
@@ -1229,7 +3582,8 @@ def button_handler(update, context):
                         "chat_title": info["chat_title"],
                         "estado": accion,
                         "fecha_gestion": datetime.now(SPAIN_TZ),
-                        "admin_username": admin_username
+                        "admin_username": admin_username,
+                        "fecha_solicitud": info["timestamp"]
                     })
                 keyboard = [
                     [InlineKeyboardButton("↩️ Pendientes", callback_data="pend_page_1"), 
@@ -1238,17 +3592,17 @@ def button_handler(update, context):
                 reply_markup = InlineKeyboardMarkup(keyboard)
                 canal_info = CANALES_PETICIONES.get(info["chat_id"], {"chat_id": info["chat_id"], "thread_id": info["thread_id"]})
                 if accion == "subido":
-                    safe_bot_method(bot.send_message, chat_id=canal_info["chat_id"], 
-                                    text=f"✅ {escape_markdown(info['username'], True)}, tu solicitud (Ticket #{ticket}) \"{escape_markdown(info['message_text'])}\" ha sido aprobada por el *Equipo de EntresHijos*.\n{random.choice(frases_agradecimiento)}", 
+                    safe_bot_method_async(bot.send_message, chat_id=canal_info["chat_id"], 
+                                    text=PLANTILLA_APROBADA.render(username=info['username'], ticket=ticket, message_text=info['message_text'], frase=random.choice(frases_agradecimiento)), 
                                     parse_mode='Markdown', message_thread_id=canal_info["thread_id"])
                 elif accion == "denegado":
-                    safe_bot_method(bot.send_message, chat_id=canal_info["chat_id"], 
-                                    text=f"❌ {escape_markdown(info['username'], True)}, tu solicitud (Ticket #{ticket}) \"{escape_markdown(info['message_text'])}\" ha sido rechazada por el *Equipo de EntresHijos*. Contacta a un administrador para más detalles.", 
+                    safe_bot_method_async(bot.send_message, chat_id=canal_info["chat_id"], 
+                                    text=PLANTILLA_RECHAZADA.render(username=info['username'], ticket=ticket, message_text=info['message_text']), 
                                     parse_mode='Markdown', message_thread_id=canal_info["thread_id"])
                 del_peticion_registrada(ticket)
                 texto = f"✅ *Ticket #{ticket} procesado como {accion_str}* 😊\n(Finalizado: {datetime.now(SPAIN_TZ).strftime('%H:%M:%S')})"
-                safe_bot_method(query.edit_message_text, text=texto, reply_markup=reply_markup, parse_mode='Markdown')
-                menu_activos[(chat_id, query.message.message_id)] = datetime.now(SPAIN_TZ)
+                safe_bot_method_async(query.edit_message_text, text=texto, reply_markup=reply_markup, parse_mode='Markdown')
+                registrar_menu(chat_id, query.message.message_id)
                 return
 
             if data.endswith("_cancel"):  # Cancelar acción
@@ -1258,94 +3612,250 @@ def button_handler(update, context):
                 ]
                 reply_markup = InlineKeyboardMarkup(keyboard)
                 texto = f"❌ *Acción cancelada para Ticket #{ticket}* 😊\nVuelve a seleccionar una opción si deseas continuar."
-                safe_bot_method(query.edit_message_text, text=texto, reply_markup=reply_markup, parse_mode='Markdown')
-                menu_activos[(chat_id, query.message.message_id)] = datetime.now(SPAIN_TZ)
+                safe_bot_method_async(query.edit_message_text, text=texto, reply_markup=reply_markup, parse_mode='Markdown')
+                registrar_menu(chat_id, query.message.message_id)
                 return
 
-            except Exception as e:
-            logger.error(f"Error en button_handler: {str(e)}")
-            keyboard = [[InlineKeyboardButton("↩️ Menú", callback_data="menu_principal"), InlineKeyboardButton("❌ Cerrar", callback_data="menu_close")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            safe_bot_method(query.edit_message_text, text="❌ Ocurrió un error al procesar la acción. Por favor, intenta de nuevo.", reply_markup=reply_markup, parse_mode='Markdown')
+    except Exception as e:
+        logger.error(f"Error en button_handler: {str(e)}")
+        keyboard = [[InlineKeyboardButton("↩️ Menú", callback_data="menu_principal"), InlineKeyboardButton("❌ Cerrar", callback_data="menu_close")]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        safe_bot_method_async(query.edit_message_text, text="❌ Ocurrió un error al procesar la acción. Por favor, intenta de nuevo.", reply_markup=reply_markup, parse_mode='Markdown')
+        return
+
+# Rutas de Flask para el webhook
+@app.route('/', methods=['GET', 'HEAD'])
+def index():
+    return "Bot de Entreshijos está funcionando!", 200
+
+# Arranque de los servicios de cada proceso: el bloque __main__ o, bajo gunicorn, el hook post_fork de
+# gunicorn.conf.py (las migraciones ya las ha aplicado on_starting y aquí solo se comprueba la versión)
+_servicios_pid = None
+_servicios_lock = threading.Lock()
+
+def iniciar_servicios():
+    global _servicios_pid
+    if _servicios_pid == os.getpid():
+        return
+    with _servicios_lock:
+        if _servicios_pid == os.getpid():
             return
+        init_db()
+        threading.Thread(target=escuchar_notificaciones, daemon=True).start()
+        threading.Thread(target=planificador_menus, daemon=True).start()
+        threading.Thread(target=ejecutor_tareas, daemon=True).start()
+        iniciar_workers_webhook()
+        _servicios_pid = os.getpid()
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    return jsonify({"pid": os.getpid(), "db_pool": get_pool_stats(), "webhook": get_webhook_stats(),
+                    "telegram": obtener_bandeja().estadisticas() if OUTBOX_WORKERS > 0 else {},
+                    "jobs": get_jobs_estado(), "similares": indice_similares.estadisticas()}), 200
+
+# Cola de ingesta particionada por chat: cada worker atiende su partición, así se conserva el orden
+# de las actualizaciones de un mismo chat mientras chats distintos se procesan en paralelo
+_colas_webhook = []
+_workers_webhook = []
+_webhook_aceptando = True
+_webhook_stats = {"recibidas": 0, "encoladas": 0, "rechazadas": 0, "procesadas": 0, "errores": 0, "profundidad_max": 0}
+_webhook_stats_lock = threading.Lock()
+
+def _contar_webhook(clave, n=1):
+    with _webhook_stats_lock:
+        _webhook_stats[clave] += n
+
+def procesar_update(update):
+    _contexto_update.activo = True
+    _contexto_update.db = _contexto_update.api = 0
+    _contexto_update.handler = "ninguno"
+    try:
+        dispatcher.process_update(update)
+        _contar_webhook("procesadas")
+    except Exception as e:
+        _contar_webhook("errores")
+        logger.error(f"Error al procesar la actualización {update.update_id}: {str(e)}")
+    finally:
+        _contexto_update.activo = False
+        metricas.observar("bot_update_db_queries", _contexto_update.db, handler=_contexto_update.handler)
+        metricas.observar("bot_update_api_calls", _contexto_update.api, handler=_contexto_update.handler)
 
-        # Rutas de Flask para el webhook
-        @app.route('/', methods=['GET', 'HEAD'])
-        def index():
-            return "Bot de Entreshijos está funcionando!", 200
+def worker_webhook(cola):
+    while True:
+        update = cola.get()
+        try:
+            if update is None:
+                return
+            procesar_update(update)
+        finally:
+            cola.task_done()
 
-        @app.route('/webhook', methods=['POST'])
-        def webhook():
-            try:
-                update = telegram.Update.de_json(request.get_json(force=True), bot)
-                if update:
-                    logger.debug(f"Procesando actualización: {update}")
-                    dispatcher.process_update(update)
-                    logger.debug("Actualización procesada correctamente")
-                    return 'OK', 200
-                else:
-                    logger.warning("No se recibió una actualización válida")
-                    return 'No update', 400
-            except Exception as e:
-                logger.error(f"Error en el webhook: {str(e)}")
-                return 'Error', 500
-
-        # Configuración de los handlers
-        dispatcher.add_handler(CommandHandler("menu", handle_menu))
-        dispatcher.add_handler(CommandHandler("sumar", handle_sumar_command))
-        dispatcher.add_handler(CommandHandler("restar", handle_restar_command))
-        dispatcher.add_handler(CommandHandler("ping", handle_ping))
-        dispatcher.add_handler(CommandHandler("ayuda", handle_ayuda))
-        dispatcher.add_handler(CommandHandler("graficas", handle_graficas))
-        dispatcher.add_handler(MessageHandler(Filters.text | Filters.photo | Filters.document | Filters.video, handle_message))
-        dispatcher.add_handler(CallbackQueryHandler(button_handler))
-
-        # Inicialización del programa
-        if __name__ == '__main__':
-            logger.info("Iniciando el bot...")
-            init_db()
-            threading.Thread(target=check_menu_timeout, daemon=True).start()
-            threading.Thread(target=auto_clean_cache, daemon=True).start()
-
-            # Obtener el puerto de Render o usar 5000 como fallback
-            port = int(os.getenv('PORT', 5000))
-
-            # Construir la URL del webhook dinámicamente usando el dominio de Render
-            render_domain = os.getenv('RENDER_EXTERNAL_HOSTNAME', 'localhost')
-            webhook_url = f"https://{render_domain}/webhook" if render_domain != 'localhost' else f"http://localhost:{port}/webhook"
-            logger.info(f"Intentando configurar webhook en: {webhook_url}")
-
-            # Limpiar actualizaciones pendientes antes de configurar el webhook
-            try:
-                updates = bot.get_updates()
-                if updates:
-                    last_update_id = updates[-1].update_id
-                    bot.get_updates(offset=last_update_id + 1)
-                    logger.info(f"Se limpiaron {len(updates)} actualizaciones pendientes.")
-                else:
-                    logger.info("No había actualizaciones pendientes para limpiar.")
-            except telegram.error.TelegramError as e:
-                logger.error(f"Error al limpiar actualizaciones pendientes: {str(e)}")
+def iniciar_workers_webhook():
+    if WEBHOOK_WORKERS <= 0:
+        return
+    por_cola = max(1, WEBHOOK_QUEUE_SIZE // WEBHOOK_WORKERS)
+    for i in range(WEBHOOK_WORKERS):
+        cola = queue.Queue(maxsize=por_cola)
+        hilo = threading.Thread(target=worker_webhook, args=(cola,), name=f"webhook-{i}", daemon=True)
+        _colas_webhook.append(cola)
+        _workers_webhook.append(hilo)
+        hilo.start()
+    atexit.register(drenar_webhook)
+    logger.info(f"Ingesta asíncrona del webhook: {WEBHOOK_WORKERS} workers, cola de {por_cola * WEBHOOK_WORKERS}")
+
+def drenar_webhook():
+    global _webhook_aceptando
+    _webhook_aceptando = False
+    limite = time.monotonic() + WEBHOOK_DRAIN_TIMEOUT
+    pendientes = sum(c.qsize() for c in _colas_webhook)
+    if pendientes:
+        logger.info(f"Vaciando la cola del webhook ({pendientes} actualizaciones pendientes)...")
+    for cola in _colas_webhook:
+        try:
+            cola.put(None, timeout=max(0.1, limite - time.monotonic()))
+        except queue.Full:
+            pass
+    for hilo in _workers_webhook:
+        hilo.join(max(0.1, limite - time.monotonic()))
+    restantes = sum(c.qsize() for c in _colas_webhook)
+    if restantes:
+        logger.warning(f"Apagado con {restantes} actualizaciones sin procesar en la cola del webhook")
+    drenar_bandeja()  # Los envíos generados al vaciar la cola también deben salir
+
+def get_webhook_stats():
+    with _webhook_stats_lock:
+        stats = dict(_webhook_stats)
+    stats["workers"] = len(_workers_webhook)
+    stats["profundidad"] = sum(c.qsize() for c in _colas_webhook)
+    stats["capacidad"] = sum(c.maxsize for c in _colas_webhook)
+    return stats
+
+@app.route('/webhook', methods=['POST'])
+def webhook():
+    try:
+        try:
+            update = telegram.Update.de_json(request.get_json(force=True, silent=True), bot)
+        except (TypeError, ValueError, AttributeError) as e:
+            logger.warning(f"Actualización malformada: {str(e)}")
+            return 'Bad update', 400
+        if not update:
+            logger.warning("No se recibió una actualización válida")
+            return 'No update', 400
+        _contar_webhook("recibidas")
+        logger.debug(f"Procesando actualización: {update}")
+        if not _colas_webhook:
+            procesar_update(update)
+            logger.debug("Actualización procesada correctamente")
+            return 'OK', 200
+        if not _webhook_aceptando:
+            _contar_webhook("rechazadas")
+            return 'Shutting down', 503, {'Retry-After': str(WEBHOOK_RETRY_AFTER)}
+        chat = update.effective_chat
+        cola = _colas_webhook[hash(chat.id if chat else update.update_id) % len(_colas_webhook)]
+        try:
+            cola.put_nowait(update)
+        except queue.Full:
+            _contar_webhook("rechazadas")
+            logger.warning(f"Cola del webhook llena, se pide a Telegram reintentar en {WEBHOOK_RETRY_AFTER}s")
+            return 'Queue full', 503, {'Retry-After': str(WEBHOOK_RETRY_AFTER)}
+        profundidad = sum(c.qsize() for c in _colas_webhook)
+        with _webhook_stats_lock:
+            _webhook_stats["encoladas"] += 1
+            _webhook_stats["profundidad_max"] = max(_webhook_stats["profundidad_max"], profundidad)
+        return 'OK', 200
+    except Exception as e:
+        logger.error(f"Error en el webhook: {str(e)}")
+        return 'Error', 500
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    indicadores = [(f"bot_db_pool_{k}", f"Pool de conexiones: {k}", v) for k, v in get_pool_stats().items()]
+    indicadores += [(f"bot_webhook_{k}", f"Ingesta del webhook: {k}", v) for k, v in get_webhook_stats().items()]
+    if OUTBOX_WORKERS > 0:
+        indicadores += [(f"bot_outbox_{k}", f"Bandeja de salida de Telegram: {k}", v) for k, v in obtener_bandeja().estadisticas().items()]
+    return metricas.exponer(indicadores), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+# Familia de un callback para las métricas: pend_page_3_a120 -> pend_page, select_on_-100 -> select...
+FAMILIAS_CALLBACK = ("pend_page", "hist_page", "pend", "hist", "select", "confirm", "busq", "dup")
+
+def familia_callback(data):
+    if re.fullmatch(r"menu_[a-z]+", data or ""):
+        return data
+    for familia in FAMILIAS_CALLBACK:
+        if data.startswith(familia + "_"):
+            return familia
+    return "otro"
+
+def medir_handler(nombre, funcion):
+    def envoltura(update, context):
+        etiqueta = nombre
+        if update.callback_query:
+            etiqueta = f"{nombre}:{familia_callback(update.callback_query.data)}"
+        _contexto_update.handler = etiqueta
+        inicio = time.perf_counter()
+        try:
+            return funcion(update, context)
+        finally:
+            metricas.observar("bot_handler_seconds", time.perf_counter() - inicio, handler=etiqueta)
+    return envoltura
+
+# Configuración de los handlers
+dispatcher.add_handler(CommandHandler("menu", medir_handler("handle_menu", handle_menu)))
+dispatcher.add_handler(CommandHandler("sumar", medir_handler("handle_sumar_command", handle_sumar_command)))
+dispatcher.add_handler(CommandHandler("restar", medir_handler("handle_restar_command", handle_restar_command)))
+dispatcher.add_handler(CommandHandler("ping", medir_handler("handle_ping", handle_ping)))
+dispatcher.add_handler(CommandHandler("ayuda", medir_handler("handle_ayuda", handle_ayuda)))
+dispatcher.add_handler(CommandHandler("graficas", medir_handler("handle_graficas", handle_graficas)))
+dispatcher.add_handler(CommandHandler("buscar", medir_handler("handle_buscar", handle_buscar)))
+dispatcher.add_handler(MessageHandler(Filters.text | Filters.photo | Filters.document | Filters.video, medir_handler("handle_message", handle_message)))
+dispatcher.add_handler(CallbackQueryHandler(medir_handler("button_handler", button_handler)))
+
+# Inicialización del programa
+if __name__ == '__main__':
+    logger.info("Iniciando el bot...")
+    # SIGTERM termina con sys.exit para que atexit vacíe la cola del webhook antes de salir
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    iniciar_servicios()
+
+    # Obtener el puerto de Render o usar 5000 como fallback
+    port = int(os.getenv('PORT', 5000))
+
+    # Construir la URL del webhook dinámicamente usando el dominio de Render
+    render_domain = os.getenv('RENDER_EXTERNAL_HOSTNAME', 'localhost')
+    webhook_url = f"https://{render_domain}/webhook" if render_domain != 'localhost' else f"http://localhost:{port}/webhook"
+    logger.info(f"Intentando configurar webhook en: {webhook_url}")
+
+    # Limpiar actualizaciones pendientes antes de configurar el webhook
+    try:
+        updates = bot.get_updates()
+        if updates:
+            last_update_id = updates[-1].update_id
+            bot.get_updates(offset=last_update_id + 1)
+            logger.info(f"Se limpiaron {len(updates)} actualizaciones pendientes.")
+        else:
+            logger.info("No había actualizaciones pendientes para limpiar.")
+    except telegram.error.TelegramError as e:
+        logger.error(f"Error al limpiar actualizaciones pendientes: {str(e)}")
 
-            # Configurar el webhook con manejo de errores detallado
-            try:
-                bot.set_webhook(url=webhook_url)
-                logger.info(f"Webhook configurado exitosamente en {webhook_url}")
-            except telegram.error.TelegramError as e:
-                logger.error(f"Error al configurar el webhook: {str(e)}")
-                raise Exception(f"No se pudo configurar el webhook: {str(e)}")
+    # Configurar el webhook con manejo de errores detallado
+    try:
+        bot.set_webhook(url=webhook_url)
+        logger.info(f"Webhook configurado exitosamente en {webhook_url}")
+    except telegram.error.TelegramError as e:
+        logger.error(f"Error al configurar el webhook: {str(e)}")
+        raise Exception(f"No se pudo configurar el webhook: {str(e)}")
 
-            # Verificar el estado del webhook después de configurarlo
-            try:
-                webhook_info = bot.get_webhook_info()
-                logger.info(f"Estado del webhook después de configurarlo: {webhook_info}")
-                if webhook_info.url != webhook_url:
-                    logger.error(f"El webhook no se configuró correctamente. URL esperada: {webhook_url}, URL actual: {webhook_info.url}")
-                    raise Exception("El webhook no se configuró correctamente.")
-            except telegram.error.TelegramError as e:
-                logger.error(f"Error al verificar el estado del webhook: {str(e)}")
-                raise Exception(f"No se pudo verificar el webhook: {str(e)}")
-
-            # Iniciar el servidor Flask
-            logger.info(f"Iniciando servidor en puerto {port}")
-            app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file
+    # Verificar el estado del webhook después de configurarlo
+    try:
+        webhook_info = bot.get_webhook_info()
+        logger.info(f"Estado del webhook después de configurarlo: {webhook_info}")
+        if webhook_info.url != webhook_url:
+            logger.error(f"El webhook no se configuró correctamente. URL esperada: {webhook_url}, URL actual: {webhook_info.url}")
+            raise Exception("El webhook no se configuró correctamente.")
+    except telegram.error.TelegramError as e:
+        logger.error(f"Error al verificar el estado del webhook: {str(e)}")
+        raise Exception(f"No se pudo verificar el webhook: {str(e)}")
+
+    # Iniciar el servidor Flask
+    logger.info(f"Iniciando servidor en puerto {port}")
+    app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file